@@ -1,16 +1,46 @@
 # ==================== IMPORTS ====================
 import os
+import io
+import sys
+import re
 import json
 import random
+import queue
 import requests
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, session, redirect, url_for, render_template, flash
+from datetime import datetime, timedelta, timezone
+import click
+from flask import Flask, Response, request, jsonify, session, redirect, url_for, render_template, flash, stream_with_context, make_response, send_from_directory
 import google.generativeai as genai
 from dotenv import load_dotenv
 from geopy.geocoders import Nominatim
 from geopy.distance import geodesic
 import sqlite3
+import hashlib
+import hmac
+import base64
+import zlib
+import gzip
+import tempfile
+import shutil
+import subprocess
+import csv
+import mmap
+import struct
+import bisect
+from array import array
+import time
+import threading
+import contextvars
+import cProfile
+import pstats
+import tracemalloc
+from collections import deque, OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from contextlib import contextmanager
+from enum import Enum
+from pathlib import Path
+from triage_rules import find_red_flag
 
 # ==================== CONFIGURATION ====================
 load_dotenv()
@@ -18,73 +48,318 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "sehat_saathi_secret_key_2024")
 app.config['DATABASE'] = 'sehat_saathi.db'
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "10"))
+db_write_latencies = deque(maxlen=500)
+# How long a booking idempotency key keeps answering retries with the original appointment
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+app.config['UPLOAD_FOLDER'] = 'data/uploads/prescriptions'
+app.config['MAX_PRESCRIPTION_BYTES'] = 16 * 1024 * 1024
+# Leave room for multipart headers around the 16MB image
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_PRESCRIPTION_BYTES'] + 64 * 1024
+
+# Static instructions - sent as the model's system instruction, not inline with every turn
+SYSTEM_INSTRUCTION = """
+You are "Sehat Saathi" - a healthcare assistant for rural India.
+Provide practical health solutions for the user's latest message.
+
+**RULES:**
+- Focus on SOLUTIONS only, no unnecessary explanations
+- Use simple Hindi-English mix for rural users
+- Keep it helpful but not too short
+- Maximum 6-7 lines total
+- No long stories, no causes, just actionable advice
+- Be empathetic but practical
+- For follow-up questions, use the earlier conversation instead of repeating advice
+
+**Example for headache:**
+🤕 Sir dard hai? Ye practical solutions try karein:
+• Thandi patti se matha ponche aur aaram karein
+• Ginger tea ya haldi doodh piyein
+• Andhere room mein 20-30 minute aaram karein
+⚠️ Agar 3-4 ghante tak dard na jaye ya ulti ho, doctor ko dikhayein
+"""
 
 # AI Configuration
 try:
     genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    model = genai.GenerativeModel('gemini-flash-latest')
+    model = genai.GenerativeModel('gemini-flash-latest', system_instruction=SYSTEM_INSTRUCTION)
     GEMINI_AVAILABLE = True
     print("✅ Gemini AI loaded successfully")
 except Exception as e:
     GEMINI_AVAILABLE = False
     print(f"⚠️ Gemini AI not available: {e}")
 
-# Twilio Configuration (Disabled for testing)
-TWILIO_ENABLED = False
-print("📱 Twilio DISABLED - Running in simulation mode")
+# LLM latency budget - fallback advice is served if Gemini is slower than this
+LLM_LATENCY_BUDGET = float(os.getenv("LLM_LATENCY_BUDGET", "6"))
+# Send a hedged second request after this percentile of recent latencies (0 = off)
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(6 * 3600)))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "2048"))  # cached answers, least recently used evicted first
+# Approximate token budget for conversation history sent with each follow-up
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "1200"))
+LLM_SUMMARY_TOKENS = int(os.getenv("LLM_SUMMARY_TOKENS", "300"))
+llm_executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_WORKERS", "8")), thread_name_prefix="gemini")
+llm_latencies = deque(maxlen=200)
+ai_response_cache = OrderedDict()
+ai_cache_lock = threading.Lock()
+
+# Image processing (optional - thumbnails need Pillow)
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+    print("⚠️ Pillow not installed - prescription thumbnails disabled")
+
+# Response compression (optional - gzip is used without brotli)
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+# Twilio Configuration (Disabled for testing unless TWILIO_ENABLED=true)
+TWILIO_ENABLED = os.getenv("TWILIO_ENABLED", "false").lower() == "true"
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+TWILIO_WHATSAPP_FROM = os.getenv("TWILIO_WHATSAPP_FROM")
+TWILIO_WEBHOOK_URL = os.getenv("TWILIO_WEBHOOK_URL")  # public webhook URL, if a proxy rewrites request.url
+if TWILIO_ENABLED:
+    print("📱 Twilio ENABLED - WhatsApp messages will be sent")
+else:
+    print("📱 Twilio DISABLED - Running in simulation mode")
 
 # Admin Credentials
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "sehat123"
 
-# Session Management
+# Session Management (session id -> ChatSession)
 user_sessions = {}
+slots_cache = {}
+
+# Deduplicated response texts (response id -> text)
+RESPONSE_TEXT_CACHE_SIZE = 4096
+response_text_cache = {}
+
+# Hospital Search Caches (pincode -> data)
+HOSPITAL_CACHE_TTL = int(os.getenv("HOSPITAL_CACHE_TTL", str(24 * 3600)))
+geocode_cache = {}
+hospital_cache = {}
 
 # ==================== DATABASE OPERATIONS ====================
 
 # ==================== AI HEALTH FUNCTIONS ====================
 
-def get_ai_health_response(user_message, conversation_history=None):
-    """Get balanced, solution-focused health advice using Gemini"""
+def get_cached_ai_response(user_message):
+    """Get cached AI response if still fresh"""
+    with ai_cache_lock:
+        entry = ai_response_cache.get(user_message)
+        if entry and time.time() - entry[1] < LLM_CACHE_TTL:
+            ai_response_cache.move_to_end(user_message)
+            return entry[0]
+    return None
+
+def cache_ai_response(user_message, ai_response):
+    """Cache AI response for repeated questions (LRU, at most LLM_CACHE_SIZE entries)"""
+    with ai_cache_lock:
+        ai_response_cache[user_message] = (ai_response, time.time())
+        ai_response_cache.move_to_end(user_message)
+        while len(ai_response_cache) > LLM_CACHE_SIZE:
+            ai_response_cache.popitem(last=False)
+
+def _timed_generate(prompt):
+    """Call Gemini and record how long it took"""
+    start = time.monotonic()
+    text = call_upstream('gemini', prompt, lambda: model.generate_content(prompt).text.strip())
+    llm_latencies.append(time.monotonic() - start)
+    return text
+
+def get_hedge_delay():
+    """Delay after which a hedged request is sent (None if hedging disabled)"""
+    if LLM_HEDGE_PERCENTILE <= 0 or len(llm_latencies) < 20:
+        return None
+    ordered = sorted(llm_latencies)
+    index = min(len(ordered) - 1, int(len(ordered) * LLM_HEDGE_PERCENTILE / 100))
+    return ordered[index]
+
+def generate_with_deadline(prompt, budget, on_late=None):
+    """
+    Run Gemini request within a latency budget.
+    Returns response text, or None if the budget ran out. A response that
+    arrives after the deadline is handed to on_late (once).
+    """
+    deadline = time.monotonic() + budget
+    # Copy the context so the call runs in the caller's scheduling lane
+    pending = {llm_executor.submit(contextvars.copy_context().run, _timed_generate, prompt)}
+
+    hedge_delay = get_hedge_delay()
+    if hedge_delay is not None and hedge_delay < budget:
+        done, _ = wait(pending, timeout=hedge_delay)
+        if not done:
+            pending.add(llm_executor.submit(contextvars.copy_context().run, _timed_generate, prompt))
+            print(f"🔁 Hedged Gemini request sent after {hedge_delay:.2f}s")
+
+    last_error = None
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            last_error = future.exception()
+
+    if not pending:
+        raise last_error
+
+    # Budget exceeded - deliver the first late answer in the background
+    if on_late:
+        delivered = threading.Event()
+
+        def deliver(future):
+            if future.exception() is None and not delivered.is_set():
+                delivered.set()
+                try:
+                    on_late(future.result())
+                except Exception as e:
+                    print(f"❌ Late AI response error: {e}")
+
+        for future in pending:
+            future.add_done_callback(deliver)
+    return None
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token)"""
+    return len(text) // 4 + 1
+
+# "• tip", "- tip", "* tip", "1. tip" - not "*Heading:*" lines
+SUMMARY_BULLET = re.compile(r"^(?:[•\-*]|\d+[.)])\s+(.+)")
+
+class ConversationContext:
+    """
+    Multi-turn chat history kept within a token budget. Recent turns are
+    sent verbatim; turns that no longer fit are folded into a short
+    running summary one at a time, so prompt size stays flat.
+    """
+    __slots__ = ('budget', 'summary_budget', 'turns', 'turn_tokens', 'summary_lines', 'summary_tokens')
+
+    def __init__(self, budget=None, summary_budget=None):
+        self.budget = budget or LLM_CONTEXT_TOKENS
+        self.summary_budget = summary_budget or LLM_SUMMARY_TOKENS
+        # Plain lists - only a handful of turns, and one exists per chat session
+        self.turns = []
+        self.turn_tokens = 0
+        self.summary_lines = []
+        self.summary_tokens = 0
+
+    def __len__(self):
+        return len(self.turns)
+
+    @property
+    def token_estimate(self):
+        return self.turn_tokens + self.summary_tokens
+
+    def add_turn(self, user_message, ai_response):
+        tokens = estimate_tokens(user_message) + estimate_tokens(ai_response)
+        self.turns.append((user_message, ai_response, tokens))
+        self.turn_tokens += tokens
+        # Keep the newest turn even if it alone exceeds the budget
+        while len(self.turns) > 1 and self.turn_tokens > self.budget - self.summary_tokens:
+            self.summarize_oldest_turn()
+
+    def summarize_oldest_turn(self):
+        user_message, ai_response, tokens = self.turns.pop(0)
+        self.turn_tokens -= tokens
+        lines = [line.strip() for line in ai_response.splitlines() if line.strip()]
+        # Replies open with a greeting/heading - the advice is in the bullet lines
+        bullets = [match.group(1) for match in map(SUMMARY_BULLET.match, lines) if match]
+        advice = '; '.join(bullets[:2]) if bullets else (lines[0] if lines else '')
+        line = f"- User said: {user_message[:120]} | Advised: {advice[:160]}"
+        self.summary_lines.append(line)
+        self.summary_tokens += estimate_tokens(line)
+        while len(self.summary_lines) > 1 and self.summary_tokens > self.summary_budget:
+            self.summary_tokens -= estimate_tokens(self.summary_lines.pop(0))
+
+    def build_contents(self, user_message):
+        """Gemini multi-turn contents for the next user message"""
+        contents = []
+        for past_message, past_response, _ in self.turns:
+            contents.append({'role': 'user', 'parts': [past_message]})
+            contents.append({'role': 'model', 'parts': [past_response]})
+        contents.append({'role': 'user', 'parts': [user_message]})
+        if self.summary_lines:
+            summary = "Earlier in this conversation:\n" + "\n".join(self.summary_lines)
+            contents[0]['parts'] = [summary + "\n\n" + contents[0]['parts'][0]]
+        return contents
+
+class LateAnswer:
+    """
+    Gemini answer that arrived after fallback advice was served. The health
+    query row is saved by the chat handler, so whichever of attach() and
+    deliver() runs second writes the answer onto that row.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.query_id = None
+        self.response = None
+
+    def attach(self, query_id):
+        with self.lock:
+            self.query_id = query_id
+            response = self.response
+        if response is not None:
+            update_health_query_response(query_id, response)
+
+    def deliver(self, response):
+        with self.lock:
+            self.response = response
+            query_id = self.query_id
+        if query_id is not None:
+            update_health_query_response(query_id, response)
+
+def get_ai_health_response(user_message, conversation=None, late_answer=None):
+    """
+    Get balanced, solution-focused health advice using Gemini.
+    Returns (reply, from_model) - from_model is False for fallback advice.
+    """
     try:
         if not GEMINI_AVAILABLE:
-            return get_balanced_fallback_advice(user_message)
-        
-        # BALANCED PROMPT - Solution Focused
-        prompt = f"""
-        You are "Sehat Saathi" - a healthcare assistant for rural India.
-        User: "{user_message}"
-        
-        Provide practical health solutions with this structure:
-        
-        
-        
-        **RULES:**
-        - Focus on SOLUTIONS only, no unnecessary explanations
-        - Use simple Hindi-English mix for rural users
-        - Keep it helpful but not too short
-        - Maximum 6-7 lines total
-        - No long stories, no causes, just actionable advice
-        - Be empathetic but practical
-        
-        **Example for headache:**
-        🤕 Sir dard hai? Ye practical solutions try karein:
-        • Thandi patti se matha ponche aur aaram karein
-        • Ginger tea ya haldi doodh piyein
-        • Andhere room mein 20-30 minute aaram karein
-        ⚠️ Agar 3-4 ghante tak dard na jaye ya ulti ho, doctor ko dikhayein
-        
-        Now respond to: "{user_message}"
-        """
-        
-        response = model.generate_content(prompt)
-        ai_response = response.text.strip()
-        
-        return ai_response
+            return get_balanced_fallback_advice(user_message), False
+
+        # Follow-ups depend on earlier turns, so only cold questions use the cache
+        is_follow_up = conversation is not None and len(conversation) > 0
+        if not is_follow_up:
+            cached_response = get_cached_ai_response(user_message)
+            if cached_response:
+                return cached_response, True
+
+        if is_follow_up:
+            prompt = conversation.build_contents(user_message)
+        else:
+            prompt = user_message
+
+        def record_late_response(late_response):
+            # User already got fallback advice - keep the real answer for next time
+            if not is_follow_up:
+                cache_ai_response(user_message, late_response)
+            if late_answer:
+                late_answer.deliver(late_response)
+            print(f"🕓 Late Gemini response saved for: {user_message}")
+
+        ai_response = generate_with_deadline(prompt, LLM_LATENCY_BUDGET, on_late=record_late_response)
+        if ai_response is None:
+            print(f"⏱️ Gemini exceeded {LLM_LATENCY_BUDGET}s budget - serving fallback advice")
+            return get_balanced_fallback_advice(user_message), False
+
+        if not is_follow_up:
+            cache_ai_response(user_message, ai_response)
+        return ai_response, True
         
     except Exception as e:
         print(f"❌ AI health response error: {e}")
-        return get_balanced_fallback_advice(user_message)
+        return get_balanced_fallback_advice(user_message), False
 
 def get_balanced_fallback_advice(symptoms):
     """Fallback balanced practical advice"""
@@ -146,29 +421,57 @@ def get_balanced_fallback_advice(symptoms):
 
 def save_conversation_context(session_id, user_message, ai_response):
     """Save conversation context for follow-up questions"""
-    if session_id not in user_sessions:
-        user_sessions[session_id] = {'state': 'main_menu', 'conversation_history': []}
+    session = get_chat_session(session_id)
     
-    # Keep last 3 exchanges for context
-    history = user_sessions[session_id].get('conversation_history', [])
-    history.append(f"User: {user_message}")
-    history.append(f"Assistant: {ai_response}")
-    
-    # Keep only recent history to avoid token limits
-    if len(history) > 6:
-        history = history[-6:]
-    
-    user_sessions[session_id]['conversation_history'] = history
+    # Older turns are summarized to stay within LLM_CONTEXT_TOKENS
+    if session.conversation is None:
+        session.conversation = ConversationContext()
+    session.conversation.add_turn(user_message, ai_response)
+
 @contextmanager
 def get_db():
-    """Database connection context manager"""
-    conn = sqlite3.connect(app.config['DATABASE'])
+    """Database connection context manager (writer path)"""
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=DB_BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA synchronous=NORMAL')  # durable enough with WAL, much faster commits
+    start = time.monotonic()
+    try:
+        yield conn
+    finally:
+        # Connections that changed rows count as writes
+        if conn.total_changes:
+            db_write_latencies.append(round((time.monotonic() - start) * 1000, 1))
+        conn.close()
+
+@contextmanager
+def get_read_db():
+    """
+    Read-only connection for admin and analytics reads. All queries inside
+    the block see one WAL snapshot and never block booking writes.
+    """
+    uri = Path(os.path.abspath(app.config['DATABASE'])).as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT, isolation_level=None)
     conn.row_factory = sqlite3.Row
     try:
+        conn.execute('BEGIN')
         yield conn
     finally:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
         conn.close()
 
+def get_write_timing_summary():
+    """Average, p95 and max of recent write transactions (ms)"""
+    ordered = sorted(db_write_latencies)
+    if not ordered:
+        return {}
+    return {
+        'count': len(ordered),
+        'avg': round(sum(ordered) / len(ordered), 1),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max': ordered[-1]
+    }
+
 def init_db():
     """Initialize database with all tables"""
     try:
@@ -176,6 +479,10 @@ def init_db():
         print("📁 Data directory checked")
         
         with get_db() as conn:
+            # WAL lets snapshot readers run alongside the writer (setting persists in the file)
+            journal_mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            print(f"🗄️ Journal mode: {journal_mode}")
+
             # Patients table
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS patients (
@@ -247,6 +554,17 @@ def init_db():
                     symptoms TEXT,
                     ai_response TEXT,
                     severity TEXT DEFAULT 'low',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    response_id INTEGER REFERENCES ai_responses(id)
+                )
+            ''')
+
+            # Deduplicated AI/fallback response texts, keyed by content hash
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS ai_responses (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    content_hash TEXT UNIQUE NOT NULL,
+                    content TEXT NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
@@ -262,7 +580,129 @@ def init_db():
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-            
+
+            # Prescriptions table
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS prescriptions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    patient_id INTEGER,
+                    session_id TEXT,
+                    doctor_name TEXT,
+                    hospital_name TEXT,
+                    medicines TEXT,
+                    prescription_date TEXT,
+                    file_hash TEXT UNIQUE NOT NULL,
+                    file_path TEXT NOT NULL,
+                    mime_type TEXT,
+                    size_bytes INTEGER,
+                    width INTEGER,
+                    height INTEGER,
+                    thumbnail_path TEXT,
+                    processing_status TEXT DEFAULT 'pending',
+                    processing_started_at REAL,
+                    status TEXT DEFAULT 'active',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (patient_id) REFERENCES patients (id)
+                )
+            ''')
+            columns = [row['name'] for row in conn.execute('PRAGMA table_info(prescriptions)')]
+            if 'processing_started_at' not in columns:
+                conn.execute('ALTER TABLE prescriptions ADD COLUMN processing_started_at REAL')
+
+            # WhatsApp inbound queue (acked immediately, processed by workers)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS whatsapp_inbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    provider_message_id TEXT UNIQUE NOT NULL,
+                    sender TEXT NOT NULL,
+                    body TEXT,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    reply TEXT,
+                    claimed_at REAL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    processed_at TIMESTAMP
+                )
+            ''')
+            columns = [row['name'] for row in conn.execute('PRAGMA table_info(whatsapp_inbox)')]
+            if 'claimed_at' not in columns:
+                conn.execute('ALTER TABLE whatsapp_inbox ADD COLUMN claimed_at REAL')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_whatsapp_inbox_status ON whatsapp_inbox (status, sender, id)')
+
+            # Booking idempotency keys - retried submissions get the original appointment back
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS idempotency_keys (
+                    key TEXT PRIMARY KEY,
+                    appointment_id INTEGER NOT NULL,
+                    reply TEXT,
+                    created_at REAL NOT NULL,
+                    FOREIGN KEY (appointment_id) REFERENCES appointments (id)
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)')
+
+            # Outbound notifications (sent in batches by the dispatcher)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS notifications (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    recipient TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    kind TEXT,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_notifications_due ON notifications (status, next_attempt_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_health_queries_created ON health_queries (created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_emergency_contacts_created ON emergency_contacts (created_at)')
+
+            # Facilities table (imported hospitals/clinics for offline search)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS facilities (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    type TEXT,
+                    specialization TEXT,
+                    address TEXT,
+                    latitude REAL,
+                    longitude REAL,
+                    phone TEXT,
+                    slots TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Legacy import ledger - makes re-running the importer a no-op
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS legacy_imports (
+                    source_key TEXT PRIMARY KEY,
+                    table_name TEXT,
+                    row_id INTEGER,
+                    imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Change log for the live admin feed (filled by triggers)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS change_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    table_name TEXT NOT NULL,
+                    row_id INTEGER,
+                    op TEXT NOT NULL,
+                    old_status TEXT,
+                    new_status TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_change_log_table ON change_log (table_name, id)')
+            create_change_triggers(conn)
+            prune_change_log(conn)
+            migrate_health_query_responses(conn)
+
             # Verify tables created
             tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
             print("📊 Database tables:", [table[0] for table in tables])
@@ -275,6 +715,64 @@ def init_db():
     except Exception as e:
         print(f"❌ Database initialization error: {e}")
 
+def prune_change_log(conn):
+    """Keep only the newest CHANGE_LOG_KEEP change_log rows (caller commits)"""
+    conn.execute('DELETE FROM change_log WHERE id <= (SELECT MAX(id) FROM change_log) - ?', (CHANGE_LOG_KEEP,))
+
+def create_change_triggers(conn):
+    """Record inserts/updates/deletes of watched tables in change_log"""
+    for table in CHANGE_FEED_TABLES:
+        # Appointment status transitions let the dashboard keep exact counters
+        old_status = 'OLD.status' if table == 'appointments' else 'NULL'
+        new_status = 'NEW.status' if table == 'appointments' else 'NULL'
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO change_log (table_name, row_id, op, new_status) VALUES ('{table}', NEW.id, 'insert', {new_status});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_update AFTER UPDATE ON {table}
+            BEGIN
+                INSERT INTO change_log (table_name, row_id, op, old_status, new_status)
+                VALUES ('{table}', NEW.id, 'update', {old_status}, {new_status});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO change_log (table_name, row_id, op, old_status) VALUES ('{table}', OLD.id, 'delete', {old_status});
+            END
+        ''')
+
+def migrate_health_query_responses(conn, batch_size=1000):
+    """Move inline health_queries.ai_response text into ai_responses"""
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(health_queries)')]
+    if 'response_id' not in columns:
+        conn.execute('ALTER TABLE health_queries ADD COLUMN response_id INTEGER REFERENCES ai_responses(id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_health_queries_response ON health_queries (response_id)')
+
+    migrated = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, ai_response FROM health_queries
+            WHERE response_id IS NULL AND ai_response IS NOT NULL
+            LIMIT ?
+        ''', (batch_size,)).fetchall()
+        if not rows:
+            break
+        conn.executemany('UPDATE health_queries SET response_id = ?, ai_response = NULL WHERE id = ?',
+                         [(store_response(conn, row['ai_response']), row['id']) for row in rows])
+        # Not real edits - keep them out of the live change feed
+        ids = [row['id'] for row in rows]
+        conn.execute(f"DELETE FROM change_log WHERE table_name = 'health_queries' AND op = 'update' "
+                     f"AND row_id IN ({','.join('?' * len(ids))})", ids)
+        conn.commit()
+        migrated += len(rows)
+    conn.commit()
+    if migrated:
+        print(f"🧬 Moved {migrated} health query responses into ai_responses")
+
 def insert_default_data(conn):
     """Insert default doctors and services"""
     # Check if doctors already exist
@@ -339,7 +837,7 @@ def get_patient(patient_id):
 
 def get_all_patients():
     """Get all patients"""
-    with get_db() as conn:
+    with get_read_db() as conn:
         return conn.execute('SELECT * FROM patients ORDER BY created_at DESC').fetchall()
 
 # Appointment Operations
@@ -359,33 +857,76 @@ def create_appointment(patient_id, hospital_name, hospital_type, slot, symptoms=
         print(f"❌ Error creating appointment: {e}")
         return None
 
-def create_emergency_appointment_direct(patient_name, hospital_name, pincode):
-    """Create emergency appointment directly"""
+# Idempotent bookings
+def booking_idempotency_keys(session_id, request_id):
+    """
+    Keys for one booking submission - only the client's request id, so a
+    retried request is booked once but a new booking (same patient, same
+    hospital) is always created. No request id means no deduplication.
+    """
+    return [f"request:{session_id}:{request_id}"] if request_id else []
+
+def find_idempotent_booking(conn, keys):
+    """(appointment_id, reply) stored under any of the keys within IDEMPOTENCY_TTL, or None"""
+    if not keys:
+        return None
+    placeholders = ','.join('?' * len(keys))
+    row = conn.execute(f'''
+        SELECT appointment_id, reply FROM idempotency_keys
+        WHERE key IN ({placeholders}) AND created_at > ?
+        ORDER BY created_at LIMIT 1
+    ''', (*keys, time.time() - IDEMPOTENCY_TTL)).fetchone()
+    return (row['appointment_id'], row['reply']) if row else None
+
+def get_idempotent_reply(session_id, request_id):
+    """Reply of a booking already made for this client request id, or None"""
+    with get_read_db() as conn:
+        found = find_idempotent_booking(conn, [f"request:{session_id}:{request_id}"])
+    return found[1] if found else None
+
+def create_booking(keys, patient_name, phone, pincode, hospital_name, hospital_type, slot, confirmation,
+                   maps_link=None, priority='normal', status='pending'):
+    """
+    Create patient + appointment in one transaction and record the keys.
+    confirmation(appointment_id) builds the reply stored with the keys.
+    Returns (appointment_id, reply, duplicate) - a key seen within
+    IDEMPOTENCY_TTL returns the original booking without writing.
+    """
     try:
         with get_db() as conn:
-            # Create patient first
-            cursor = conn.execute('''
-                INSERT INTO patients (name, pincode, phone) 
-                VALUES (?, ?, ?)
-            ''', (patient_name, pincode, 'emergency_user'))
-            patient_id = cursor.lastrowid
-            
-            # Create emergency appointment with immediate slot
-            emergency_slot = (datetime.now() + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M')
-            
-            cursor = conn.execute('''
-                INSERT INTO appointments (patient_id, hospital_name, hospital_type, slot, pincode, priority, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (patient_id, hospital_name, 'Emergency', emergency_slot, pincode, 'emergency', 'confirmed'))
-            
-            appointment_id = cursor.lastrowid
-            conn.commit()
-            
-            print(f"✅ EMERGENCY Appointment saved: {appointment_id}")
-            return appointment_id
+            found = find_idempotent_booking(conn, keys)
+            if found:
+                return found[0], found[1], True
+
+            with db_write_slot():
+                conn.execute('BEGIN IMMEDIATE')
+                # A concurrent retry may have booked between the check and the lock
+                found = find_idempotent_booking(conn, keys)
+                if found:
+                    conn.rollback()
+                    return found[0], found[1], True
+
+                now = time.time()
+                conn.execute('DELETE FROM idempotency_keys WHERE created_at <= ?', (now - IDEMPOTENCY_TTL,))
+                cursor = conn.execute('''
+                    INSERT INTO patients (name, phone, pincode) VALUES (?, ?, ?)
+                ''', (patient_name, phone, pincode))
+                patient_id = cursor.lastrowid
+                cursor = conn.execute('''
+                    INSERT INTO appointments (patient_id, hospital_name, hospital_type, slot, pincode, maps_link, priority, status)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (patient_id, hospital_name, hospital_type, slot, pincode, maps_link, priority, status))
+                appointment_id = cursor.lastrowid
+                reply = confirmation(appointment_id)
+                conn.executemany('''
+                    INSERT OR REPLACE INTO idempotency_keys (key, appointment_id, reply, created_at) VALUES (?, ?, ?, ?)
+                ''', [(key, appointment_id, reply, now) for key in keys])
+                conn.commit()
+            print(f"✅ Appointment saved: {appointment_id} - Patient: {patient_id} ({priority})")
+            return appointment_id, reply, False
     except Exception as e:
-        print(f"❌ Emergency appointment error: {e}")
-        return None
+        print(f"❌ Error creating booking: {e}")
+        return None, None, False
 
 def get_appointment(appointment_id):
     """Get appointment by ID"""
@@ -400,7 +941,7 @@ def get_appointment(appointment_id):
 def get_all_appointments():
     """Get all appointments with patient details"""
     try:
-        with get_db() as conn:
+        with get_read_db() as conn:
             appointments = conn.execute('''
                 SELECT a.*, p.name as patient_name, p.phone, p.age, p.gender
                 FROM appointments a 
@@ -426,6 +967,48 @@ def update_appointment_status(appointment_id, status, approved_by=None):
             conn.execute('UPDATE appointments SET status = ? WHERE id = ?', (status, appointment_id))
         conn.commit()
 
+def bulk_update_appointments(appointment_ids, action, approved_by='admin'):
+    """
+    Apply accept/reject/delete to many appointments in one transaction.
+    Returns rows that actually changed (deleted ids for delete).
+    """
+    ids = sorted(set(appointment_ids))
+    new_status = {'accept': 'confirmed', 'reject': 'rejected'}.get(action)
+
+    def select_ids(conn, query, ids, params=()):
+        # Chunked to stay under SQLite's bound-parameter limit
+        found = []
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            found += conn.execute(query.format(placeholders), list(params) + chunk).fetchall()
+        return found
+
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if action == 'delete':
+            rows = select_ids(conn, 'SELECT id FROM appointments WHERE id IN ({})', ids)
+            changed_ids = [row['id'] for row in rows]
+            conn.executemany('DELETE FROM appointments WHERE id = ?', [(i,) for i in changed_ids])
+            conn.commit()
+            return changed_ids
+
+        rows = select_ids(conn, 'SELECT id FROM appointments WHERE status != ? AND id IN ({})', ids, (new_status,))
+        changed_ids = [row['id'] for row in rows]
+        conn.executemany('''
+            UPDATE appointments
+            SET status = ?, approved_by = ?, approved_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', [(new_status, approved_by, i) for i in changed_ids])
+        changed = select_ids(conn, '''
+            SELECT a.*, p.name as patient_name, p.phone
+            FROM appointments a
+            LEFT JOIN patients p ON a.patient_id = p.id
+            WHERE a.id IN ({})
+        ''', changed_ids)
+        conn.commit()
+        return changed
+
 def delete_appointment(appointment_id):
     """Delete appointment"""
     with get_db() as conn:
@@ -448,42 +1031,151 @@ def update_doctor_status(doctor_id, status):
     with get_db() as conn:
         conn.execute('UPDATE doctors SET status = ? WHERE id = ?', (status, doctor_id))
         conn.commit()
+    doctor_directory.invalidate()
+
+def create_doctor(name, specialization, fee, contact, online_link, languages='Hindi,English'):
+    """Create new doctor record"""
+    try:
+        with get_db() as conn:
+            cursor = conn.execute('''
+                INSERT INTO doctors (name, specialization, fee, contact, online_link, languages)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (name, specialization, fee, contact, online_link, languages))
+            conn.commit()
+        doctor_directory.invalidate()
+        print(f"✅ Doctor saved: {cursor.lastrowid} - {name}")
+        return cursor.lastrowid
+    except Exception as e:
+        print(f"❌ Error creating doctor: {e}")
+        return None
 
 # Health Queries Operations
+def store_response(conn, content):
+    """Id of response text in ai_responses, inserting it if new (caller commits)"""
+    if content is None:
+        return None
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    conn.execute('INSERT OR IGNORE INTO ai_responses (content_hash, content) VALUES (?, ?)', (content_hash, content))
+    return conn.execute('SELECT id FROM ai_responses WHERE content_hash = ?', (content_hash,)).fetchone()[0]
+
+def get_response_texts(response_ids):
+    """Map response id -> text (texts never change, so they are cached)"""
+    missing = [i for i in set(response_ids) if i is not None and i not in response_text_cache]
+    if missing:
+        if len(response_text_cache) > RESPONSE_TEXT_CACHE_SIZE:
+            response_text_cache.clear()
+        with get_read_db() as conn:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                for row in conn.execute(f"SELECT id, content FROM ai_responses WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+                    response_text_cache[row['id']] = row['content']
+    return {i: response_text_cache.get(i) for i in response_ids if i is not None}
+
+def with_response_text(rows, batch_size=500):
+    """Fill ai_response from ai_responses for health query rows, yields dicts"""
+    rows = iter(rows)
+    while True:
+        batch = [dict(row) for row in islice(rows, batch_size)]
+        if not batch:
+            break
+        texts = get_response_texts([row.get('response_id') for row in batch])
+        for row in batch:
+            if row.get('response_id') is not None:
+                row['ai_response'] = texts.get(row['response_id'])
+            yield row
+
 def save_health_query(patient_phone, symptoms, ai_response, severity='low'):
-    """Save health query for analytics"""
-    with get_db() as conn:
-        conn.execute('''
-            INSERT INTO health_queries (patient_phone, symptoms, ai_response, severity)
+    """Save health query for analytics, returns the new row id"""
+    with db_write_slot(), get_db() as conn:
+        response_id = store_response(conn, ai_response)
+        cursor = conn.execute('''
+            INSERT INTO health_queries (patient_phone, symptoms, response_id, severity)
             VALUES (?, ?, ?, ?)
-        ''', (patient_phone, symptoms, ai_response, severity))
+        ''', (patient_phone, symptoms, response_id, severity))
         conn.commit()
+        return cursor.lastrowid
 
-def get_health_queries():
-    """Get all health queries"""
-    with get_db() as conn:
-        return conn.execute('SELECT * FROM health_queries ORDER BY created_at DESC').fetchall()
+def update_health_query_response(query_id, ai_response):
+    """Replace the saved answer of a health query (late Gemini answer after fallback advice)"""
+    with db_write_slot(), get_db() as conn:
+        response_id = store_response(conn, ai_response)
+        conn.execute('UPDATE health_queries SET response_id = ? WHERE id = ?', (response_id, query_id))
+        conn.commit()
+
+def get_health_queries(limit=None, response_id=None):
+    """Get health queries, newest first, including archived months"""
+    query, params = 'SELECT * FROM health_queries ORDER BY created_at DESC', ()
+    if response_id is not None:
+        query, params = 'SELECT * FROM health_queries WHERE response_id = ? ORDER BY created_at DESC', (response_id,)
+    rows = with_response_text(iter_partitioned_rows('health_queries', query, params, newest_first=True))
+    return list(rows if limit is None else islice(rows, limit))
+
+def get_top_responses(limit=10):
+    """Most reused responses across hot and archived health queries"""
+    uses = {}
+    for row in iter_partitioned_rows('health_queries', '''
+        SELECT response_id, COUNT(*) AS uses FROM health_queries
+        WHERE response_id IS NOT NULL GROUP BY response_id
+    '''):
+        uses[row['response_id']] = uses.get(row['response_id'], 0) + row['uses']
+    top = sorted(uses.items(), key=lambda item: -item[1])[:limit]
+    texts = get_response_texts([response_id for response_id, _ in top])
+    return [{'response_id': response_id, 'uses': count, 'content': texts.get(response_id)} for response_id, count in top]
 
 # Emergency Operations
 def log_emergency_contact(patient_phone, emergency_type, pincode, action_taken):
     """Log emergency contact for analytics"""
-    with get_db() as conn:
+    with db_write_slot(), get_db() as conn:
         conn.execute('''
             INSERT INTO emergency_contacts (patient_phone, emergency_type, pincode, action_taken)
             VALUES (?, ?, ?, ?)
         ''', (patient_phone, emergency_type, pincode, action_taken))
         conn.commit()
 
-def get_emergency_logs():
-    """Get all emergency logs"""
+def get_emergency_logs(limit=None):
+    """Get emergency logs, newest first, including archived months"""
+    rows = iter_partitioned_rows('emergency_contacts', 'SELECT * FROM emergency_contacts ORDER BY created_at DESC', newest_first=True)
+    return list(rows if limit is None else islice(rows, limit))
+
+# Prescription Operations
+def create_prescription(file_hash, file_path, mime_type, size_bytes, session_id=None):
+    """Create prescription record, returns (id, is_duplicate)"""
     with get_db() as conn:
-        return conn.execute('SELECT * FROM emergency_contacts ORDER BY created_at DESC').fetchall()
+        try:
+            cursor = conn.execute('''
+                INSERT INTO prescriptions (file_hash, file_path, mime_type, size_bytes, session_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (file_hash, file_path, mime_type, size_bytes, session_id))
+            conn.commit()
+            return cursor.lastrowid, False
+        except sqlite3.IntegrityError:
+            # Same image uploaded concurrently
+            existing = conn.execute('SELECT id FROM prescriptions WHERE file_hash = ?', (file_hash,)).fetchone()
+            return existing['id'], True
+
+def get_prescription_by_hash(file_hash):
+    """Get prescription by image content hash"""
+    with get_db() as conn:
+        return conn.execute('SELECT * FROM prescriptions WHERE file_hash = ?', (file_hash,)).fetchone()
+
+def get_all_prescriptions():
+    """Get all prescriptions with patient names"""
+    with get_read_db() as conn:
+        return conn.execute('''
+            SELECT pr.*, COALESCE(p.name, 'Web User') as patient_name
+            FROM prescriptions pr
+            LEFT JOIN patients p ON pr.patient_id = p.id
+            ORDER BY pr.created_at DESC
+        ''').fetchall()
 
 # ==================== HELPER FUNCTIONS ====================
 
 def get_available_slots():
-    """Get available appointment slots for next 7 days"""
+    """Get available appointment slots for next 7 days (shared tuple, rebuilt hourly)"""
     today = datetime.now()
+    key = today.strftime('%Y-%m-%d %H')
+    if slots_cache.get('key') == key:
+        return slots_cache['slots']
     slots = []
     
     for i in range(7):  # Next 7 days
@@ -496,18 +1188,90 @@ def get_available_slots():
             slot_str = slot_time.strftime('%Y-%m-%d %H:%M')
             slots.append(slot_str)
                 
-    return slots[:8]
+    slots_cache['key'], slots_cache['slots'] = key, tuple(slots[:8])
+    return slots_cache['slots']
+
+DOCTOR_DIRECTORY_TTL = 300  # also reload periodically to pick up writes from other workers
+
+def get_fee_tier(fee):
+    """Bucket fee text ('Free', '₹50') into free/low/mid/high"""
+    digits = ''.join(ch for ch in str(fee or '') if ch.isdigit())
+    if not digits:
+        return 'free'
+    amount = int(digits)
+    if amount <= 100:
+        return 'low'
+    if amount <= 300:
+        return 'mid'
+    return 'high'
+
+class DoctorDirectory:
+    """
+    Shared in-memory index of active doctors by specialization, language
+    and fee tier. Writes call invalidate(); the next read reloads.
+    Returned doctor dicts are shared - treat them as read-only.
+    """
 
-def get_available_doctors(specialization=None):
-    """Get available doctors from database"""
-    doctors = get_all_doctors()
-    
-    if specialization:
-        doctors = [dict(doc) for doc in doctors if specialization.lower() in doc['specialization'].lower()]
-    else:
-        doctors = [dict(doc) for doc in doctors]
-    
-    return doctors
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.by_id = {}
+        self.ordered_ids = ()
+        self.by_specialization = {}
+        self.by_language = {}
+        self.by_fee_tier = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self.loaded_at and time.monotonic() - self.loaded_at < DOCTOR_DIRECTORY_TTL:
+                return
+            by_id, by_specialization, by_language, by_fee_tier = {}, {}, {}, {}
+            for row in get_all_doctors():
+                doctor = dict(row)
+                doctor['languages'] = [lang.strip() for lang in (doctor.get('languages') or '').split(',') if lang.strip()]
+                doctor['fee_tier'] = get_fee_tier(doctor.get('fee'))
+                by_id[doctor['id']] = doctor
+                by_specialization.setdefault(doctor['specialization'].lower(), []).append(doctor['id'])
+                for language in doctor['languages']:
+                    by_language.setdefault(language.lower(), []).append(doctor['id'])
+                by_fee_tier.setdefault(doctor['fee_tier'], []).append(doctor['id'])
+            self.by_id, self.ordered_ids = by_id, tuple(by_id)
+            self.by_specialization, self.by_language, self.by_fee_tier = by_specialization, by_language, by_fee_tier
+            self.loaded_at = time.monotonic()
+
+    def get(self, doctor_id):
+        self.ensure_loaded()
+        return self.by_id.get(doctor_id)
+
+    def active_listing(self):
+        """(ids, doctors) for all active doctors - the ids tuple is shared and safe to keep"""
+        self.ensure_loaded()
+        with self.lock:
+            ids, by_id = self.ordered_ids, self.by_id
+        return ids, [by_id[i] for i in ids]
+
+    def search(self, specialization=None, language=None, fee_tier=None):
+        """Active doctors matching all given filters"""
+        self.ensure_loaded()
+        ids = set(self.ordered_ids)
+        if specialization:
+            wanted = specialization.lower()
+            ids &= {i for spec, spec_ids in self.by_specialization.items() if wanted in spec for i in spec_ids}
+        if language:
+            ids &= set(self.by_language.get(language.lower(), []))
+        if fee_tier:
+            ids &= set(self.by_fee_tier.get(fee_tier, []))
+        return [self.by_id[i] for i in self.ordered_ids if i in ids]
+
+doctor_directory = DoctorDirectory()
+
+def get_available_doctors(specialization=None, language=None, fee_tier=None):
+    """Get available doctors from the shared directory"""
+    return doctor_directory.search(specialization, language, fee_tier)
 
 def simulate_whatsapp_message(to_number, message):
     """Simulate WhatsApp message and log it"""
@@ -516,10 +1280,629 @@ def simulate_whatsapp_message(to_number, message):
     print("📱 [STATUS]: ✅ Message would be sent via WhatsApp")
     return True
 
+def send_whatsapp_message(to_number, message):
+    """Send WhatsApp message via Twilio (simulated when Twilio is disabled)"""
+    if not TWILIO_ENABLED:
+        return simulate_whatsapp_message(to_number, message)
+    url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json"
+    resp = requests.post(url, data={'From': TWILIO_WHATSAPP_FROM, 'To': to_number, 'Body': message},
+                         auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), timeout=15)
+    resp.raise_for_status()
+    return True
+
+def twilio_signature_valid(url, params, signature):
+    """Check X-Twilio-Signature: base64 HMAC-SHA1 of the URL plus sorted POST params"""
+    if not TWILIO_AUTH_TOKEN or not signature:
+        return False
+    payload = url + ''.join(f"{key}{value}" for key in sorted(params) for value in params.getlist(key))
+    digest = hmac.new(TWILIO_AUTH_TOKEN.encode(), payload.encode('utf-8'), hashlib.sha1).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode(), signature)
+
+# ==================== CHAT SESSIONS ====================
+
+class ChatState(str, Enum):
+    """Chat state machine states"""
+    MAIN_MENU = 'main_menu'
+    EMERGENCY_HELP = 'emergency_help'
+    AWAITING_PINCODE_FOR_EMERGENCY = 'awaiting_pincode_for_emergency'
+    EMERGENCY_SERVICES_SHOWN = 'emergency_services_shown'
+    EMERGENCY_APPOINT_PINCODE = 'emergency_appoint_pincode'
+    EMERGENCY_HOSPITAL_SELECT = 'emergency_hospital_select'
+    EMERGENCY_PATIENT_NAME = 'emergency_patient_name'
+    GENERAL_QUERY = 'general_query'
+    AWAITING_PINCODE_FOR_APPOINTMENT = 'awaiting_pincode_for_appointment'
+    HOSPITALS_SHOWN = 'hospitals_shown'
+    HOSPITALS_SHOWN_FOR_APPOINTMENT = 'hospitals_shown_for_appointment'
+    SELECT_SLOT = 'select_slot'
+    GET_PATIENT_NAME = 'get_patient_name'
+    TELE_SELECT = 'tele_select'
+    AWAITING_PINCODE_FOR_HOSPITAL = 'awaiting_pincode_for_hospital'
+
+class ChatSession:
+    """
+    Per-user chat state. Hospital lists, slots and doctor ids are references
+    to shared cached objects; selections are small indexes into them.
+    """
+    __slots__ = ('state', 'pincode', 'hospitals', 'hospital_index', 'slots', 'slot_index',
+                 'doctor_ids', 'patient_phone', 'conversation', 'recent_replies')
+
+    def __init__(self):
+        self.state = ChatState.MAIN_MENU
+        self.pincode = None
+        self.hospitals = None
+        self.hospital_index = None
+        self.slots = None
+        self.slot_index = None
+        self.doctor_ids = None
+        self.patient_phone = None
+        self.conversation = None
+        self.recent_replies = None  # [(request_id, reply)] of the last few client requests
+
+    def selected_hospital(self):
+        if self.hospitals and self.hospital_index is not None and self.hospital_index < len(self.hospitals):
+            return self.hospitals[self.hospital_index]
+        return {}
+
+    def selected_slot(self):
+        if self.slots and self.slot_index is not None and self.slot_index < len(self.slots):
+            return self.slots[self.slot_index]
+        return ''
+
+    def clear_booking(self):
+        self.pincode = self.hospitals = self.hospital_index = self.slots = self.slot_index = None
+
+def get_chat_session(session_id):
+    """Get or create chat session"""
+    session = user_sessions.get(session_id)
+    if session is None:
+        session = user_sessions.setdefault(session_id, ChatSession())
+    return session
+
+# ==================== UPSTREAM CIRCUIT BREAKERS ====================
+
+class UpstreamUnavailable(Exception):
+    """Raised when an upstream API fails or its circuit is open"""
+
+class CircuitBreaker:
+    """
+    Failure-rate circuit breaker for an upstream API.
+    closed -> open when failure rate over the recent window crosses the threshold,
+    open -> half_open after cooldown (one trial call), half_open -> closed on success.
+    """
+
+    def __init__(self, name, failure_threshold=0.5, window_size=20, min_calls=5, cooldown=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.opened_at = None
+        self.outcomes = deque(maxlen=window_size)
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def failure_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    return False
+                self.state = 'half_open'
+                self.trial_in_flight = False
+                print(f"🟡 Circuit {self.name}: half-open, trying one request")
+            if self.state == 'half_open':
+                if self.trial_in_flight:
+                    return False
+                self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.outcomes.append(True)
+            if self.state == 'half_open':
+                self.state = 'closed'
+                self.outcomes.clear()
+                print(f"🟢 Circuit {self.name}: closed")
+
+    def record_failure(self):
+        with self.lock:
+            self.outcomes.append(False)
+            if self.state == 'half_open' or (
+                    len(self.outcomes) >= self.min_calls and self.failure_rate() >= self.failure_threshold):
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                print(f"🔴 Circuit {self.name}: OPEN for {self.cooldown}s")
+
+    def call(self, func, *args, **kwargs):
+        """Call func through the breaker, raising UpstreamUnavailable on failure"""
+        if not self.allow_request():
+            raise UpstreamUnavailable(f"{self.name} circuit open")
+        try:
+            result = func(*args, **kwargs)
+        except SchedulerBusy:
+            raise  # queued locally - says nothing about the upstream
+        except Exception as e:
+            self.record_failure()
+            raise UpstreamUnavailable(f"{self.name} error: {e}") from e
+        self.record_success()
+        return result
+
+    def snapshot(self):
+        """Breaker state for /health"""
+        with self.lock:
+            return {
+                'state': self.state,
+                'failure_rate': round(self.failure_rate(), 2),
+                'recent_calls': len(self.outcomes),
+                'cooldown_remaining_s': round(max(0, self.cooldown - (time.monotonic() - self.opened_at)), 1)
+                if self.state == 'open' else 0
+            }
+
+nominatim_breaker = CircuitBreaker('nominatim', cooldown=int(os.getenv("NOMINATIM_COOLDOWN", "60")))
+overpass_breaker = CircuitBreaker('overpass', cooldown=int(os.getenv("OVERPASS_COOLDOWN", "60")))
+
+# ==================== PRIORITY SCHEDULING ====================
+
+# Highest priority first: emergency turns, interactive booking/lookup, routine LLM queries
+LANES = ('emergency', 'normal', 'routine')
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "8"))
+# Upstream slots only the emergency lane may use - routine load can never take them
+UPSTREAM_EMERGENCY_RESERVED = int(os.getenv("UPSTREAM_EMERGENCY_RESERVED", "2"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "30"))
+EMERGENCY_STATES = (
+    ChatState.EMERGENCY_HELP, ChatState.AWAITING_PINCODE_FOR_EMERGENCY, ChatState.EMERGENCY_SERVICES_SHOWN,
+    ChatState.EMERGENCY_APPOINT_PINCODE, ChatState.EMERGENCY_HOSPITAL_SELECT, ChatState.EMERGENCY_PATIENT_NAME
+)
+# Lane of the work running in this thread/context
+request_lane = contextvars.ContextVar('request_lane', default='normal')
+
+class SchedulerBusy(UpstreamUnavailable):
+    """Raised when a lane waited too long for capacity"""
+
+class PriorityScheduler:
+    """
+    Bounded capacity shared by LANES. A freed slot goes to the oldest waiter
+    of the highest-priority lane, so queued emergency work overtakes routine
+    work. `reserved` slots are usable by the emergency lane only.
+    """
+
+    def __init__(self, name, capacity, reserved=0):
+        self.name = name
+        self.capacity = capacity
+        self.reserved = min(reserved, capacity - 1)
+        self.cond = threading.Condition()
+        self.running = 0
+        self.active = {lane: 0 for lane in LANES}
+        self.waiting = {lane: deque() for lane in LANES}
+        self.wait_times = {lane: deque(maxlen=500) for lane in LANES}
+        self.completed = {lane: 0 for lane in LANES}
+        self.timed_out = {lane: 0 for lane in LANES}
+
+    def can_start(self, lane, ticket):
+        if self.waiting[lane][0] is not ticket:
+            return False
+        if any(self.waiting[higher] for higher in LANES[:LANES.index(lane)]):
+            return False
+        limit = self.capacity if lane == 'emergency' else self.capacity - self.reserved
+        return self.running < limit
+
+    @contextmanager
+    def slot(self, lane, timeout=None):
+        """Hold one slot of capacity in lane, raises SchedulerBusy after timeout"""
+        ticket = object()
+        start = time.monotonic()
+        with self.cond:
+            self.waiting[lane].append(ticket)
+            try:
+                while not self.can_start(lane, ticket):
+                    remaining = None if timeout is None else timeout - (time.monotonic() - start)
+                    if remaining is not None and remaining <= 0:
+                        self.timed_out[lane] += 1
+                        raise SchedulerBusy(f"{self.name} {lane} lane: no capacity within {timeout}s")
+                    self.cond.wait(remaining)
+            finally:
+                self.waiting[lane].remove(ticket)
+                self.cond.notify_all()
+            self.running += 1
+            self.active[lane] += 1
+            self.wait_times[lane].append((time.monotonic() - start) * 1000)
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.active[lane] -= 1
+                self.completed[lane] += 1
+                self.cond.notify_all()
+
+    def snapshot(self):
+        """Per-lane queue depth, active work and wait times (ms) for /health"""
+        with self.cond:
+            lanes = {}
+            for lane in LANES:
+                ordered = sorted(self.wait_times[lane])
+                lanes[lane] = {
+                    'queued': len(self.waiting[lane]),
+                    'active': self.active[lane],
+                    'completed': self.completed[lane],
+                    'timed_out': self.timed_out[lane],
+                    'wait_ms': {
+                        'avg': round(sum(ordered) / len(ordered), 1),
+                        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+                        'max': round(ordered[-1], 1)
+                    } if ordered else {}
+                }
+            return {'capacity': self.capacity, 'reserved': self.reserved, 'lanes': lanes}
+
+upstream_scheduler = PriorityScheduler('upstream', UPSTREAM_CONCURRENCY, UPSTREAM_EMERGENCY_RESERVED)
+# SQLite has one writer - ordering only, so emergency writes skip queued routine ones
+db_write_scheduler = PriorityScheduler('db_writes', 1)
+
+def chat_lane(state):
+    """Scheduling lane for a chat turn in this state"""
+    if state in EMERGENCY_STATES:
+        return 'emergency'
+    if state == ChatState.GENERAL_QUERY:
+        return 'routine'
+    return 'normal'
+
+def upstream_slot():
+    """Upstream capacity for the current lane; routine work gives up after the LLM budget"""
+    lane = request_lane.get()
+    timeout = LLM_LATENCY_BUDGET if lane == 'routine' else UPSTREAM_QUEUE_TIMEOUT
+    return upstream_scheduler.slot(lane, timeout)
+
+def db_write_slot():
+    """Writer turn for the current lane"""
+    return db_write_scheduler.slot(request_lane.get())
+
+class RateLimiter:
+    """
+    Minimum spacing between calls to an upstream, shared by all threads.
+    The next call goes to the oldest waiter of the highest-priority lane, so
+    an emergency lookup jumps queued normal ones. Waiting longer than the
+    lane's max_wait raises SchedulerBusy. Take it before the upstream slot.
+    """
+
+    def __init__(self, name, min_interval, max_wait):
+        self.name = name
+        self.min_interval = min_interval
+        self.max_wait = max_wait  # {lane: seconds}
+        self.next_at = 0.0
+        self.waiting = {lane: deque() for lane in LANES}
+        self.condition = threading.Condition()
+
+    def wait(self):
+        lane = request_lane.get()
+        deadline = time.monotonic() + self.max_wait[lane]
+        token = object()
+        with self.condition:
+            self.waiting[lane].append(token)
+            try:
+                while True:
+                    now = time.monotonic()
+                    head = next(waiters[0] for waiters in self.waiting.values() if waiters)
+                    if head is token and now >= self.next_at:
+                        self.next_at = now + self.min_interval
+                        return
+                    if now >= deadline:
+                        raise SchedulerBusy(f"{self.name} {lane} lane: no rate limit turn within {self.max_wait[lane]}s")
+                    wake_at = max(self.next_at, now) if head is token else deadline
+                    self.condition.wait(min(wake_at, deadline) - now)
+            finally:
+                self.waiting[lane].remove(token)
+                self.condition.notify_all()
+
+# Nominatim usage policy: at most one request per second from the whole app
+NOMINATIM_MIN_INTERVAL = 1.0
+NOMINATIM_MAX_WAIT = float(os.getenv("NOMINATIM_MAX_WAIT", "10"))
+nominatim_limiter = RateLimiter('nominatim', NOMINATIM_MIN_INTERVAL, {
+    'emergency': UPSTREAM_QUEUE_TIMEOUT, 'normal': NOMINATIM_MAX_WAIT, 'routine': NOMINATIM_MAX_WAIT})
+
+# ==================== TRAFFIC CAPTURE & REPLAY ====================
+
+# Opt-in: append anonymized /web-chat turns and upstream responses to a JSONL file.
+# Anonymization masks phone numbers, e-mail addresses, self-introductions ("mera naam ...")
+# and the name typed at the booking name step. Other free text (health queries) is kept
+# verbatim and may still mention names or addresses - treat capture files as patient data.
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH")
+TRAFFIC_CAPTURE_MAX_BYTES = int(os.getenv("TRAFFIC_CAPTURE_MAX_MB", "100")) * 1024 * 1024
+TRAFFIC_CAPTURE_SALT = os.getenv("TRAFFIC_CAPTURE_SALT") or os.urandom(16).hex()
+# Serve Gemini/Nominatim/Overpass from a capture instead of the network (benchmarks)
+TRAFFIC_REPLAY_PATH = os.getenv("TRAFFIC_REPLAY_PATH")
+TRAFFIC_REPLAY_SPEED = float(os.getenv("TRAFFIC_REPLAY_SPEED", "1"))
+NAME_STATES = (ChatState.GET_PATIENT_NAME, ChatState.EMERGENCY_PATIENT_NAME)
+PHONE_PATTERN = re.compile(r'\+?\d[\d -]{8,}\d')
+EMAIL_PATTERN = re.compile(r'[\w.+-]+@[\w-]+(\.[\w-]+)+')
+NAME_INTRO_PATTERN = re.compile(r"\b(my name is|mera naam|mera name|meri beti ka naam|mere bete ka naam)\s+([a-z]+(\s+[a-z]+)?)", re.IGNORECASE)
+
+def anonymize_text(text):
+    """Mask phone numbers, e-mails and introduced names (pincodes are kept - lookups need them)"""
+    text = PHONE_PATTERN.sub('9999999999', text)
+    text = EMAIL_PATTERN.sub('user@example.com', text)
+    return NAME_INTRO_PATTERN.sub(lambda match: f"{match.group(1)} [name]", text)
+
+def upstream_key(request_data):
+    """Stable hash of an upstream request, computed on the anonymized request"""
+    if not isinstance(request_data, str):
+        request_data = json.dumps(request_data, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(anonymize_text(request_data).encode()).hexdigest()[:20]
+
+class TrafficRecorder:
+    """Appends anonymized chat turns and upstream responses to a JSONL capture"""
+
+    def __init__(self, path, max_bytes=TRAFFIC_CAPTURE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.file = None
+        self.started = time.monotonic()
+        self.written = 0
+        self.full = False
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            if self.full:
+                return
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+                self.written = self.file.tell()
+            if self.written + len(line) > self.max_bytes:
+                self.full = True
+                print(f"⚠️ Traffic capture {self.path} reached its size limit - recording stopped")
+                return
+            self.file.write(line)
+            self.file.flush()
+            self.written += len(line)
+
+    def record_upstream(self, upstream, key, start, response=None, error=None):
+        record = {'type': 'upstream', 'upstream': upstream, 'key': key,
+                  'offset_s': round(start - self.started, 3),
+                  'latency_ms': round((time.monotonic() - start) * 1000, 1)}
+        if error is not None:
+            record['error'] = error
+        else:
+            # Gemini replies can echo what the user typed
+            record['response'] = anonymize_text(response) if isinstance(response, str) else response
+        self.write(record)
+
+    def run_turn(self, session_id, user_message, request_id=None):
+        """Process a chat turn and record it (a recording error never fails the turn)"""
+        session_id = str(session_id)
+        state = get_chat_session(session_id).state
+        start = time.monotonic()
+        reply = process_chat_message(session_id, user_message, request_id)
+        try:
+            self.record_turn(session_id, state, user_message, reply, start)
+        except Exception as e:
+            print(f"❌ Traffic capture error: {e}")
+        return reply
+
+    def record_turn(self, session_id, state, user_message, reply, start):
+        latency_ms = round((time.monotonic() - start) * 1000, 1)
+        digest = hashlib.sha256((TRAFFIC_CAPTURE_SALT + session_id).encode()).hexdigest()
+        message, recorded_reply = anonymize_text(user_message), anonymize_text(reply)
+        if state in NAME_STATES:
+            placeholder = f"patient {hashlib.sha256((TRAFFIC_CAPTURE_SALT + user_message).encode()).hexdigest()[:6]}"
+            recorded_reply = re.sub(re.escape(user_message), placeholder, recorded_reply, flags=re.IGNORECASE)
+            message = placeholder
+        self.write({'type': 'turn', 'session': digest[:12], 'offset_s': round(start - self.started, 3),
+                    'state': state.value, 'message': message, 'reply': recorded_reply, 'latency_ms': latency_ms})
+
+def load_traffic_capture(path):
+    """Read a capture file, returns (turns, upstream records) in capture order"""
+    turns, upstreams = [], []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # partially written last line
+            if record.get('type') == 'turn':
+                turns.append(record)
+            elif record.get('type') == 'upstream':
+                upstreams.append(record)
+    return turns, upstreams
+
+class TrafficReplay:
+    """
+    Serves upstream responses from a capture by request key. Repeated keys
+    are served in capture order; the last response is reused once they run out.
+    """
+
+    def __init__(self, path, speed=TRAFFIC_REPLAY_SPEED, upstream_latency=True):
+        _, upstreams = load_traffic_capture(path)
+        self.responses = {}
+        for record in upstreams:
+            self.responses.setdefault((record['upstream'], record['key']), deque()).append(record)
+        self.speed = speed
+        self.upstream_latency = upstream_latency
+        self.lock = threading.Lock()
+        self.served = 0
+        self.misses = 0
+
+    def response(self, upstream, key):
+        with self.lock:
+            recorded = self.responses.get((upstream, key))
+            if not recorded:
+                self.misses += 1
+                raise UpstreamUnavailable(f"{upstream} request not in capture")
+            record = recorded.popleft() if len(recorded) > 1 else recorded[0]
+            self.served += 1
+        if self.upstream_latency and self.speed > 0:
+            time.sleep(record['latency_ms'] / 1000 / self.speed)
+        if 'error' in record:
+            raise UpstreamUnavailable(f"{upstream} error (recorded): {record['error']}")
+        return record['response']
+
+traffic_recorder = TrafficRecorder(TRAFFIC_CAPTURE_PATH) if TRAFFIC_CAPTURE_PATH else None
+traffic_replay = TrafficReplay(TRAFFIC_REPLAY_PATH) if TRAFFIC_REPLAY_PATH else None
+if traffic_recorder:
+    print(f"🎙️ Traffic capture ENABLED -> {TRAFFIC_CAPTURE_PATH}")
+if traffic_replay:
+    print(f"🔁 Traffic replay: upstreams served from {TRAFFIC_REPLAY_PATH}")
+
+def call_upstream(upstream, request_data, fetch):
+    """
+    Run an upstream call. While capturing, its response is appended to the
+    capture; while replaying, the recorded response is returned instead.
+    """
+    with upstream_slot():
+        if traffic_replay is not None:
+            return traffic_replay.response(upstream, upstream_key(request_data))
+        if traffic_recorder is None:
+            return fetch()
+        start = time.monotonic()
+        try:
+            result = fetch()
+        except Exception as e:
+            traffic_recorder.record_upstream(upstream, upstream_key(request_data), start, error=str(e))
+            raise
+        traffic_recorder.record_upstream(upstream, upstream_key(request_data), start, response=result)
+        return result
+
+# ==================== LOCAL PINCODE DIRECTORY ====================
+
+PINCODE_INDEX_PATH = os.getenv("PINCODE_INDEX_PATH", 'data/pincodes.bin')
+PINCODE_INDEX_MAGIC = b'PINC'
+PINCODE_INDEX_HEADER = struct.Struct('<4sII')  # magic, version, count
+
+class PincodeDirectory:
+    """
+    Memory-mapped pincode -> (lat, lon) table built by `flask import-pincodes`.
+    Layout after header: int32 keys[n] (sorted), float32 lat[n], float32 lon[n].
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = PINCODE_INDEX_HEADER.unpack_from(self.mm, 0)
+        if magic != PINCODE_INDEX_MAGIC or version != 1:
+            raise ValueError(f"{path} is not a pincode index")
+        view = memoryview(self.mm)
+        start = PINCODE_INDEX_HEADER.size
+        self.keys = view[start:start + 4 * count].cast('i')
+        self.lats = view[start + 4 * count:start + 8 * count].cast('f')
+        self.lons = view[start + 8 * count:start + 12 * count].cast('f')
+        self.count = count
+
+    def lookup(self, pincode):
+        """Binary search for pincode, returns (lat, lon) or None"""
+        try:
+            key = int(pincode)
+        except (TypeError, ValueError):
+            return None
+        index = bisect.bisect_left(self.keys, key)
+        if index < self.count and self.keys[index] == key:
+            return (self.lats[index], self.lons[index])
+        return None
+
+def build_pincode_index(csv_path, out_path=PINCODE_INDEX_PATH):
+    """Convert India Post pincode CSV into the compact binary index"""
+    sums = {}
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        fields = {name.strip().lower(): name for name in reader.fieldnames or []}
+        pin_col, lat_col, lon_col = fields.get('pincode'), fields.get('latitude'), fields.get('longitude')
+        if not (pin_col and lat_col and lon_col):
+            raise ValueError("CSV needs pincode, latitude and longitude columns")
+
+        for row in reader:
+            try:
+                key = int(row[pin_col])
+                lat = float(row[lat_col])
+                lon = float(row[lon_col])
+            except (TypeError, ValueError):
+                continue  # 'NA' coordinates in the India Post directory
+            # Several post offices share a pincode - average their coordinates
+            entry = sums.setdefault(key, [0.0, 0.0, 0])
+            entry[0] += lat
+            entry[1] += lon
+            entry[2] += 1
+
+    keys = sorted(sums)
+    lats = array('f', (sums[k][0] / sums[k][2] for k in keys))
+    lons = array('f', (sums[k][1] / sums[k][2] for k in keys))
+
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(PINCODE_INDEX_HEADER.pack(PINCODE_INDEX_MAGIC, 1, len(keys)))
+        f.write(array('i', keys).tobytes())
+        f.write(lats.tobytes())
+        f.write(lons.tobytes())
+    os.replace(tmp_path, out_path)
+    return len(keys)
+
+def load_pincode_directory(path=PINCODE_INDEX_PATH):
+    """Map pincode index at startup (None if not built yet)"""
+    if not os.path.exists(path):
+        print(f"📮 Pincode index not found at {path} - using Nominatim only")
+        return None
+    try:
+        directory = PincodeDirectory(path)
+        print(f"📮 Pincode index loaded: {directory.count} pincodes")
+        return directory
+    except Exception as e:
+        print(f"⚠️ Pincode index error: {e}")
+        return None
+
+pincode_directory = load_pincode_directory()
+
+@app.cli.command('import-pincodes')
+@click.argument('csv_path')
+@click.option('--out', default=PINCODE_INDEX_PATH, help='Output index file')
+def import_pincodes_command(csv_path, out):
+    """Build the local pincode index from an India Post CSV."""
+    start = time.monotonic()
+    count = build_pincode_index(csv_path, out)
+    print(f"✅ {count} pincodes written to {out} in {time.monotonic() - start:.1f}s")
+
+def get_local_coords(pincode):
+    """Coordinates for pincode without any network call"""
+    if pincode in geocode_cache:
+        return geocode_cache[pincode]
+    if pincode_directory:
+        return pincode_directory.lookup(pincode)
+    return None
+
+def geocode_pincode(pincode):
+    """
+    Geocode pincode to (lat, lon) using Nominatim.
+    Returns None if not found, raises UpstreamUnavailable if Nominatim is down.
+    """
+    coords = get_local_coords(pincode)
+    if coords:
+        return coords
+
+    def nominatim_lookup(key, query):
+        def lookup():
+            location = Nominatim(user_agent="sehat_saathi_app_v2").geocode(query, timeout=10)
+            return (location.latitude, location.longitude) if location else None
+        # Rate-limit turn first, so no upstream slot sits idle waiting for it
+        if traffic_replay is None:
+            nominatim_limiter.wait()
+        return nominatim_breaker.call(call_upstream, 'nominatim', key, lookup)
+
+    coords = nominatim_lookup(pincode, pincode + ", India") or nominatim_lookup(f"{pincode} (bare)", pincode)
+    if not coords:
+        return None
+    geocode_cache[pincode] = tuple(coords)
+    return geocode_cache[pincode]
+
 def query_overpass(lat, lon, radius_m=30000, limit=7):
     """
     Query Overpass API to find hospitals, clinics, doctors within radius.
     Returns list of places with name, type, lat, lon, tags.
+    Raises UpstreamUnavailable if Overpass is down or its circuit is open.
     """
     amenity_filter = r"hospital|clinic|doctors|healthcare|dispensary|clinic"
     q = f"""
@@ -532,89 +1915,366 @@ def query_overpass(lat, lon, radius_m=30000, limit=7):
     out center {limit};
     """
     url = "https://overpass-api.de/api/interpreter"
-    try:
+
+    def fetch():
         resp = requests.post(url, data={'data': q}, timeout=30)
-        data = resp.json()
-        places = []
-        for el in data.get('elements', []):
-            # Get center coordinates for ways/relation; nodes have lat/lon
-            if el.get('type') in ('way', 'relation'):
-                c = el.get('center') or {}
-                plat = c.get('lat')
-                plon = c.get('lon')
-            else:
-                plat = el.get('lat')
-                plon = el.get('lon')
-            tags = el.get('tags') or {}
-            name = tags.get('name') or tags.get('operator') or tags.get('healthcare') or 'Unnamed'
-            amenity = tags.get('amenity') or tags.get('shop') or 'clinic'
-            places.append({
-                'name': name,
-                'type': amenity,
-                'latitude': plat,
-                'longitude': plon,
-                'tags': tags
-            })
-        return places
-    except Exception as e:
+        resp.raise_for_status()
+        return resp.json()
+
+    try:
+        data = overpass_breaker.call(call_upstream, 'overpass', q, fetch)
+    except UpstreamUnavailable as e:
         print("Overpass query error:", e)
+        raise
+
+    places = []
+    for el in data.get('elements', []):
+        # Get center coordinates for ways/relation; nodes have lat/lon
+        if el.get('type') in ('way', 'relation'):
+            c = el.get('center') or {}
+            plat = c.get('lat')
+            plon = c.get('lon')
+        else:
+            plat = el.get('lat')
+            plon = el.get('lon')
+        tags = el.get('tags') or {}
+        name = tags.get('name') or tags.get('operator') or tags.get('healthcare') or 'Unnamed'
+        amenity = tags.get('amenity') or tags.get('shop') or 'clinic'
+        places.append({
+            'name': name,
+            'type': amenity,
+            'latitude': plat,
+            'longitude': plon,
+            'tags': tags
+        })
+    return places
+
+def load_local_facilities():
+    """Load locally stored facilities (facilities table, else hospitals.json)"""
+    try:
+        with get_db() as conn:
+            rows = conn.execute('''
+                SELECT name, type, latitude, longitude FROM facilities WHERE latitude IS NOT NULL
+            ''').fetchall()
+        if rows:
+            return [dict(row) for row in rows]
+    except sqlite3.Error:
+        pass  # Table not created yet
+    try:
+        with open('hospitals.json', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ Local facilities not available: {e}")
         return []
 
+def places_to_hospitals(places, user_coords, limit=6):
+    """Convert raw places to hospital dicts sorted by distance"""
+    hospitals = []
+    for p in places:
+        if p.get('latitude') is None or p.get('longitude') is None:
+            continue
+        try:
+            dist = round(geodesic(user_coords, (p['latitude'], p['longitude'])).km, 1)
+        except Exception:
+            dist = None
+        
+        # Create Google Maps link
+        maps_link = f"https://www.google.com/maps/search/?api=1&query={p['latitude']},{p['longitude']}"
+        
+        hospitals.append({
+            'name': p['name'],
+            'type': p['type'],
+            'distance_km': dist if dist else round(random.uniform(1, 10), 1),
+            'maps_link': maps_link
+        })
+
+    # Sort by distance and get top N
+    hospitals = [h for h in hospitals if h['distance_km'] is not None]
+    hospitals.sort(key=lambda x: x['distance_km'])
+    return hospitals[:limit]
+
+def format_hospitals_text(pincode, hospitals, note=None):
+    """Format hospital list as chat message"""
+    response_text = f"🏥 *Real Hospitals near {pincode}:*\n\n"
+    if note:
+        response_text += f"{note}\n\n"
+    for idx, hospital in enumerate(hospitals, 1):
+        response_text += f"{idx}. *{hospital['name']}*\n"
+        response_text += f"   🏷️ {hospital['type'].title()}\n"
+        response_text += f"   📏 {hospital['distance_km']} km away\n"
+        response_text += f"   🗺️ [Open in Maps]({hospital['maps_link']})\n\n"
+    
+    response_text += "💡 *Click map links for exact locations*"
+    return response_text
+
+LOCAL_SEARCH_RADIUS_KM = 30  # same radius as the live Overpass search
+
+def local_hospitals_near(coords):
+    """Saved facilities within LOCAL_SEARCH_RADIUS_KM of coords, nearest first"""
+    nearby = []
+    for place in load_local_facilities():
+        if place.get('latitude') is None or place.get('longitude') is None:
+            continue
+        try:
+            if geodesic(coords, (place['latitude'], place['longitude'])).km <= LOCAL_SEARCH_RADIUS_KM:
+                nearby.append(place)
+        except Exception:
+            continue
+    return places_to_hospitals(nearby, coords)
+
+def get_local_hospitals_nearby(pincode):
+    """Degraded hospital search from cached results or hospitals.json (no network)"""
+    note = "⚠️ Live search is slow right now - showing saved facilities"
+    cached = hospital_cache.get(pincode)
+    if cached:
+        return format_hospitals_text(pincode, cached[0], note), cached[0]
+
+    coords = get_local_coords(pincode)
+    if coords:
+        hospitals = local_hospitals_near(coords)
+        if hospitals:
+            return format_hospitals_text(pincode, hospitals, note), hospitals
+
+    return "⚠️ Hospital search temporarily unavailable. Please call 108 for ambulance or try again shortly.", []
+
+def fetch_hospitals(pincode):
+    """
+    Geocode pincode and fetch nearby hospitals from Overpass, caching the result.
+    Returns None if the pincode can't be located, raises UpstreamUnavailable.
+    """
+    coords = geocode_pincode(pincode)
+    if not coords:
+        return None
+
+    places = query_overpass(coords[0], coords[1], radius_m=30000, limit=15)
+    hospitals = places_to_hospitals(places, coords)
+    if hospitals:
+        hospital_cache[pincode] = (hospitals, time.time())
+    return hospitals
+
 def get_real_hospitals_nearby(pincode):
     """Get real hospitals using Overpass API"""
+    cached = hospital_cache.get(pincode)
+    if cached and time.time() - cached[1] < HOSPITAL_CACHE_TTL:
+        return format_hospitals_text(pincode, cached[0]), cached[0]
+
     try:
-        geolocator = Nominatim(user_agent="sehat_saathi_app_v2")
-        location = geolocator.geocode(pincode + ", India", timeout=10)
-        if not location:
-            location = geolocator.geocode(pincode, timeout=10)
-        if not location:
+        hospitals = fetch_hospitals(pincode)
+        if hospitals is None:
             return "❌ Location not found. Please check pincode.", []
-
-        places = query_overpass(location.latitude, location.longitude, radius_m=30000, limit=15)
-        user_coords = (location.latitude, location.longitude)
-        
-        hospitals = []
-        for p in places:
-            if p['latitude'] is None or p['longitude'] is None:
-                continue
-            try:
-                dist = round(geodesic(user_coords, (p['latitude'], p['longitude'])).km, 1)
-            except Exception:
-                dist = None
-            
-            # Create Google Maps link
-            maps_link = f"https://www.google.com/maps/search/?api=1&query={p['latitude']},{p['longitude']}"
-            
-            hospitals.append({
-                'name': p['name'],
-                'type': p['type'],
-                'distance_km': dist if dist else round(random.uniform(1, 10), 1),
-                'maps_link': maps_link
-            })
-
-        # Sort by distance and get top 6
-        hospitals = [h for h in hospitals if h['distance_km'] is not None]
-        hospitals.sort(key=lambda x: x['distance_km'])
-        hospitals = hospitals[:6]
         
         if not hospitals:
             return "❌ No hospitals found nearby. Try another pincode.", []
 
-        # Format response
-        response_text = f"🏥 *Real Hospitals near {pincode}:*\n\n"
-        for idx, hospital in enumerate(hospitals, 1):
-            response_text += f"{idx}. *{hospital['name']}*\n"
-            response_text += f"   🏷️ {hospital['type'].title()}\n"
-            response_text += f"   📏 {hospital['distance_km']} km away\n"
-            response_text += f"   🗺️ [Open in Maps]({hospital['maps_link']})\n\n"
-        
-        response_text += "💡 *Click map links for exact locations*"
-        return response_text, hospitals
+        return format_hospitals_text(pincode, hospitals), hospitals
+
+    except UpstreamUnavailable as e:
+        print(f"⚠️ Hospital search degraded for {pincode}: {e}")
+        return get_local_hospitals_nearby(pincode)
         
     except Exception as e:
         print(f"Hospital search error: {e}")
         return "⚠️ Error searching hospitals. Please try again.", []
 
+# ==================== HOSPITAL CACHE WARMER ====================
+
+CACHE_WARM_INTERVAL = int(os.getenv("CACHE_WARM_INTERVAL", "3600"))
+CACHE_WARM_TOP_PINCODES = int(os.getenv("CACHE_WARM_TOP_PINCODES", "300"))
+# Max upstream (Nominatim + Overpass) requests per warm run
+CACHE_WARM_REQUEST_BUDGET = int(os.getenv("CACHE_WARM_REQUEST_BUDGET", "120"))
+# Pause between pincodes to stay polite with public APIs
+CACHE_WARM_DELAY = float(os.getenv("CACHE_WARM_DELAY", "1.0"))
+cache_warmer_stats = {'last_run': None, 'warmed': 0, 'skipped_fresh': 0, 'requests': 0, 'stopped': None}
+cache_warmer_started = False
+cache_warmer_lock = threading.Lock()
+
+def get_popular_pincodes(limit=CACHE_WARM_TOP_PINCODES):
+    """Most frequent pincodes from appointments and emergency contacts"""
+    with get_read_db() as conn:
+        rows = conn.execute('''
+            SELECT pincode, COUNT(*) AS hits FROM (
+                SELECT pincode FROM appointments
+                UNION ALL
+                SELECT pincode FROM emergency_contacts
+            )
+            WHERE length(pincode) = 6
+            GROUP BY pincode
+            ORDER BY hits DESC
+            LIMIT ?
+        ''', (limit,)).fetchall()
+    return [str(row['pincode']) for row in rows if str(row['pincode']).isdigit()]
+
+def needs_warming(pincode, now):
+    """True if pincode is missing from cache or will expire before the next run"""
+    cached = hospital_cache.get(pincode)
+    return not cached or now - cached[1] > HOSPITAL_CACHE_TTL - 2 * CACHE_WARM_INTERVAL
+
+def warm_hospital_cache(limit=CACHE_WARM_TOP_PINCODES, budget=CACHE_WARM_REQUEST_BUDGET):
+    """Pre-fetch facility lists for popular pincodes within the request budget"""
+    stats = {'last_run': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'warmed': 0, 'skipped_fresh': 0, 'requests': 0, 'stopped': None}
+    for pincode in get_popular_pincodes(limit):
+        if not needs_warming(pincode, time.time()):
+            stats['skipped_fresh'] += 1
+            continue
+
+        cost = 1 if get_local_coords(pincode) else 2
+        if stats['requests'] + cost > budget:
+            stats['stopped'] = 'request budget used up'
+            break
+
+        try:
+            stats['requests'] += cost
+            if fetch_hospitals(pincode):
+                stats['warmed'] += 1
+        except UpstreamUnavailable as e:
+            stats['stopped'] = str(e)
+            break
+        except Exception as e:
+            print(f"❌ Cache warm error for {pincode}: {e}")
+        time.sleep(CACHE_WARM_DELAY)
+
+    cache_warmer_stats.update(stats)
+    print(f"🔥 Hospital cache warmed: {stats['warmed']} pincodes, {stats['requests']} upstream requests"
+          + (f" (stopped: {stats['stopped']})" if stats['stopped'] else ""))
+    return stats
+
+def cache_warmer():
+    """Background loop refreshing popular pincodes before their TTL runs out"""
+    request_lane.set('routine')
+    while True:
+        try:
+            warm_hospital_cache()
+        except Exception as e:
+            print(f"❌ Cache warmer error: {e}")
+        time.sleep(CACHE_WARM_INTERVAL)
+
+def start_cache_warmer():
+    """Start cache warmer thread once per process"""
+    global cache_warmer_started
+    with cache_warmer_lock:
+        if cache_warmer_started or CACHE_WARM_REQUEST_BUDGET <= 0:
+            return
+        threading.Thread(target=cache_warmer, name="cache-warmer", daemon=True).start()
+        cache_warmer_started = True
+
+# ==================== BATCH FACILITY LOOKUP ====================
+
+FACILITY_BATCH_MAX = int(os.getenv("FACILITY_BATCH_MAX", "100"))
+FACILITY_BATCH_WORKERS = int(os.getenv("FACILITY_BATCH_WORKERS", "4"))
+FACILITY_RADIUS_M = 30000
+# Pincodes whose coordinates fall in the same tile share one Overpass query
+FACILITY_TILE_DEG = float(os.getenv("FACILITY_TILE_DEG", "0.1"))
+FACILITY_TILE_LIMIT = 40
+# Nominatim geocodes per batch (1 req/s, routine lane) - load `flask import-pincodes` for the rest
+FACILITY_BATCH_GEOCODE_MAX = int(os.getenv("FACILITY_BATCH_GEOCODE_MAX", "5"))
+# Shared by all batch calls, so concurrent batches can't multiply upstream load
+facility_executor = ThreadPoolExecutor(max_workers=FACILITY_BATCH_WORKERS, thread_name_prefix="facility")
+
+def facility_tile(coords):
+    """Grid tile containing coords: (key, center)"""
+    key = (round(coords[0] / FACILITY_TILE_DEG), round(coords[1] / FACILITY_TILE_DEG))
+    return key, (round(key[0] * FACILITY_TILE_DEG, 4), round(key[1] * FACILITY_TILE_DEG, 4))
+
+def fetch_tile_places(center):
+    """Facilities around a tile center, radius widened so every pincode in the tile keeps its 30km circle"""
+    half_diagonal_m = geodesic(center, (center[0] + FACILITY_TILE_DEG / 2, center[1] + FACILITY_TILE_DEG / 2)).m
+    return query_overpass(center[0], center[1], radius_m=int(FACILITY_RADIUS_M + half_diagonal_m),
+                          limit=FACILITY_TILE_LIMIT)
+
+def degraded_facilities(pincode, error):
+    """Saved facilities when the live lookup failed (same fallback as the chat)"""
+    cached = hospital_cache.get(pincode)
+    if cached:
+        return {'status': 'degraded', 'source': 'stale_cache', 'facilities': cached[0], 'error': error}
+    coords = get_local_coords(pincode)
+    if coords:
+        hospitals = local_hospitals_near(coords)
+        if hospitals:
+            return {'status': 'degraded', 'source': 'local', 'facilities': hospitals, 'error': error}
+    return {'status': 'error', 'error': error}
+
+def lookup_facilities_batch(pincodes):
+    """
+    Nearby facilities for many pincodes. Coordinates come from the local
+    pincode directory (`flask import-pincodes`); at most FACILITY_BATCH_GEOCODE_MAX
+    others are geocoded through the Nominatim rate limit, the rest come back
+    'unresolved'. Pincodes in the same tile share one Overpass query, run on
+    facility_executor. Returns (results per unique pincode, summary).
+    """
+    start = time.monotonic()
+    now = time.time()
+    unique = list(dict.fromkeys(pincodes))
+    results = {}
+    summary = {'requested': len(pincodes), 'unique': len(unique), 'cached': 0}
+
+    to_locate = []
+    for pincode in unique:
+        if len(pincode) != 6 or not pincode.isdigit():
+            results[pincode] = {'status': 'invalid', 'error': 'Pincode must be 6 digits'}
+            continue
+        cached = hospital_cache.get(pincode)
+        if cached and now - cached[1] < HOSPITAL_CACHE_TTL:
+            results[pincode] = {'status': 'ok', 'source': 'cache', 'facilities': cached[0]}
+            summary['cached'] += 1
+        else:
+            to_locate.append(pincode)
+
+    # 1. Coordinates - local directory first, a few Nominatim lookups (routine lane) for the rest
+    coords = {}
+    summary['geocode_requests'] = 0
+    lane_token = request_lane.set('routine')
+    try:
+        for pincode in to_locate:
+            found = get_local_coords(pincode)
+            if not found:
+                if summary['geocode_requests'] >= FACILITY_BATCH_GEOCODE_MAX:
+                    results[pincode] = {'status': 'unresolved',
+                                        'error': 'Not in the local pincode directory - retry later or load it with flask import-pincodes'}
+                    continue
+                summary['geocode_requests'] += 1
+                try:
+                    found = geocode_pincode(pincode)
+                except UpstreamUnavailable as e:
+                    results[pincode] = degraded_facilities(pincode, str(e))
+                    continue
+                if not found:
+                    results[pincode] = {'status': 'not_found', 'error': 'Location not found'}
+                    continue
+            coords[pincode] = found
+    finally:
+        request_lane.reset(lane_token)
+
+    # 2. One Overpass query per tile
+    tiles = {}
+    for pincode, point in coords.items():
+        key, center = facility_tile(point)
+        tiles.setdefault(key, (center, []))[1].append(pincode)
+    summary['overpass_requests'] = len(tiles)
+    futures = {facility_executor.submit(fetch_tile_places, center): members for center, members in tiles.values()}
+    for future, members in futures.items():
+        try:
+            places = future.result()
+        except Exception as e:
+            for pincode in members:
+                results[pincode] = degraded_facilities(pincode, str(e))
+            continue
+        for pincode in members:
+            hospitals = [h for h in places_to_hospitals(places, coords[pincode], limit=len(places))
+                         if h['distance_km'] <= FACILITY_RADIUS_M / 1000][:6]
+            if hospitals:
+                hospital_cache[pincode] = (hospitals, time.time())
+                results[pincode] = {'status': 'ok', 'source': 'live', 'facilities': hospitals}
+            else:
+                results[pincode] = {'status': 'not_found', 'error': 'No facilities found nearby'}
+
+    ordered = [dict(pincode=pincode, **results[pincode]) for pincode in unique]
+    for status in ('ok', 'degraded', 'not_found', 'unresolved', 'invalid', 'error'):
+        summary[status] = sum(1 for result in ordered if result['status'] == status)
+    summary['elapsed_ms'] = round((time.monotonic() - start) * 1000, 1)
+    print(f"🏥 Batch facility lookup: {summary['unique']} pincodes, {summary['cached']} cached, "
+          f"{summary['geocode_requests']} geocode + {summary['overpass_requests']} Overpass requests")
+    return ordered, summary
+
 # ==================== EMERGENCY FUNCTIONS ====================
 
 def get_emergency_contacts():
@@ -653,6 +2313,1477 @@ def get_emergency_instructions(emergency_type):
     }
     return instructions.get(emergency_type, [])
 
+# ==================== LOCAL TRIAGE ====================
+
+TRIAGE_MODEL_PATH = os.getenv("TRIAGE_MODEL_PATH", "data/triage_model.json")
+TRIAGE_LABELS = ('low', 'medium', 'high')
+TRIAGE_NGRAM_SIZES = (3, 4, 5)
+TRIAGE_BUCKETS = 2 ** 18
+TRIAGE_BIAS = -1
+
+# Red-flag rules live in triage_rules.py so they can be tested without Flask
+
+class TriageClassifier:
+    """
+    Averaged perceptron over hashed character n-grams. Scoring a message
+    is a few hundred dict lookups, so it runs far below a millisecond.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights or {label: {} for label in TRIAGE_LABELS}
+
+    @staticmethod
+    def features(text):
+        text = f" {' '.join(text.lower().split())} "
+        features = {TRIAGE_BIAS}
+        for n in TRIAGE_NGRAM_SIZES:
+            for i in range(len(text) - n + 1):
+                features.add(zlib.crc32(text[i:i + n].encode('utf-8')) % TRIAGE_BUCKETS)
+        return features
+
+    def scores(self, features):
+        return {label: sum(weights.get(f, 0.0) for f in features) for label, weights in self.weights.items()}
+
+    def predict(self, text):
+        scores = self.scores(self.features(text))
+        return max(TRIAGE_LABELS, key=lambda label: scores[label])
+
+    def train(self, examples, epochs=10, seed=42):
+        """Train on (text, label) pairs"""
+        data = [(self.features(text), label) for text, label in examples if label in TRIAGE_LABELS]
+        weights = {label: {} for label in TRIAGE_LABELS}
+        totals = {label: {} for label in TRIAGE_LABELS}
+        stamps = {label: {} for label in TRIAGE_LABELS}
+        step = 1
+
+        def update(label, feature, value):
+            w = weights[label].get(feature, 0.0)
+            totals[label][feature] = totals[label].get(feature, 0.0) + (step - stamps[label].get(feature, 0)) * w
+            stamps[label][feature] = step
+            weights[label][feature] = w + value
+
+        rng = random.Random(seed)
+        for _ in range(epochs):
+            rng.shuffle(data)
+            for features, label in data:
+                scores = {lbl: sum(weights[lbl].get(f, 0.0) for f in features) for lbl in TRIAGE_LABELS}
+                guess = max(TRIAGE_LABELS, key=lambda lbl: scores[lbl])
+                if guess != label:
+                    for feature in features:
+                        update(label, feature, 1.0)
+                        update(guess, feature, -1.0)
+                step += 1
+
+        # Average weights over all steps, dropping ones that cancelled out
+        self.weights = {label: {} for label in TRIAGE_LABELS}
+        for label in TRIAGE_LABELS:
+            for feature, w in weights[label].items():
+                total = totals[label].get(feature, 0.0) + (step - stamps[label].get(feature, 0)) * w
+                average = round(total / step, 4)
+                if average:
+                    self.weights[label][feature] = average
+        return len(data)
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'ngram_sizes': TRIAGE_NGRAM_SIZES, 'buckets': TRIAGE_BUCKETS, 'weights': self.weights}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if tuple(data['ngram_sizes']) != TRIAGE_NGRAM_SIZES or data['buckets'] != TRIAGE_BUCKETS:
+            raise ValueError("triage model was trained with different features - retrain it")
+        return cls({label: {int(k): v for k, v in weights.items()} for label, weights in data['weights'].items()})
+
+def load_triage_model(path=TRIAGE_MODEL_PATH):
+    """Load trained triage model if present"""
+    if not os.path.exists(path):
+        print(f"🩺 Triage model not found at {path} - using red-flag rules only")
+        return None
+    try:
+        classifier = TriageClassifier.load(path)
+        print(f"🩺 Triage model loaded from {path}")
+        return classifier
+    except Exception as e:
+        print(f"⚠️ Triage model error: {e}")
+        return None
+
+triage_model = load_triage_model()
+
+def triage_severity(text, classifier=None):
+    """
+    Severity for a health message: (severity, emergency_type).
+    Red-flag rules win; otherwise the model decides ('low' without a model).
+    """
+    emergency_type = find_red_flag(text)
+    if emergency_type:
+        return 'high', emergency_type
+    classifier = classifier or triage_model
+    if classifier:
+        return classifier.predict(text), None
+    return 'low', None
+
+def load_triage_examples(labels_path):
+    """
+    Hand-labeled (text, severity) pairs from a JSONL file. health_queries.severity
+    is not used - it was written by triage_severity itself (or defaulted to 'low').
+    """
+    examples = []
+    with open(labels_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                examples.append((record['text'], record['severity']))
+    return examples
+
+@app.cli.command('train-triage')
+@click.option('--labels', required=True, help='Hand-labeled JSONL file of {"text": ..., "severity": ...}')
+@click.option('--epochs', default=10, help='Training passes')
+@click.option('--out', default=TRIAGE_MODEL_PATH, help='Output model file')
+def train_triage_command(labels, epochs, out):
+    """Train the local triage classifier from hand-labeled messages."""
+    examples = load_triage_examples(labels)
+    classifier = TriageClassifier()
+    count = classifier.train(examples, epochs=epochs)
+    classifier.save(out)
+    print(f"✅ Triage model trained on {count} examples, saved to {out}")
+
+# ==================== PRESCRIPTION UPLOADS ====================
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (256, 256)
+PRESCRIPTION_WORKERS = int(os.getenv("PRESCRIPTION_WORKERS", "2"))
+prescription_executor = ThreadPoolExecutor(max_workers=PRESCRIPTION_WORKERS, thread_name_prefix="prescription")
+prescription_worker_slots = threading.BoundedSemaphore(PRESCRIPTION_WORKERS)
+PRESCRIPTION_LEASE_SECONDS = int(os.getenv("PRESCRIPTION_LEASE_SECONDS", "300"))  # 'processing' rows older than this are retried
+
+class UploadRejected(Exception):
+    """Upload failed validation (size or file type)"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def detect_image_type(header):
+    """Detect image type from magic bytes, returns (extension, mime_type)"""
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpg', 'image/jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png', 'image/png'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp', 'image/webp'
+    return None, None
+
+def stream_upload_to_disk(stream, max_bytes):
+    """
+    Copy upload stream to a temp file in chunks while hashing it.
+    Returns (tmp_path, md5 hex, size, first bytes).
+    """
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    digest = hashlib.md5()
+    size = 0
+    header = b''
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadRejected(f"File too large! Max {max_bytes // (1024 * 1024)}MB", 413)
+                if len(header) < 16:
+                    header += chunk[:16 - len(header)]
+                digest.update(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size, header
+
+def save_prescription_upload(stream, session_id=None):
+    """Store uploaded prescription image, deduplicated by content hash"""
+    tmp_path, file_hash, size, header = stream_upload_to_disk(stream, app.config['MAX_PRESCRIPTION_BYTES'])
+    try:
+        if size == 0:
+            raise UploadRejected("Empty file")
+        extension, mime_type = detect_image_type(header)
+        if not extension:
+            raise UploadRejected("Only JPG, PNG or WEBP images are allowed")
+
+        existing = get_prescription_by_hash(file_hash)
+        if existing:
+            return existing['id'], True
+
+        # Files are named by content hash, so an identical image may already be on disk
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_hash}.{extension}")
+        if not os.path.exists(file_path):
+            os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    prescription_id, duplicate = create_prescription(file_hash, file_path, mime_type, size, session_id)
+    if not duplicate:
+        schedule_prescription_processing()
+    return prescription_id, duplicate
+
+def process_prescription(prescription):
+    """Extract image metadata and create thumbnail"""
+    width = height = thumbnail_path = taken_at = None
+    if PIL_AVAILABLE:
+        with Image.open(prescription['file_path']) as img:
+            width, height = img.size
+            exif_datetime = img.getexif().get(306)  # EXIF DateTime tag
+            if exif_datetime:
+                taken_at = str(exif_datetime).replace(':', '-', 2)[:16]
+            thumb_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'thumbs')
+            os.makedirs(thumb_dir, exist_ok=True)
+            thumbnail_path = os.path.join(thumb_dir, f"{prescription['file_hash']}.jpg")
+            img.thumbnail(THUMBNAIL_SIZE)
+            img.convert('RGB').save(thumbnail_path, 'JPEG', quality=80)
+
+    with get_db() as conn:
+        conn.execute('''
+            UPDATE prescriptions
+            SET width = ?, height = ?, thumbnail_path = ?, processing_status = 'processed',
+                prescription_date = COALESCE(prescription_date, ?)
+            WHERE id = ?
+        ''', (width, height, thumbnail_path, taken_at, prescription['id']))
+        conn.commit()
+
+# Pending rows, and 'processing' rows whose worker died (lease expired)
+CLAIMABLE_PRESCRIPTION = '''
+    (processing_status = 'pending' OR (processing_status = 'processing'
+     AND (processing_started_at IS NULL OR processing_started_at < ?)))
+'''
+
+def claim_pending_prescription():
+    """Mark the oldest claimable prescription as processing and return it"""
+    with get_db() as conn:
+        while True:
+            now = time.time()
+            row = conn.execute(f'''
+                SELECT * FROM prescriptions WHERE {CLAIMABLE_PRESCRIPTION} ORDER BY id LIMIT 1
+            ''', (now - PRESCRIPTION_LEASE_SECONDS,)).fetchone()
+            if not row:
+                return None
+            cursor = conn.execute(f'''
+                UPDATE prescriptions SET processing_status = 'processing', processing_started_at = ?
+                WHERE id = ? AND {CLAIMABLE_PRESCRIPTION}
+            ''', (now, row['id'], now - PRESCRIPTION_LEASE_SECONDS))
+            conn.commit()
+            if cursor.rowcount:
+                return row
+
+def has_claimable_prescription():
+    """True if a prescription is waiting for a worker"""
+    with get_db() as conn:
+        return conn.execute(f'SELECT 1 FROM prescriptions WHERE {CLAIMABLE_PRESCRIPTION} LIMIT 1',
+                            (time.time() - PRESCRIPTION_LEASE_SECONDS,)).fetchone() is not None
+
+def prescription_worker():
+    """Drain pending prescriptions from the table"""
+    try:
+        while True:
+            prescription = claim_pending_prescription()
+            if not prescription:
+                break
+            try:
+                process_prescription(prescription)
+                print(f"🖼️ Prescription {prescription['id']} processed")
+            except Exception as e:
+                print(f"❌ Prescription {prescription['id']} processing error: {e}")
+                with get_db() as conn:
+                    conn.execute('UPDATE prescriptions SET processing_status = ? WHERE id = ?',
+                                 ('failed', prescription['id']))
+                    conn.commit()
+    finally:
+        prescription_worker_slots.release()
+    # An upload that arrived after our last claim found no free slot - pick it up
+    try:
+        if has_claimable_prescription():
+            schedule_prescription_processing()
+    except sqlite3.Error as e:
+        print(f"❌ Prescription queue check error: {e}")
+
+def schedule_prescription_processing():
+    """Start a worker if the pool has room - busy workers pick up new rows themselves"""
+    if prescription_worker_slots.acquire(blocking=False):
+        prescription_executor.submit(prescription_worker)
+
+# ==================== VOICE MESSAGES ====================
+
+VOICE_MAX_BYTES = int(os.getenv("VOICE_MAX_BYTES", str(5 * 1024 * 1024)))
+VOICE_WORKERS = int(os.getenv("VOICE_WORKERS", "2"))
+VOICE_QUEUE_LIMIT = int(os.getenv("VOICE_QUEUE_LIMIT", "8"))
+VOICE_TIMEOUT = int(os.getenv("VOICE_TIMEOUT", "60"))
+voice_slots = threading.BoundedSemaphore(VOICE_QUEUE_LIMIT)
+# Threads, not processes - ffmpeg already runs as its own process and the
+# transcription is a network call on the shared Gemini client
+voice_executor = ThreadPoolExecutor(max_workers=VOICE_WORKERS, thread_name_prefix="voice")
+voice_stage_timings = {stage: deque(maxlen=200) for stage in ('receive_ms', 'transcode_ms', 'transcribe_ms', 'chat_ms', 'total_ms')}
+
+class Transcriber:
+    """Speech-to-text backend. Runs on the voice worker threads."""
+
+    def transcribe(self, audio_bytes, mime_type):
+        raise NotImplementedError
+
+class StubTranscriber(Transcriber):
+    """Local transcriber for tests/offline - returns a fixed transcript"""
+
+    def transcribe(self, audio_bytes, mime_type):
+        return os.getenv("STUB_TRANSCRIPT", "hi")
+
+class GeminiTranscriber(Transcriber):
+    """Transcribe voice notes with Gemini audio input"""
+
+    def transcribe(self, audio_bytes, mime_type):
+        response = model.generate_content([
+            "Transcribe this voice message exactly as spoken (Hindi/English). Reply with only the transcript.",
+            {'mime_type': mime_type, 'data': audio_bytes}
+        ])
+        return response.text.strip()
+
+TRANSCRIBERS = {
+    'stub': StubTranscriber,
+    'gemini': GeminiTranscriber
+}
+VOICE_TRANSCRIBER = os.getenv("VOICE_TRANSCRIBER", 'gemini' if GEMINI_AVAILABLE else 'stub')
+
+def transcode_audio(audio_bytes, mime_type):
+    """Convert audio to 16kHz mono WAV with ffmpeg over pipes (no temp files)"""
+    if not shutil.which('ffmpeg'):
+        return audio_bytes, mime_type
+    result = subprocess.run(
+        ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+         '-ac', '1', '-ar', '16000', '-f', 'wav', 'pipe:1'],
+        input=audio_bytes, capture_output=True, timeout=30
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='ignore')[:200]}")
+    return result.stdout, 'audio/wav'
+
+def run_voice_job(audio_bytes, mime_type, transcriber_name):
+    """Transcode and transcribe one voice note (runs on a voice worker thread)"""
+    start = time.monotonic()
+    audio_bytes, mime_type = transcode_audio(audio_bytes, mime_type)
+    transcoded = time.monotonic()
+    transcript = TRANSCRIBERS[transcriber_name]().transcribe(audio_bytes, mime_type)
+    timings = {
+        'transcode_ms': round((transcoded - start) * 1000, 1),
+        'transcribe_ms': round((time.monotonic() - transcoded) * 1000, 1)
+    }
+    return transcript, timings
+
+def read_voice_upload(stream, max_bytes):
+    """Read one request's audio into its own in-memory buffer"""
+    buffer = io.BytesIO()
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        if buffer.tell() + len(chunk) > max_bytes:
+            raise UploadRejected(f"Voice note too large! Max {max_bytes // (1024 * 1024)}MB", 413)
+        buffer.write(chunk)
+    return buffer.getvalue()
+
+def transcribe_voice_message(audio_bytes, mime_type):
+    """Run voice job on the bounded voice pool, returns (transcript, timings)"""
+    if not voice_slots.acquire(blocking=False):
+        raise UploadRejected("Voice service busy. Please type your message.", 503)
+    try:
+        future = voice_executor.submit(run_voice_job, audio_bytes, mime_type, VOICE_TRANSCRIBER)
+        return future.result(timeout=VOICE_TIMEOUT)
+    finally:
+        voice_slots.release()
+
+def record_voice_timings(timings):
+    """Keep recent per-stage timings for /health"""
+    for stage, value in timings.items():
+        if stage in voice_stage_timings:
+            voice_stage_timings[stage].append(value)
+
+def get_voice_timing_summary():
+    """Average and p95 per voice stage"""
+    summary = {}
+    for stage, values in voice_stage_timings.items():
+        if values:
+            ordered = sorted(values)
+            summary[stage] = {
+                'avg': round(sum(ordered) / len(ordered), 1),
+                'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            }
+    return summary
+
+# ==================== WHATSAPP INBOUND QUEUE ====================
+
+WHATSAPP_WORKERS = int(os.getenv("WHATSAPP_WORKERS", "4"))
+WHATSAPP_MAX_ATTEMPTS = 3
+WHATSAPP_LEASE_SECONDS = int(os.getenv("WHATSAPP_LEASE_SECONDS", "300"))  # 'processing' rows older than this are retried
+WHATSAPP_SEND_ATTEMPTS = 4
+WHATSAPP_SEND_RETRY_BASE = 1       # seconds, doubled after every failed send
+whatsapp_wakeup = threading.Condition()
+whatsapp_workers_started = False
+whatsapp_workers_lock = threading.Lock()
+
+def enqueue_whatsapp_message(provider_message_id, sender, body):
+    """Persist inbound message, returns False if this message ID was already received"""
+    with get_db() as conn:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO whatsapp_inbox (provider_message_id, sender, body)
+            VALUES (?, ?, ?)
+        ''', (provider_message_id, sender, body))
+        conn.commit()
+        is_new = cursor.rowcount == 1
+    if is_new:
+        with whatsapp_wakeup:
+            whatsapp_wakeup.notify()
+    return is_new
+
+def claim_whatsapp_message():
+    """
+    Claim the next message to process. Only the oldest pending message of a
+    sender is eligible, and only if none of that sender's messages is in progress,
+    so replies keep per-sender order. Claims older than the lease (worker died)
+    go back to pending first.
+    """
+    now = time.time()
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('''
+            UPDATE whatsapp_inbox SET status = 'pending'
+            WHERE status = 'processing' AND (claimed_at IS NULL OR claimed_at < ?)
+        ''', (now - WHATSAPP_LEASE_SECONDS,))
+        row = conn.execute('''
+            SELECT m.* FROM whatsapp_inbox m
+            WHERE m.status = 'pending'
+              AND m.id = (SELECT MIN(o.id) FROM whatsapp_inbox o WHERE o.sender = m.sender AND o.status = 'pending')
+              AND NOT EXISTS (SELECT 1 FROM whatsapp_inbox p WHERE p.sender = m.sender AND p.status = 'processing')
+            ORDER BY m.id LIMIT 1
+        ''').fetchone()
+        if row:
+            conn.execute('''
+                UPDATE whatsapp_inbox SET status = 'processing', attempts = attempts + 1, claimed_at = ? WHERE id = ?
+            ''', (now, row['id']))
+        conn.commit()
+        return row
+
+def save_whatsapp_reply(message_id, reply):
+    """Store the reply on the row before sending, so a failed send never re-runs the turn"""
+    with get_db() as conn:
+        conn.execute('UPDATE whatsapp_inbox SET reply = ? WHERE id = ?', (reply, message_id))
+        conn.commit()
+
+def finish_whatsapp_message(message_id, status):
+    """Mark queued message as done/failed, or back to pending for retry"""
+    with get_db() as conn:
+        conn.execute('''
+            UPDATE whatsapp_inbox SET status = ?, processed_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (status, message_id))
+        conn.commit()
+
+def send_whatsapp_reply(to_number, reply):
+    """Send with exponential backoff, returns False once every attempt failed"""
+    for attempt in range(WHATSAPP_SEND_ATTEMPTS):
+        try:
+            send_whatsapp_message(to_number, reply)
+            return True
+        except Exception as e:
+            print(f"⚠️ WhatsApp send to {to_number} failed (attempt {attempt + 1}/{WHATSAPP_SEND_ATTEMPTS}): {e}")
+            if attempt + 1 < WHATSAPP_SEND_ATTEMPTS:
+                time.sleep(WHATSAPP_SEND_RETRY_BASE * 2 ** attempt)
+    return False
+
+def handle_whatsapp_message(message):
+    """Run queued message through the chat state machine and send the reply"""
+    reply = message['reply']
+    if reply is None:
+        user_message = (message['body'] or '').strip().lower()
+        if not user_message:
+            finish_whatsapp_message(message['id'], 'done')
+            return
+        # Bookings made over WhatsApp get confirmations on the same number
+        get_chat_session(message['sender']).patient_phone = message['sender']
+        reply = process_chat_message(message['sender'], user_message)
+        save_whatsapp_reply(message['id'], reply)
+    # A stored reply means the turn already ran - only the send is retried
+    sent = send_whatsapp_reply(message['sender'], reply)
+    finish_whatsapp_message(message['id'], 'done' if sent else 'failed')
+
+def whatsapp_worker():
+    """Process queued WhatsApp messages forever"""
+    while True:
+        try:
+            message = claim_whatsapp_message()
+        except Exception as e:
+            print(f"❌ WhatsApp queue error: {e}")
+            message = None
+        if not message:
+            with whatsapp_wakeup:
+                whatsapp_wakeup.wait(timeout=1)
+            continue
+        try:
+            handle_whatsapp_message(message)
+        except Exception as e:
+            print(f"❌ WhatsApp message {message['provider_message_id']} error: {e}")
+            retry = message['attempts'] + 1 < WHATSAPP_MAX_ATTEMPTS
+            finish_whatsapp_message(message['id'], 'pending' if retry else 'failed')
+
+def start_whatsapp_workers():
+    """Start worker threads once per process"""
+    global whatsapp_workers_started
+    with whatsapp_workers_lock:
+        if whatsapp_workers_started:
+            return
+        # Messages left 'processing' by a dead worker are reclaimed by
+        # claim_whatsapp_message once their lease runs out
+        for i in range(WHATSAPP_WORKERS):
+            threading.Thread(target=whatsapp_worker, name=f"whatsapp-{i}", daemon=True).start()
+        whatsapp_workers_started = True
+        print(f"📱 WhatsApp workers started: {WHATSAPP_WORKERS}")
+
+# ==================== OUTBOUND NOTIFICATIONS ====================
+
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", "20"))
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_BASE = 30       # seconds, doubled on every failed attempt
+NOTIFICATION_RETRY_MAX = 3600
+NOTIFICATION_LEASE_SECONDS = int(os.getenv("NOTIFICATION_LEASE_SECONDS", "600"))  # 'sending' rows older than this are retried
+NOTIFICATION_RATE_LIMIT = int(os.getenv("NOTIFICATION_RATE_LIMIT", "5"))  # messages per recipient per minute
+EMERGENCY_ALERT_NUMBER = os.getenv("EMERGENCY_ALERT_NUMBER")
+notification_wakeup = threading.Event()
+notification_dispatcher_started = False
+notification_dispatcher_lock = threading.Lock()
+recipient_send_times = {}
+
+class NotificationTransport:
+    """Delivery backend for outbound notifications"""
+
+    def send_batch(self, notifications):
+        """Send notifications, returns {id: error or None}"""
+        raise NotImplementedError
+
+class WhatsAppTransport(NotificationTransport):
+    """Send through WhatsApp (simulated when Twilio is disabled)"""
+
+    def send_batch(self, notifications):
+        results = {}
+        for notification in notifications:
+            try:
+                send_whatsapp_message(notification['recipient'], notification['message'])
+                results[notification['id']] = None
+            except Exception as e:
+                results[notification['id']] = str(e)
+        return results
+
+class StubTransport(NotificationTransport):
+    """Local transport for tests - keeps sent messages in memory"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_batch(self, notifications):
+        self.sent.extend((n['recipient'], n['message']) for n in notifications)
+        return {n['id']: None for n in notifications}
+
+NOTIFICATION_TRANSPORTS = {
+    'whatsapp': WhatsAppTransport,
+    'stub': StubTransport
+}
+notification_transport = NOTIFICATION_TRANSPORTS[os.getenv("NOTIFICATION_TRANSPORT", "whatsapp")]()
+
+def is_reachable_number(recipient):
+    """Placeholder phones like 'web_user' have no delivery address"""
+    number = (recipient or '').replace('whatsapp:', '').replace('+', '').replace(' ', '')
+    return number.isdigit() and len(number) >= 10
+
+def enqueue_notification(recipient, message, kind=None):
+    """Queue outbound message - never blocks on delivery"""
+    if not is_reachable_number(recipient):
+        return None
+    try:
+        with db_write_slot(), get_db() as conn:
+            cursor = conn.execute('''
+                INSERT INTO notifications (recipient, message, kind, next_attempt_at)
+                VALUES (?, ?, ?, ?)
+            ''', (recipient, message, kind, time.time()))
+            conn.commit()
+        start_notification_dispatcher()
+        notification_wakeup.set()
+        return cursor.lastrowid
+    except Exception as e:
+        print(f"❌ Notification enqueue error: {e}")
+        return None
+
+def enqueue_notifications(notifications):
+    """Queue many (recipient, message, kind) notifications with one insert"""
+    rows = [(recipient, message, kind, time.time())
+            for recipient, message, kind in notifications if is_reachable_number(recipient)]
+    if not rows:
+        return 0
+    try:
+        with get_db() as conn:
+            conn.executemany('''
+                INSERT INTO notifications (recipient, message, kind, next_attempt_at)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+        start_notification_dispatcher()
+        notification_wakeup.set()
+        return len(rows)
+    except Exception as e:
+        print(f"❌ Notification enqueue error: {e}")
+        return 0
+
+def appointment_status_notification(appointment):
+    """(recipient, message, kind) for a confirmed/rejected appointment"""
+    if appointment['status'] == 'confirmed':
+        message = (f"✅ Sehat Saathi: Appointment {appointment['id']} at {appointment['hospital_name']} "
+                   f"on {appointment['slot']} is CONFIRMED.")
+    else:
+        message = (f"❌ Sehat Saathi: Appointment {appointment['id']} at {appointment['hospital_name']} "
+                   f"could not be confirmed. Please book another slot.")
+    return appointment['phone'], message, f"appointment_{appointment['status']}"
+
+def notify_appointment_status(appointment_id):
+    """Tell patient their appointment was confirmed or rejected"""
+    appointment = get_appointment(appointment_id)
+    if appointment:
+        enqueue_notification(*appointment_status_notification(appointment))
+
+def notify_emergency_booking(appointment_id, patient_name, patient_phone, hospital_name, pincode):
+    """Emergency booking alerts for patient and emergency desk"""
+    enqueue_notification(patient_phone,
+                         f"🚨 Sehat Saathi: Emergency appointment {appointment_id} at {hospital_name} confirmed. "
+                         f"Call 108 for ambulance.", 'emergency_booking')
+    if EMERGENCY_ALERT_NUMBER:
+        enqueue_notification(EMERGENCY_ALERT_NUMBER,
+                             f"🚨 EMERGENCY booking {appointment_id}: {patient_name}, {hospital_name}, pincode {pincode}",
+                             'emergency_alert')
+
+def is_rate_limited(recipient, now):
+    """Per-recipient sliding window limit"""
+    window = recipient_send_times.setdefault(recipient, deque())
+    while window and now - window[0] > 60:
+        window.popleft()
+    return len(window) >= NOTIFICATION_RATE_LIMIT
+
+def claim_notifications(now):
+    """
+    Claim a batch of due notifications by marking them 'sending', so two
+    dispatchers never send the same row. A claim holds the row until
+    next_attempt_at (the lease) - rows still 'sending' after that belong to
+    a dead dispatcher and are claimed again.
+    """
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        due = conn.execute('''
+            SELECT * FROM notifications
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+        ''', (now, NOTIFICATION_BATCH_SIZE)).fetchall()
+        conn.executemany("UPDATE notifications SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                         [(now + NOTIFICATION_LEASE_SECONDS, notification['id']) for notification in due])
+        conn.commit()
+        return due
+
+def dispatch_notifications():
+    """Send one batch of due notifications, returns number processed"""
+    now = time.time()
+    due = claim_notifications(now)
+    if not due:
+        return 0
+
+    batch, deferred = [], []
+    for notification in due:
+        if is_rate_limited(notification['recipient'], now):
+            deferred.append((now + 60, notification['id']))
+        else:
+            recipient_send_times[notification['recipient']].append(now)
+            batch.append(notification)
+
+    results = notification_transport.send_batch(batch) if batch else {}
+
+    sent, retries, failed = [], [], []
+    for notification in batch:
+        error = results.get(notification['id'], 'no result from transport')
+        attempts = notification['attempts'] + 1
+        if error is None:
+            sent.append((attempts, notification['id']))
+        elif attempts >= NOTIFICATION_MAX_ATTEMPTS:
+            failed.append((attempts, error, notification['id']))
+        else:
+            delay = min(NOTIFICATION_RETRY_MAX, NOTIFICATION_RETRY_BASE * 2 ** (attempts - 1))
+            retries.append((attempts, error, now + delay, notification['id']))
+
+    with get_db() as conn:
+        conn.executemany("UPDATE notifications SET status = 'sent', attempts = ?, sent_at = CURRENT_TIMESTAMP WHERE id = ?", sent)
+        conn.executemany("UPDATE notifications SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?", failed)
+        conn.executemany("UPDATE notifications SET status = 'pending', attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?", retries)
+        conn.executemany("UPDATE notifications SET status = 'pending', next_attempt_at = ? WHERE id = ?", deferred)
+        conn.commit()
+
+    if sent or failed:
+        print(f"📨 Notifications: {len(sent)} sent, {len(retries)} retrying, {len(failed)} failed")
+    return len(due)
+
+def notification_dispatcher():
+    """Background loop sending queued notifications"""
+    while True:
+        try:
+            processed = dispatch_notifications()
+        except Exception as e:
+            print(f"❌ Notification dispatcher error: {e}")
+            processed = 0
+        if not processed:
+            notification_wakeup.wait(timeout=5)
+            notification_wakeup.clear()
+
+def start_notification_dispatcher():
+    """Start dispatcher thread once per process"""
+    global notification_dispatcher_started
+    with notification_dispatcher_lock:
+        if notification_dispatcher_started:
+            return
+        threading.Thread(target=notification_dispatcher, name="notifications", daemon=True).start()
+        notification_dispatcher_started = True
+
+# ==================== LEGACY DATA IMPORT ====================
+
+LEGACY_FILES = [
+    'data/appointments.json', 'data/doctors.json', 'data/services.json',
+    'bookings.json', 'requests.jsonl', 'clinics.json', 'hospitals.json'
+]
+LEGACY_READ_SIZE = 64 * 1024
+
+class CountingReader:
+    """Text file wrapper that counts bytes read (for throughput reports)"""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, size):
+        chunk = self.f.read(size)
+        self.bytes_read += len(chunk.encode('utf-8'))
+        return chunk
+
+    def readline(self):
+        line = self.f.readline()
+        self.bytes_read += len(line.encode('utf-8'))
+        return line
+
+def iter_json_stream(reader):
+    """
+    Incrementally parse a top-level JSON array or object.
+    Yields array elements, or each value of an object - list values are
+    streamed element by element with the object key added as '_group'.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+
+    def fill():
+        nonlocal buffer, eof
+        chunk = reader.read(LEGACY_READ_SIZE)
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+    def skip(chars):
+        nonlocal buffer
+        while True:
+            buffer = buffer.lstrip(chars)
+            if buffer or eof:
+                return
+            fill()
+
+    def decode():
+        nonlocal buffer
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer)
+                # A number at the buffer edge may be cut off - make sure more input follows
+                if end == len(buffer) and not eof and not isinstance(value, (dict, list, str)):
+                    raise json.JSONDecodeError('partial value', buffer, end)
+                buffer = buffer[end:]
+                return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+
+    skip(' \t\r\n\ufeff')
+    if not buffer:
+        return
+    opening = buffer[0]
+    buffer = buffer[1:]
+    closing = ']' if opening == '[' else '}'
+    if opening not in '[{':
+        raise ValueError("Expected JSON array or object")
+
+    while True:
+        skip(' \t\r\n,')
+        if not buffer or buffer[0] == closing:
+            return
+        if opening == '[':
+            yield decode()
+            continue
+        key = decode()
+        skip(' \t\r\n:')
+        if buffer[:1] != '[':
+            yield decode()
+            continue
+        # {group: [...]} - read the nested array one element at a time too
+        buffer = buffer[1:]
+        while True:
+            skip(' \t\r\n,')
+            if not buffer:
+                raise ValueError("Unterminated JSON array")
+            if buffer[0] == ']':
+                buffer = buffer[1:]
+                break
+            item = decode()
+            if isinstance(item, dict):
+                item = dict(item, _group=key)
+            yield item
+
+def iter_legacy_records(reader, path):
+    """Stream records from JSON or JSONL file"""
+    if path.endswith('.jsonl'):
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        yield from iter_json_stream(reader)
+
+def first_value(record, *keys):
+    """First non-empty value among differently named legacy fields"""
+    for key in keys:
+        if record.get(key) not in (None, ''):
+            return record[key]
+    return None
+
+def map_legacy_record(record):
+    """Map a legacy record onto our schema, returns (table, row dict) or None"""
+    if not isinstance(record, dict):
+        return None
+
+    if 'specialization' in record and 'name' in record and not record.get('slots'):
+        languages = record.get('languages')
+        if isinstance(languages, list):
+            languages = ','.join(languages)
+        return 'doctors', {
+            'name': record['name'], 'specialization': record['specialization'],
+            'fee': record.get('fee'), 'contact': record.get('contact'),
+            'online_link': record.get('online_link'), 'languages': languages,
+            'status': record.get('status', 'active'),
+            'experience_years': record.get('experience_years'), 'rating': record.get('rating')
+        }
+
+    if 'latitude' in record or 'slots' in record:
+        slots = record.get('slots')
+        return 'facilities', {
+            'name': record.get('name', 'Unnamed'), 'type': record.get('type'),
+            'specialization': record.get('_group'), 'address': record.get('address'),
+            'latitude': record.get('latitude'), 'longitude': record.get('longitude'),
+            'phone': record.get('phone'), 'slots': ','.join(slots) if isinstance(slots, list) else slots
+        }
+
+    if first_value(record, 'hospital', 'hospital_name', 'doctor', 'slot'):
+        doctor = record.get('doctor')
+        hospital = first_value(record, 'hospital', 'hospital_name') or (f"Tele-consultation: {doctor}" if doctor else 'Unknown Hospital')
+        return 'appointments', {
+            'patient_name': first_value(record, 'name', 'patient_name') or 'Unknown',
+            'phone': first_value(record, 'user_number', 'phone', 'patient_phone'),
+            'hospital_name': hospital,
+            'hospital_type': record.get('hospital_type') or ('Tele-Consultation' if record.get('type') == 'teleconsultation' else 'hospital'),
+            'slot': record.get('slot') or 'N/A',
+            'status': record.get('status', 'pending'),
+            'priority': record.get('priority', 'normal'),
+            'symptoms': record.get('symptoms'),
+            'pincode': record.get('pincode'),
+            'maps_link': record.get('maps_link'),
+            'created_at': first_value(record, 'timestamp', 'created_at'),
+            'approved_by': first_value(record, 'approved_by', 'rejected_by'),
+            'approved_at': first_value(record, 'approved_at', 'rejected_at')
+        }
+
+    if 'price' in record or 'duration' in record:
+        return 'services', {
+            'name': record.get('name', 'Unnamed'), 'description': record.get('description'),
+            'price': record.get('price'), 'duration': record.get('duration'),
+            'status': record.get('status', 'active')
+        }
+
+    symptoms = first_value(record, 'symptoms', 'message', 'query')
+    if symptoms:
+        return 'health_queries', {
+            'patient_phone': first_value(record, 'patient_phone', 'user_number', 'phone', 'session_id'),
+            'symptoms': symptoms,
+            'ai_response': first_value(record, 'ai_response', 'reply', 'response'),
+            'severity': record.get('severity', 'low'),
+            'created_at': first_value(record, 'created_at', 'timestamp')
+        }
+
+    return None
+
+# Reference rows that init_db seeds as well - matched on a natural key instead of inserted twice
+LEGACY_NATURAL_KEYS = {
+    'doctors': ('name', 'contact'),
+    'services': ('name',),
+}
+
+def find_existing_row(conn, table, row):
+    """Id of an existing row with the same natural key, or None"""
+    key_columns = LEGACY_NATURAL_KEYS.get(table)
+    if not key_columns:
+        return None
+    where = ' AND '.join(f"{column} IS ?" for column in key_columns)
+    existing = conn.execute(f'SELECT id FROM {table} WHERE {where} LIMIT 1',
+                            [row.get(column) for column in key_columns]).fetchone()
+    return existing['id'] if existing else None
+
+def insert_legacy_row(conn, table, row):
+    """Insert mapped row, returns new row id"""
+    if table == 'appointments':
+        cursor = conn.execute(
+            'INSERT INTO patients (name, phone, pincode, created_at) VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))',
+            (row.pop('patient_name'), row.pop('phone'), row['pincode'], row['created_at']))
+        row['patient_id'] = cursor.lastrowid
+    if table == 'health_queries':
+        row['response_id'] = store_response(conn, row.pop('ai_response', None))
+    if 'created_at' in row and row['created_at'] is None:
+        del row['created_at']
+    columns = ', '.join(row)
+    placeholders = ', '.join('?' * len(row))
+    cursor = conn.execute(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', list(row.values()))
+    return cursor.lastrowid
+
+def import_legacy_file(conn, path, batch_size=1000):
+    """Stream one legacy file into SQLite, returns stats dict"""
+    stats = {'records': 0, 'imported': 0, 'skipped': 0, 'duplicates': 0, 'unmapped': 0, 'failed': 0, 'bytes': 0}
+    source = os.path.basename(path)
+    # Records are keyed by their export id, else their position in the file -
+    # two identical records (same patient, same slot twice) are two rows
+    with open(path, encoding='utf-8') as f:
+        reader = CountingReader(f)
+        for record in iter_legacy_records(reader, path):
+            stats['records'] += 1
+            mapped = map_legacy_record(record)
+            if not mapped:
+                stats['unmapped'] += 1
+                continue
+            table, row = mapped
+            record_id = record.get('id')
+            source_key = f"{source}:id:{record_id}" if record_id not in (None, '') else f"{source}:#{stats['records']}"
+            record_hash = hashlib.sha1(json.dumps(record, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+            # One savepoint per record, so a bad row doesn't lose the rest of the batch
+            if not conn.in_transaction:
+                conn.execute('BEGIN')
+            conn.execute('SAVEPOINT legacy_record')
+            try:
+                # Earlier imports keyed records by content hash - move one such key over to this record
+                conn.execute('''
+                    UPDATE legacy_imports SET source_key = ? WHERE source_key = ?
+                    AND NOT EXISTS (SELECT 1 FROM legacy_imports WHERE source_key = ?)
+                ''', (source_key, f"{source}:{record_hash}", source_key))
+                cursor = conn.execute('INSERT OR IGNORE INTO legacy_imports (source_key, table_name) VALUES (?, ?)',
+                                      (source_key, table))
+                if not cursor.rowcount:
+                    stats['skipped'] += 1
+                    conn.execute('RELEASE legacy_record')
+                    continue
+                row_id = find_existing_row(conn, table, row)
+                if row_id:
+                    stats['duplicates'] += 1
+                else:
+                    row_id = insert_legacy_row(conn, table, row)
+                    stats['imported'] += 1
+                conn.execute('UPDATE legacy_imports SET row_id = ? WHERE source_key = ?', (row_id, source_key))
+                conn.execute('RELEASE legacy_record')
+            except sqlite3.Error as e:
+                conn.execute('ROLLBACK TO legacy_record')
+                conn.execute('RELEASE legacy_record')
+                stats['failed'] += 1
+                print(f"⚠️ {path} record {stats['records']}: {e}")
+                continue
+            if stats['records'] % batch_size == 0:
+                conn.commit()
+        conn.commit()
+        stats['bytes'] = reader.bytes_read
+    return stats
+
+@app.cli.command('import-legacy')
+@click.argument('paths', nargs=-1)
+@click.option('--batch-size', default=1000, help='Records per transaction')
+def import_legacy_command(paths, batch_size):
+    """Import legacy JSON/JSONL files into the database (safe to re-run)."""
+    init_db()
+    totals = {'records': 0, 'imported': 0, 'bytes': 0}
+    overall_start = time.monotonic()
+    with get_db() as conn:
+        conn.execute('PRAGMA synchronous = NORMAL')
+        for path in paths or LEGACY_FILES:
+            if not os.path.exists(path):
+                print(f"⚠️ {path}: not found, skipping")
+                continue
+            start = time.monotonic()
+            try:
+                stats = import_legacy_file(conn, path, batch_size)
+            except (ValueError, json.JSONDecodeError) as e:
+                conn.rollback()
+                print(f"❌ {path}: {e}")
+                continue
+            elapsed = max(time.monotonic() - start, 1e-6)
+            print(f"📥 {path}: {stats['records']} records, {stats['imported']} imported, "
+                  f"{stats['skipped']} already imported, {stats['duplicates']} matched existing rows, "
+                  f"{stats['unmapped']} unmapped, {stats['failed']} failed "
+                  f"({stats['records'] / elapsed:.0f} rec/s, {stats['bytes'] / elapsed / 1e6:.1f} MB/s)")
+            for key in totals:
+                totals[key] += stats[key]
+    elapsed = max(time.monotonic() - overall_start, 1e-6)
+    print(f"✅ Total: {totals['imported']}/{totals['records']} records imported in {elapsed:.1f}s "
+          f"({totals['records'] / elapsed:.0f} rec/s)")
+
+# ==================== DATA ARCHIVAL ====================
+
+ARCHIVE_FOLDER = os.getenv("ARCHIVE_FOLDER", "data/archive")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_DICT_SIZE = 32 * 1024  # zlib window size - larger dictionaries are not used
+# Monthly archive files keep the hot table names as views, so the same SQL
+# runs against hot and archived partitions. response_id points at the hot
+# ai_responses table; inline ai_response text from before deduplication is
+# stored zlib-compressed with a per-file shared dictionary.
+ARCHIVE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS archive_meta (key TEXT PRIMARY KEY, value BLOB);
+    CREATE TABLE IF NOT EXISTS health_queries_archive (
+        id INTEGER PRIMARY KEY,
+        patient_phone TEXT,
+        symptoms TEXT,
+        ai_response_z BLOB,
+        severity TEXT,
+        created_at TIMESTAMP,
+        response_id INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_health_queries_archive_created ON health_queries_archive (created_at);
+    CREATE VIEW IF NOT EXISTS health_queries AS
+        SELECT id, patient_phone, symptoms, inflate(ai_response_z) AS ai_response, severity, created_at, response_id
+        FROM health_queries_archive;
+    CREATE TABLE IF NOT EXISTS emergency_contacts (
+        id INTEGER PRIMARY KEY,
+        patient_phone TEXT,
+        emergency_type TEXT,
+        pincode TEXT,
+        action_taken TEXT,
+        created_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_emergency_contacts_archive_created ON emergency_contacts (created_at);
+'''
+# hot table -> (archive table, columns, compressed column)
+ARCHIVE_TABLES = {
+    'health_queries': ('health_queries_archive',
+                       ['id', 'patient_phone', 'symptoms', 'ai_response', 'severity', 'created_at', 'response_id'], 'ai_response'),
+    'emergency_contacts': ('emergency_contacts',
+                           ['id', 'patient_phone', 'emergency_type', 'pincode', 'action_taken', 'created_at'], None)
+}
+
+def build_compression_dict(texts):
+    """Shared zlib dictionary from the most common lines (most common last)"""
+    counts = {}
+    for text in texts:
+        for line in (text or '').splitlines():
+            line = line.strip()
+            if len(line) > 8:
+                counts[line] = counts.get(line, 0) + 1
+    zdict, size = [], 0
+    for line, count in sorted(counts.items(), key=lambda item: -item[1]):
+        if count < 2 or size + len(line.encode('utf-8')) + 1 > ARCHIVE_DICT_SIZE:
+            break
+        zdict.append(line)
+        size += len(line.encode('utf-8')) + 1
+    return '\n'.join(reversed(zdict)).encode('utf-8')
+
+def deflate_text(text, zdict):
+    """Compress text with the archive's shared dictionary"""
+    if text is None:
+        return None
+    compressor = zlib.compressobj(9, zdict=zdict) if zdict else zlib.compressobj(9)
+    return compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+def inflate_text(blob, zdict):
+    """Decompress archived text"""
+    if blob is None:
+        return None
+    decompressor = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+    return (decompressor.decompress(blob) + decompressor.flush()).decode('utf-8')
+
+def archive_path(month):
+    """Archive file for a YYYY-MM month"""
+    return os.path.join(ARCHIVE_FOLDER, f"sehat_archive_{month}.db")
+
+def list_archive_months():
+    """Archived months, oldest first"""
+    if not os.path.isdir(ARCHIVE_FOLDER):
+        return []
+    return sorted(name[len('sehat_archive_'):-3] for name in os.listdir(ARCHIVE_FOLDER)
+                  if name.startswith('sehat_archive_') and name.endswith('.db'))
+
+def open_archive(month, create=False, sample_texts=None):
+    """
+    Open a monthly archive, returns (conn, zdict) or None if it doesn't exist.
+    With create=True the file is created if needed; the first sample_texts
+    given to a file build its compression dictionary.
+    """
+    path = archive_path(month)
+    if not create and not os.path.exists(path):
+        return None
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    if create:
+        conn.executescript(ARCHIVE_SCHEMA)
+        if sample_texts:
+            conn.execute('INSERT OR IGNORE INTO archive_meta (key, value) VALUES (?, ?)',
+                         ('zdict', build_compression_dict(sample_texts)))
+        conn.commit()
+    row = conn.execute("SELECT value FROM archive_meta WHERE key = 'zdict'").fetchone()
+    zdict = bytes(row['value']) if row and row['value'] else None
+    conn.create_function('inflate', 1, lambda blob: inflate_text(blob, zdict), deterministic=True)
+    return conn, zdict
+
+def archive_old_rows(days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move rows older than `days` into monthly archive files"""
+    cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    moved = {}
+    for table, (archive_table, columns, compressed) in ARCHIVE_TABLES.items():
+        moved[table] = 0
+        with get_db() as conn:
+            months = [row[0] for row in conn.execute(
+                f"SELECT DISTINCT strftime('%Y-%m', created_at) FROM {table} WHERE created_at < ?", (cutoff,))]
+            for month in months:
+                select_sql = (f"SELECT {', '.join(columns)} FROM {table} "
+                              f"WHERE created_at < ? AND strftime('%Y-%m', created_at) = ? ORDER BY id LIMIT ?")
+                archive = None
+                while True:
+                    rows = conn.execute(select_sql, (cutoff, month, batch_size)).fetchall()
+                    if not rows:
+                        break
+                    if archive is None:
+                        samples = [row[compressed] for row in rows] if compressed else None
+                        archive, zdict = open_archive(month, create=True, sample_texts=samples)
+                    values = [tuple(deflate_text(row[col], zdict) if col == compressed else row[col] for col in columns)
+                              for row in rows]
+                    archive_columns = [f"{col}_z" if col == compressed else col for col in columns]
+                    # Archive commit first - a crash before the delete just re-copies (OR IGNORE)
+                    archive.executemany(
+                        f"INSERT OR IGNORE INTO {archive_table} ({', '.join(archive_columns)}) "
+                        f"VALUES ({', '.join('?' * len(columns))})", values)
+                    archive.commit()
+
+                    ids = [row['id'] for row in rows]
+                    placeholders = ','.join('?' * len(ids))
+                    conn.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+                    # Archived rows are not real deletes - keep them out of the live change feed
+                    conn.execute(f"DELETE FROM change_log WHERE table_name = ? AND op = 'delete' AND row_id IN ({placeholders})",
+                                 [table] + ids)
+                    conn.commit()
+                    moved[table] += len(rows)
+                if archive is not None:
+                    archive.close()
+                    print(f"🗄️ Archived {table} {month} -> {archive_path(month)}")
+    return moved
+
+def iter_partitioned_rows(table, query, params=(), start=None, end=None, newest_first=False):
+    """
+    Run the same query on the hot database and on archived months that
+    overlap [start, end] (YYYY-MM-DD), yielding rows partition by partition.
+    Archived months are always older than hot rows, so per-partition
+    ordering by created_at gives a correctly ordered stream.
+    """
+    months = []
+    if table in ARCHIVE_TABLES:
+        months = [m for m in list_archive_months()
+                  if (not start or m >= start[:7]) and (not end or m <= end[:7])]
+    partitions = [None] + months[::-1] if newest_first else months + [None]
+    for month in partitions:
+        if month is None:
+            with get_read_db() as conn:
+                yield from conn.execute(query, params)
+            continue
+        opened = open_archive(month)
+        if not opened:
+            continue
+        archive, _ = opened
+        try:
+            yield from archive.execute(query, params)
+        finally:
+            archive.close()
+
+# (table, month) -> (archive file mtime, row count) - a file is only re-counted after it changes
+archive_count_cache = {}
+
+def count_archived_rows(table):
+    """Total rows of table across archive files"""
+    total = 0
+    for month in list_archive_months():
+        try:
+            mtime = os.stat(archive_path(month)).st_mtime_ns
+        except OSError:
+            continue
+        cached = archive_count_cache.get((table, month))
+        if cached and cached[0] == mtime:
+            total += cached[1]
+            continue
+        opened = open_archive(month)
+        if opened:
+            archive, _ = opened
+            try:
+                count = archive.execute(f"SELECT COUNT(*) FROM {ARCHIVE_TABLES[table][0]}").fetchone()[0]
+            finally:
+                archive.close()
+            archive_count_cache[(table, month)] = (mtime, count)
+            total += count
+    return total
+
+@app.cli.command('archive-data')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, help='Archive rows older than this many days')
+def archive_data_command(days):
+    """Move old health queries and emergency logs into monthly archives."""
+    start = time.monotonic()
+    moved = archive_old_rows(days)
+    summary = ', '.join(f"{count} {table}" for table, count in moved.items())
+    print(f"✅ Archived {summary} in {time.monotonic() - start:.1f}s")
+
+# ==================== DATA EXPORTS ====================
+
+EXPORT_FETCH_SIZE = 500
+# export name -> (query, status filter column, date column)
+EXPORT_QUERIES = {
+    'appointments': ('''
+        SELECT a.id, p.name as patient_name, p.phone, a.hospital_name, a.hospital_type, a.slot,
+               a.status, a.priority, a.symptoms, a.pincode, a.created_at, a.approved_by, a.approved_at
+        FROM appointments a
+        LEFT JOIN patients p ON a.patient_id = p.id
+    ''', 'a.status', 'a.created_at'),
+    'health_queries': ('''
+        SELECT id, patient_phone, symptoms, ai_response, response_id, severity, created_at
+        FROM health_queries
+    ''', 'severity', 'created_at'),
+    'emergency_logs': ('''
+        SELECT id, patient_phone, emergency_type, pincode, action_taken, created_at
+        FROM emergency_contacts
+    ''', 'emergency_type', 'created_at')
+}
+# Exports that also read archived months (export name -> table)
+EXPORT_ARCHIVED_TABLES = {'health_queries': 'health_queries', 'emergency_logs': 'emergency_contacts'}
+
+def build_export_query(name, start=None, end=None, status=None):
+    """Export SQL with optional date-range (YYYY-MM-DD) and status filters"""
+    query, status_column, date_column = EXPORT_QUERIES[name]
+    conditions, params = [], []
+    if start:
+        conditions.append(f"{date_column} >= ?")
+        params.append(start)
+    if end:
+        # End date is inclusive
+        conditions.append(f"{date_column} < date(?, '+1 day')")
+        params.append(end)
+    if status:
+        conditions.append(f"{status_column} = ?")
+        params.append(status)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query + f' ORDER BY {date_column}', params
+
+def iter_export_rows(name, fmt='csv', start=None, end=None, status=None):
+    """Yield export as text chunks, reading rows incrementally from the cursor"""
+    query, params = build_export_query(name, start, end, status)
+    with get_read_db() as conn:
+        columns = [col[0] for col in conn.execute(f"SELECT * FROM ({query}) LIMIT 0", params).description]
+    rows = iter_partitioned_rows(EXPORT_ARCHIVED_TABLES.get(name, name), query, params, start, end)
+    if name == 'health_queries':
+        rows = with_response_text(rows)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(columns)
+    while True:
+        batch = list(islice(rows, EXPORT_FETCH_SIZE))
+        if not batch:
+            break
+        for row in batch:
+            values = [row[col] for col in columns]
+            if fmt == 'csv':
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False) + '\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def iter_export_bytes(name, fmt='csv', start=None, end=None, status=None, compress=False):
+    """Encode export chunks, gzip-compressing on the fly if asked"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits 31 = gzip
+    for chunk in iter_export_rows(name, fmt, start, end, status):
+        data = chunk.encode('utf-8')
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+@app.cli.command('export-data')
+@click.argument('name', type=click.Choice(list(EXPORT_QUERIES)))
+@click.option('--format', 'fmt', default='csv', type=click.Choice(['csv', 'ndjson']))
+@click.option('--start', help='From date (YYYY-MM-DD)')
+@click.option('--end', help='To date, inclusive (YYYY-MM-DD)')
+@click.option('--status', help='Status / severity / emergency type filter')
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip output')
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='Output file (default stdout)')
+def export_data_command(name, fmt, start, end, status, compress, output):
+    """Stream a table export as CSV or NDJSON."""
+    for chunk in iter_export_bytes(name, fmt, start, end, status, compress):
+        output.write(chunk)
+
+# ==================== LIVE CHANGE FEED ====================
+
+CHANGE_FEED_TABLES = ['patients', 'appointments', 'health_queries', 'emergency_contacts', 'prescriptions']
+CHANGE_FEED_POLL = 1.0        # seconds between PRAGMA data_version checks
+CHANGE_LOG_KEEP = 10000       # change_log rows kept for reconnecting clients
+CHANGE_LOG_PRUNE_INTERVAL = 60
+# Row payload sent with each change (appointments include the patient name)
+CHANGE_ROW_QUERIES = {
+    'appointments': '''
+        SELECT a.*, p.name as patient_name FROM appointments a
+        LEFT JOIN patients p ON a.patient_id = p.id WHERE a.id = ?
+    ''',
+    'health_queries': '''
+        SELECT hq.id, hq.patient_phone, hq.symptoms, COALESCE(r.content, hq.ai_response) as ai_response,
+               hq.response_id, hq.severity, hq.created_at
+        FROM health_queries hq LEFT JOIN ai_responses r ON hq.response_id = r.id WHERE hq.id = ?
+    '''
+}
+
+class ChangeFeed:
+    """
+    Watches the database for changes and pushes them to subscribers.
+    A single thread checks PRAGMA data_version (bumped only when another
+    connection commits) and reads new change_log rows past its high-water mark.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=1000)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="change-feed", daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def connect(self):
+        conn = sqlite3.connect(app.config['DATABASE'], check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def build_event(self, conn, change):
+        """Change row + current table row as JSON-ready dict"""
+        event = {'id': change['id'], 'table': change['table_name'], 'op': change['op'],
+                 'row_id': change['row_id'], 'old_status': change['old_status'],
+                 'new_status': change['new_status'], 'row': None}
+        if change['op'] != 'delete':
+            query = CHANGE_ROW_QUERIES.get(change['table_name'], f"SELECT * FROM {change['table_name']} WHERE id = ?")
+            row = conn.execute(query, (change['row_id'],)).fetchone()
+            event['row'] = dict(row) if row else None
+        return event
+
+    def changes_since(self, conn, last_id, limit=500):
+        rows = conn.execute('SELECT * FROM change_log WHERE id > ? ORDER BY id LIMIT ?', (last_id, limit)).fetchall()
+        return [self.build_event(conn, row) for row in rows]
+
+    def backlog(self, last_id):
+        """Changes missed by a reconnecting client"""
+        conn = self.connect()
+        try:
+            return self.changes_since(conn, last_id)
+        finally:
+            conn.close()
+
+    def broadcast(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Slow client - drop it, it resumes from Last-Event-ID on reconnect
+                self.unsubscribe(subscriber)
+
+    def run(self):
+        conn = self.connect()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM change_log').fetchone()[0]
+        last_version = None
+        while True:
+            try:
+                version = conn.execute('PRAGMA data_version').fetchone()[0]
+                if version != last_version:
+                    last_version = version
+                    events = self.changes_since(conn, last_id)
+                    for event in events:
+                        self.broadcast(event)
+                    if events:
+                        last_id = events[-1]['id']
+                        if len(events) == 500:
+                            last_version = None  # more pending - read again right away
+                            continue
+            except Exception as e:
+                print(f"❌ Change feed error: {e}")
+            time.sleep(CHANGE_FEED_POLL)
+
+change_feed = ChangeFeed()
+
+def change_log_pruner():
+    """Trim change_log every CHANGE_LOG_PRUNE_INTERVAL, whether or not anyone watches the feed"""
+    while True:
+        time.sleep(CHANGE_LOG_PRUNE_INTERVAL)
+        try:
+            with db_write_slot(), get_db() as conn:
+                prune_change_log(conn)
+                conn.commit()
+        except Exception as e:
+            print(f"❌ Change log prune error: {e}")
+
+def get_change_cursor(conn=None):
+    """Latest change_log id (pages pass it to the feed to avoid gaps)"""
+    if conn is not None:
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM change_log').fetchone()[0]
+    with get_read_db() as conn:
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM change_log').fetchone()[0]
+
+def format_sse(event):
+    return f"id: {event['id']}\nevent: change\ndata: {json.dumps(event, default=str)}\n\n"
+
 # ==================== ADMIN AUTHENTICATION ====================
 
 def admin_required(f):
@@ -664,17 +3795,368 @@ def admin_required(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+# ==================== HTTP CACHING & COMPRESSION ====================
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "500"))
+COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript', 'application/json'}
+PAGE_MAX_AGE = int(os.getenv("PAGE_MAX_AGE", str(24 * 3600)))
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.getenv("STATIC_MAX_AGE", str(30 * 24 * 3600)))
+
+def get_app_version():
+    """Deploy version for ETags - changes when code or templates change"""
+    if os.getenv("APP_VERSION"):
+        return os.getenv("APP_VERSION")
+    template_dir = os.path.join(app.root_path, 'templates')
+    paths = [os.path.abspath(__file__)] + [os.path.join(template_dir, name) for name in os.listdir(template_dir)]
+    return str(int(max(os.path.getmtime(path) for path in paths)))
+
+APP_VERSION = get_app_version()
+
+def get_tables_version(tables):
+    """Latest change_log entry for any of the tables: (id, changed_at)"""
+    placeholders = ','.join('?' * len(tables))
+    with get_read_db() as conn:
+        row = conn.execute(f'''
+            SELECT id, created_at FROM change_log
+            WHERE id = (SELECT MAX(id) FROM change_log WHERE table_name IN ({placeholders}))
+        ''', tables).fetchone()
+    if not row:
+        return 0, None
+    return row['id'], datetime.strptime(row['created_at'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+
+def conditional_view(*tables):
+    """Decorator answering 304 Not Modified when none of the view's tables changed"""
+    def decorator(f):
+        def decorated_function(*args, **kwargs):
+            # Pending flash messages are shown once - always render
+            if session.get('_flashes'):
+                return f(*args, **kwargs)
+            version, changed_at = get_tables_version(tables)
+            etag = hashlib.md5(f"{APP_VERSION}:{request.full_path}:{version}".encode()).hexdigest()
+            not_modified = request.if_none_match.contains_weak(etag) if request.if_none_match else (
+                changed_at is not None and request.if_modified_since is not None and request.if_modified_since >= changed_at)
+            response = Response(status=304) if not_modified else make_response(f(*args, **kwargs))
+            response.set_etag(etag, weak=True)
+            if changed_at:
+                response.last_modified = changed_at
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        decorated_function.__name__ = f.__name__
+        return decorated_function
+    return decorator
+
+def render_static_page(template_name):
+    """Render a page without per-request data, cacheable by browsers"""
+    etag = hashlib.md5(f"{APP_VERSION}:{template_name}".encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(render_template(template_name))
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = PAGE_MAX_AGE
+    return response
+
+background_jobs_started = False
+background_jobs_lock = threading.Lock()
+
+def start_background_jobs():
+    """Once per process: resume leftover work and start the periodic jobs"""
+    global background_jobs_started
+    with background_jobs_lock:
+        if background_jobs_started:
+            return
+        background_jobs_started = True
+    schedule_prescription_processing()
+    start_cache_warmer()
+    threading.Thread(target=change_log_pruner, name="change-log-pruner", daemon=True).start()
+
+@app.before_request
+def ensure_background_jobs():
+    """Start background jobs on the first request (flask run / WSGI servers skip __main__)"""
+    if not background_jobs_started:
+        start_background_jobs()
+
+@app.after_request
+def compress_response(response):
+    """Brotli/gzip-compress text responses above COMPRESS_MIN_SIZE"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    if BROTLI_AVAILABLE and request.accept_encodings['br']:
+        data, encoding = brotli.compress(data, quality=5), 'br'
+    elif request.accept_encodings['gzip']:
+        data, encoding = gzip.compress(data, compresslevel=6), 'gzip'
+    else:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    # Encoded body differs byte-wise - a strong ETag must become weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# ==================== PROFILING ====================
+
+PROFILE_FOLDER = os.getenv("PROFILE_FOLDER", 'data/profiles')
+PROFILE_MODES = ('cprofile', 'stack')
+PROFILE_MAX_DURATION = 3600
+PROFILE_STACK_INTERVAL = float(os.getenv("PROFILE_STACK_INTERVAL", "0.005"))
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "5"))
+active_profiler = None
+profiler_lock = threading.Lock()
+
+class RequestProfiler:
+    """
+    WSGI wrapper around app.wsgi_app, installed only while a profiling run is
+    active. When stopped the plain Flask app is put back, so a disabled
+    profiler costs nothing per request.
+    mode 'cprofile' -> aggregated pstats, 'stack' -> collapsed stacks (flamegraph.pl / speedscope).
+    """
+
+    def __init__(self, wsgi_app, mode, sample_percent, session_id=None, duration=300):
+        self.wsgi_app = wsgi_app
+        self.mode = mode
+        self.sample_rate = sample_percent / 100
+        self.session_id = session_id
+        self.duration = duration
+        self.started_at = datetime.now()
+        self.lock = threading.Lock()
+        # cProfile can only trace one request at a time - concurrent picks are skipped
+        self.cprofile_lock = threading.Lock()
+        self.running = True
+        self.stats = None
+        self.stacks = {}
+        self.sampled_threads = set()
+        self.requests_seen = 0
+        self.requests_profiled = 0
+        self.skipped_busy = 0
+        self.sampler = None
+        if mode == 'stack':
+            self.sampler = threading.Thread(target=self.sample_stacks, daemon=True, name="stack-sampler")
+            self.sampler.start()
+
+    def request_session_id(self, environ):
+        """session_id from a /web-chat JSON body (the body is put back for Flask)"""
+        if environ.get('PATH_INFO') != '/web-chat':
+            return None
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return None
+        if not 0 < length <= 64 * 1024:
+            return None
+        body = environ['wsgi.input'].read(length)
+        environ['wsgi.input'] = io.BytesIO(body)
+        try:
+            return json.loads(body).get('session_id')
+        except (ValueError, AttributeError):
+            return None
+
+    def should_profile(self, environ):
+        if self.session_id:
+            return self.request_session_id(environ) == self.session_id
+        return random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        with self.lock:
+            self.requests_seen += 1
+        if not self.running or not self.should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+
+        if self.mode == 'stack':
+            ident = threading.get_ident()
+            self.sampled_threads.add(ident)
+            try:
+                return self.wsgi_app(environ, start_response)
+            finally:
+                self.sampled_threads.discard(ident)
+                with self.lock:
+                    self.requests_profiled += 1
+
+        if not self.cprofile_lock.acquire(blocking=False):
+            with self.lock:
+                self.skipped_busy += 1
+            return self.wsgi_app(environ, start_response)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(self.wsgi_app, environ, start_response)
+        finally:
+            self.cprofile_lock.release()
+            with self.lock:
+                self.requests_profiled += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def sample_stacks(self):
+        """Sample the stacks of threads serving picked requests"""
+        while self.running:
+            frames = sys._current_frames()
+            for ident in list(self.sampled_threads):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    key = ';'.join(reversed(stack))
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+            del frames
+            time.sleep(PROFILE_STACK_INTERVAL)
+
+    def write_results(self):
+        """Write the aggregated profile to PROFILE_FOLDER, returns file names"""
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        name = f"profile_{self.started_at.strftime('%Y%m%d_%H%M%S')}_{self.mode}"
+        files = []
+        if self.stats is not None:
+            path = os.path.join(PROFILE_FOLDER, f"{name}.pstats")
+            self.stats.dump_stats(path)
+            report = io.StringIO()
+            pstats.Stats(path, stream=report).sort_stats('cumulative').print_stats(40)
+            with open(os.path.join(PROFILE_FOLDER, f"{name}.txt"), 'w', encoding='utf-8') as f:
+                f.write(report.getvalue())
+            files += [f"{name}.pstats", f"{name}.txt"]
+        if self.stacks:
+            with open(os.path.join(PROFILE_FOLDER, f"{name}.collapsed"), 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            files.append(f"{name}.collapsed")
+        return files
+
+    def snapshot(self):
+        return {
+            'mode': self.mode,
+            'sample_percent': self.sample_rate * 100,
+            'session_id': self.session_id,
+            'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration': self.duration,
+            'requests_seen': self.requests_seen,
+            'requests_profiled': self.requests_profiled,
+            'skipped_busy': self.skipped_busy
+        }
+
+def start_profiling(mode, sample_percent, session_id=None, duration=300):
+    """Install the profiling wrapper, returns the profiler or None if one is running"""
+    global active_profiler
+    with profiler_lock:
+        if active_profiler is not None:
+            return None
+        profiler = RequestProfiler(app.wsgi_app, mode, sample_percent, session_id, duration)
+        app.wsgi_app = active_profiler = profiler
+    timer = threading.Timer(duration, stop_profiling, args=(profiler,))
+    timer.daemon = True
+    timer.start()
+    target = f"session {session_id}" if session_id else f"{sample_percent:g}% of requests"
+    print(f"🔬 Profiling started: {mode}, {target}, {duration}s")
+    return profiler
+
+def stop_profiling(profiler=None):
+    """Remove the profiling wrapper and write its results, returns file names"""
+    global active_profiler
+    with profiler_lock:
+        if active_profiler is None or (profiler is not None and profiler is not active_profiler):
+            return []
+        profiler = active_profiler
+        app.wsgi_app = profiler.wsgi_app
+        active_profiler = None
+    profiler.running = False
+    if profiler.sampler:
+        profiler.sampler.join()
+    try:
+        files = profiler.write_results()
+    except Exception as e:
+        print(f"❌ Error writing profile: {e}")
+        return []
+    print(f"🔬 Profiling stopped: {profiler.requests_profiled} requests profiled, wrote {', '.join(files) or 'nothing'}")
+    return files
+
+def list_profile_files():
+    """Profiles and memory snapshots on disk, newest first"""
+    if not os.path.isdir(PROFILE_FOLDER):
+        return []
+    files = []
+    for name in os.listdir(PROFILE_FOLDER):
+        path = os.path.join(PROFILE_FOLDER, name)
+        files.append({'name': name, 'bytes': os.path.getsize(path),
+                      'modified': datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d %H:%M:%S')})
+    return sorted(files, key=lambda f: f['modified'], reverse=True)
+
+def deep_sizeof(obj, seen):
+    """Bytes reachable from obj, skipping objects already counted in seen"""
+    size = 0
+    pending = [obj]
+    while pending:
+        item = pending.pop()
+        if id(item) in seen or isinstance(item, (type, Enum)) or callable(item):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            pending.extend(item)
+        else:
+            if hasattr(item, '__dict__'):
+                pending.append(item.__dict__)
+            for slot in getattr(type(item), '__slots__', ()):
+                if hasattr(item, slot):
+                    pending.append(getattr(item, slot))
+    return size
+
+def get_memory_report():
+    """Deep sizes of the session store and caches, plus a tracemalloc snapshot when tracing"""
+    # Caches first - objects sessions share with them are charged to the cache
+    stores = [
+        ('hospital_cache', hospital_cache, len(hospital_cache)), ('geocode_cache', geocode_cache, len(geocode_cache)),
+        ('ai_response_cache', ai_response_cache, len(ai_response_cache)),
+        ('response_text_cache', response_text_cache, len(response_text_cache)),
+        ('slots_cache', slots_cache, len(slots_cache)),
+        ('doctor_directory', doctor_directory, len(doctor_directory.by_id)),
+        ('user_sessions', user_sessions, len(user_sessions))
+    ]
+    seen = set()
+    report = {'stores': {}, 'tracemalloc': tracemalloc.is_tracing()}
+    for name, store, entries in stores:
+        report['stores'][name] = {'entries': entries, 'bytes': deep_sizeof(store, seen)}
+    if not tracemalloc.is_tracing():
+        return report
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')
+    ])
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    filename = f"memory_{datetime.now().strftime('%Y%m%d_%H%M%S')}.tracemalloc"
+    snapshot.dump(os.path.join(PROFILE_FOLDER, filename))
+    current, peak = tracemalloc.get_traced_memory()
+    report.update(file=filename, traced_bytes=current, peak_bytes=peak, top_sites=[
+        {'site': str(stat.traceback[0]), 'bytes': stat.size, 'blocks': stat.count}
+        for stat in snapshot.statistics('lineno')[:25]
+    ])
+    return report
+
 # ==================== ROUTES ====================
 
 @app.route('/')
 def home():
     """Main home page"""
-    return render_template('index.html')
+    return render_static_page('index.html')
 
 @app.route('/chat')
 def chat_ui():
     """Chatbot interface for testing"""
-    return render_template('chat.html')
+    return render_static_page('chat.html')
 
 @app.route('/test')
 def test_page():
@@ -695,7 +4177,7 @@ def test_page():
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
-    with get_db() as conn:
+    with get_read_db() as conn:
         status = {
             "status": "healthy",
             "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -704,6 +4186,26 @@ def health_check():
                 "appointments": conn.execute('SELECT COUNT(*) FROM appointments').fetchone()[0],
                 "doctors": conn.execute('SELECT COUNT(*) FROM doctors').fetchone()[0]
             },
+            "circuit_breakers": {
+                "nominatim": nominatim_breaker.snapshot(),
+                "overpass": overpass_breaker.snapshot()
+            },
+            "hospital_cache": {
+                "pincodes": len(hospital_cache),
+                "warmer": cache_warmer_stats
+            },
+            "voice_pipeline": {
+                "transcriber": VOICE_TRANSCRIBER,
+                "stage_timings_ms": get_voice_timing_summary()
+            },
+            "database": {
+                "journal_mode": conn.execute('PRAGMA journal_mode').fetchone()[0],
+                "write_ms": get_write_timing_summary()
+            },
+            "scheduler": {
+                "upstream": upstream_scheduler.snapshot(),
+                "db_writes": db_write_scheduler.snapshot()
+            },
             "twilio_enabled": TWILIO_ENABLED,
             "mode": "database"
         }
@@ -740,15 +4242,15 @@ def admin_logout():
 @admin_required
 def admin_dashboard():
     """Admin dashboard with comprehensive stats"""
-    with get_db() as conn:
+    with get_read_db() as conn:
         # Get all statistics
         total_patients = conn.execute('SELECT COUNT(*) as count FROM patients').fetchone()['count']
         total_appointments = conn.execute('SELECT COUNT(*) as count FROM appointments').fetchone()['count']
         pending_appointments = conn.execute('SELECT COUNT(*) as count FROM appointments WHERE status = "pending"').fetchone()['count']
         confirmed_appointments = conn.execute('SELECT COUNT(*) as count FROM appointments WHERE status = "confirmed"').fetchone()['count']
         total_doctors = conn.execute('SELECT COUNT(*) as count FROM doctors').fetchone()['count']
-        health_queries = conn.execute('SELECT COUNT(*) as count FROM health_queries').fetchone()['count']
-        emergency_logs = conn.execute('SELECT COUNT(*) as count FROM emergency_contacts').fetchone()['count']
+        health_queries = conn.execute('SELECT COUNT(*) as count FROM health_queries').fetchone()['count'] + count_archived_rows('health_queries')
+        emergency_logs = conn.execute('SELECT COUNT(*) as count FROM emergency_contacts').fetchone()['count'] + count_archived_rows('emergency_contacts')
         
         # Recent appointments
         recent_appointments = conn.execute('''
@@ -761,6 +4263,9 @@ def admin_dashboard():
         # Recent patients
         recent_patients = conn.execute('SELECT * FROM patients ORDER BY created_at DESC LIMIT 5').fetchall()
 
+        # Same snapshot as the stats above, so the live feed resumes exactly here
+        feed_cursor = get_change_cursor(conn)
+
     stats = {
         'total_patients': total_patients,
         'total_appointments': total_appointments,
@@ -775,10 +4280,48 @@ def admin_dashboard():
     return render_template('admin_dashboard.html', 
                          stats=stats, 
                          recent_appointments=recent_appointments,
-                         recent_patients=recent_patients)
+                         recent_patients=recent_patients,
+                         feed_cursor=feed_cursor)
+
+@app.route('/admin/changes')
+@admin_required
+def admin_changes():
+    """Server-sent events stream of database changes (resumes from Last-Event-ID or ?since=)"""
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('since') or 0)
+    except ValueError:
+        last_id = 0
+
+    def stream(subscriber):
+        sent_id = last_id
+        try:
+            if last_id:
+                for event in change_feed.backlog(last_id):
+                    yield format_sse(event)
+                    sent_id = event['id']
+            while True:
+                try:
+                    event = subscriber.get(timeout=15)
+                except queue.Empty:
+                    if subscriber not in change_feed.subscribers:
+                        break  # dropped as too slow - client reconnects with Last-Event-ID
+                    yield ": keepalive\n\n"
+                    continue
+                if event['id'] <= sent_id:
+                    continue
+                yield format_sse(event)
+                sent_id = event['id']
+        finally:
+            change_feed.unsubscribe(subscriber)
+
+    # Subscribe before reading the backlog so nothing falls in between
+    subscriber = change_feed.subscribe()
+    return Response(stream_with_context(stream(subscriber)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/admin/appointments')
 @admin_required
+@conditional_view('appointments', 'patients')
 def admin_appointments():
     """Appointments management with all data"""
     appointments = get_all_appointments()
@@ -790,9 +4333,11 @@ def appointment_action(appointment_id, action):
     """Handle appointment actions (accept/reject/delete)"""
     if action == 'accept':
         update_appointment_status(appointment_id, 'confirmed', 'admin')
+        notify_appointment_status(appointment_id)
         flash('Appointment accepted successfully!', 'success')
     elif action == 'reject':
         update_appointment_status(appointment_id, 'rejected', 'admin')
+        notify_appointment_status(appointment_id)
         flash('Appointment rejected!', 'warning')
     elif action == 'delete':
         delete_appointment(appointment_id)
@@ -800,8 +4345,38 @@ def appointment_action(appointment_id, action):
     
     return redirect(url_for('admin_appointments'))
 
+@app.route('/admin/appointments/bulk-action', methods=['POST'])
+@admin_required
+def appointments_bulk_action():
+    """Accept/reject/delete many appointments at once, returns changed rows as JSON"""
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    if action not in ('accept', 'reject', 'delete'):
+        return jsonify({'success': False, 'message': 'Invalid action'}), 400
+    try:
+        appointment_ids = [int(i) for i in data.get('ids', [])]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid appointment IDs'}), 400
+    if not appointment_ids:
+        return jsonify({'success': False, 'message': 'No appointments selected'}), 400
+
+    changed = bulk_update_appointments(appointment_ids, action)
+    if action == 'delete':
+        print(f"🗑️ Bulk deleted {len(changed)} appointments")
+        return jsonify({'success': True, 'action': action, 'deleted': changed})
+
+    enqueue_notifications([appointment_status_notification(apt) for apt in changed])
+    print(f"✅ Bulk {action}: {len(changed)} appointments updated")
+    return jsonify({
+        'success': True,
+        'action': action,
+        'changed': [{'id': apt['id'], 'status': apt['status'], 'approved_by': apt['approved_by'],
+                     'approved_at': apt['approved_at']} for apt in changed]
+    })
+
 @app.route('/admin/patients')
 @admin_required
+@conditional_view('patients')
 def admin_patients():
     """Patients management"""
     patients = get_all_patients()
@@ -814,25 +4389,132 @@ def admin_doctors():
     doctors = get_all_doctors()
     return render_template('admin_doctors.html', doctors=doctors)
 
+@app.route('/admin/doctors/add', methods=['GET', 'POST'])
+@admin_required
+def add_doctor():
+    """Add new doctor"""
+    if request.method == 'POST':
+        doctor_id = create_doctor(
+            name=request.form.get('name', '').strip(),
+            specialization=request.form.get('specialization', '').strip(),
+            fee=request.form.get('fee', '').strip(),
+            contact=request.form.get('contact', '').strip(),
+            online_link=request.form.get('online_link', '').strip()
+        )
+        if doctor_id:
+            flash('Doctor added successfully!', 'success')
+        else:
+            flash('Error adding doctor!', 'danger')
+        return redirect(url_for('admin_doctors'))
+    return render_template('add_doctor.html')
+
 @app.route('/admin/health-queries')
 @admin_required
+@conditional_view('health_queries')
 def admin_health_queries():
     """Health queries analytics"""
-    queries = get_health_queries()
+    queries = get_health_queries(limit=request.args.get('limit', type=int),
+                                 response_id=request.args.get('response_id', type=int))
     return render_template('admin_health_queries.html', queries=queries)
 
 @app.route('/admin/emergency-logs')
 @admin_required
+@conditional_view('emergency_contacts')
 def admin_emergency_logs():
     """Emergency logs"""
-    logs = get_emergency_logs()
+    logs = get_emergency_logs(limit=request.args.get('limit', type=int))
     return render_template('admin_emergency_logs.html', logs=logs)
 
+@app.route('/admin/prescriptions')
+@admin_required
+@conditional_view('prescriptions', 'patients')
+def admin_prescriptions():
+    """Uploaded prescriptions"""
+    prescriptions = get_all_prescriptions()
+    return render_template('admin_prescriptions.html', prescriptions=prescriptions)
+
+@app.route('/admin/export/<name>')
+@admin_required
+def admin_export(name):
+    """Stream CSV/NDJSON export (?format=ndjson&gzip=1&start=&end=&status=)"""
+    if name not in EXPORT_QUERIES:
+        return jsonify({'error': 'Unknown export'}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    compress = request.args.get('gzip') in ('1', 'true')
+
+    filename = f"{name}_{datetime.now().strftime('%Y%m%d')}.{fmt}" + ('.gz' if compress else '')
+    chunks = iter_export_bytes(name, fmt, request.args.get('start'), request.args.get('end'),
+                               request.args.get('status'), compress)
+    mimetype = 'application/gzip' if compress else ('text/csv' if fmt == 'csv' else 'application/x-ndjson')
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/admin/profiler')
+@admin_required
+def admin_profiler_status():
+    """Current profiling run, tracemalloc state and files available for download"""
+    return jsonify({
+        'active': active_profiler.snapshot() if active_profiler else None,
+        'tracemalloc': tracemalloc.is_tracing(),
+        'files': list_profile_files()
+    })
+
+@app.route('/admin/profiler/start', methods=['POST'])
+@admin_required
+def admin_profiler_start():
+    """Profile N% of requests, or every /web-chat turn of one session_id"""
+    data = request.get_json(silent=True) or {}
+    mode = data.get('mode', 'cprofile')
+    if mode not in PROFILE_MODES:
+        return jsonify({'success': False, 'message': f"mode must be one of {', '.join(PROFILE_MODES)}"}), 400
+    try:
+        sample_percent = float(data.get('sample_percent', 10))
+        duration = int(data.get('duration', 300))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid sample_percent or duration'}), 400
+    if not 0 < sample_percent <= 100 or not 0 < duration <= PROFILE_MAX_DURATION:
+        return jsonify({'success': False, 'message': f'sample_percent must be 0-100, duration 1-{PROFILE_MAX_DURATION}s'}), 400
+
+    profiler = start_profiling(mode, sample_percent, data.get('session_id') or None, duration)
+    if profiler is None:
+        return jsonify({'success': False, 'message': 'A profiling run is already active'}), 409
+    return jsonify({'success': True, 'profiler': profiler.snapshot()})
+
+@app.route('/admin/profiler/stop', methods=['POST'])
+@admin_required
+def admin_profiler_stop():
+    """Stop the active run and write its profile to disk"""
+    return jsonify({'success': True, 'files': stop_profiling()})
+
+@app.route('/admin/profiler/memory', methods=['POST'])
+@admin_required
+def admin_profiler_memory():
+    """Session store / cache sizes; action=start|snapshot|stop controls tracemalloc"""
+    action = (request.get_json(silent=True) or {}).get('action', 'snapshot')
+    if action not in ('start', 'snapshot', 'stop'):
+        return jsonify({'success': False, 'message': 'Invalid action'}), 400
+    if action == 'start' and not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        print("🔬 tracemalloc started")
+    report = get_memory_report()
+    if action == 'stop' and tracemalloc.is_tracing():
+        tracemalloc.stop()
+        print("🔬 tracemalloc stopped")
+    return jsonify({'success': True, 'memory': report})
+
+@app.route('/admin/profiler/download/<filename>')
+@admin_required
+def admin_profiler_download(filename):
+    """Download a .pstats, .collapsed, .txt or .tracemalloc file"""
+    return send_from_directory(os.path.abspath(PROFILE_FOLDER), filename, as_attachment=True)
+
 @app.route('/admin/stats')
 @admin_required
 def admin_stats():
     """Detailed statistics"""
-    with get_db() as conn:
+    with get_read_db() as conn:
         # Monthly appointments
         monthly_appointments = conn.execute('''
             SELECT strftime('%Y-%m', created_at) as month, 
@@ -863,29 +4545,76 @@ def admin_stats():
     return render_template('admin_stats.html',
                          monthly_appointments=monthly_appointments,
                          top_hospitals=top_hospitals,
-                         common_symptoms=common_symptoms)
+                         common_symptoms=common_symptoms,
+                         common_responses=get_top_responses())
 
 # ==================== CHATBOT API ROUTES ====================
 
 @app.route('/web-chat', methods=['POST'])
 def web_chat_reply():
     """Main chatbot API with COMPLETE emergency flow"""
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data, dict):
+        return jsonify({'reply': '❌ Invalid request'})
+
+    message = data.get('message', '')
+    session_id = data.get('session_id', 'web')
+    if not isinstance(message, str) or not isinstance(session_id, (str, int)):
+        return jsonify({'reply': '❌ Invalid request'})
+    user_message = message.strip().lower()
+    if not user_message:
+        return jsonify({'reply': '❌ Empty message'})
+
+    session_id = str(session_id)
+    # Client-generated id, resent unchanged when chat.html retries the request
+    request_id = str(data.get('request_id') or '')[:64] or None
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'reply': '❌ Invalid request'})
-            
-        user_message = data.get('message', '').strip().lower()
-        if not user_message:
-            return jsonify({'reply': '❌ Empty message'})
+        if traffic_recorder:
+            return jsonify({'reply': traffic_recorder.run_turn(session_id, user_message, request_id)})
+        return jsonify({'reply': process_chat_message(session_id, user_message, request_id)})
+    except Exception as e:
+        print(f"❌ Chat error: {e}")
+        return jsonify({'reply': '⚠️ System error. Please try again.'})
 
+CHAT_REPLY_CACHE_SIZE = 4
+# Turns carrying a request id run one at a time per session (striped, no lock per session)
+chat_turn_locks = [threading.Lock() for _ in range(64)]
+
+def process_chat_message(session_id, user_message, request_id=None):
+    """
+    Run one chat turn and return the reply. A client retry (same request_id)
+    gets the original reply back instead of advancing the state machine again.
+    """
+    if not request_id:
+        return run_chat_turn(session_id, user_message, request_id)
+    with chat_turn_locks[hash(session_id) % len(chat_turn_locks)]:
+        session_data = get_chat_session(session_id)
+        for previous_id, previous_reply in session_data.recent_replies or ():
+            if previous_id == request_id:
+                print(f"♻️ Retried request {request_id} - returning the original reply")
+                return previous_reply
+        reply = run_chat_turn(session_id, user_message, request_id)
+        session_data.recent_replies = ((session_data.recent_replies or [])[-(CHAT_REPLY_CACHE_SIZE - 1):]
+                                       + [(request_id, reply)])
+        return reply
+
+def run_chat_turn(session_id, user_message, request_id=None):
+    """Run one chat turn through the state machine and return the reply"""
+    lane_token = request_lane.set(chat_lane(get_chat_session(session_id).state))
+    try:
         # Get or create session
-        session_id = data.get('session_id', 'web')
-        session_data = user_sessions.get(session_id, {'state': 'main_menu'})
-        state = session_data.get('state')
+        session_data = get_chat_session(session_id)
+        state = session_data.state
         ai_response = ""
 
-        print(f"💬 [{state}] User: {user_message}")
+        print(f"💬 [{state.value}] User: {user_message}")
+
+        # Retry of a name submission that booked before a restart - answer with the original reply
+        if request_id and state in (ChatState.MAIN_MENU, ChatState.GET_PATIENT_NAME, ChatState.EMERGENCY_PATIENT_NAME):
+            previous_reply = get_idempotent_reply(session_id, request_id)
+            if previous_reply:
+                print(f"♻️ Retried request {request_id} - returning the original booking reply")
+                return previous_reply
 
         # === GLOBAL MENU HANDLER ===
         if user_message in ['menu', 'main menu', 'back', 'home', '0']:
@@ -899,14 +4628,13 @@ Aapka AI Health Saathi!
 5️⃣ 📞 Tele-Consultation
 
 👉 Type number (1-5):"""
-            session_data['state'] = 'main_menu'
-            user_sessions[session_id] = session_data
-            return jsonify({'reply': ai_response})
+            session_data.state = ChatState.MAIN_MENU
+            return ai_response
 
         # === STATE MACHINE ===
         
         # Main Menu State
-        if state == 'main_menu':
+        if state == ChatState.MAIN_MENU:
             if user_message in ['hi', 'hello', 'namaste', 'start', 'hey']:
                 ai_response = """नमस्ते! मैं *Sehat Saathi* 🩺  
 Aapka AI Health Saathi!  
@@ -918,7 +4646,7 @@ Aapka AI Health Saathi!
 5️⃣ 📞 Tele-Consultation
 
 👉 Type number (1-5):"""
-                session_data['state'] = 'main_menu'
+                session_data.state = ChatState.MAIN_MENU
 
             elif user_message == '1':
                 ai_response = """🚨 *EMERGENCY HELP*
@@ -934,27 +4662,27 @@ Aapka AI Health Saathi!
 • Type 'menu' for main menu
 
 👉 Type your choice:"""
-                session_data['state'] = 'emergency_help'
+                session_data.state = ChatState.EMERGENCY_HELP
 
             elif user_message == '2':
                 ai_response = "🩺 Please describe your health issue or symptoms:"
-                session_data['state'] = 'general_query'
+                session_data.state = ChatState.GENERAL_QUERY
 
             elif user_message == '3':
                 ai_response = "📅 Please enter your 6-digit pincode to find nearby hospitals:"
-                session_data['state'] = 'awaiting_pincode_for_appointment'
+                session_data.state = ChatState.AWAITING_PINCODE_FOR_APPOINTMENT
 
             elif user_message == '4':
                 ai_response = "🏥 Please enter pincode to find nearby hospitals and clinics:"
-                session_data['state'] = 'awaiting_pincode_for_hospital'
+                session_data.state = ChatState.AWAITING_PINCODE_FOR_HOSPITAL
 
             elif user_message == '5':
-                doctors = get_available_doctors()
+                doctor_ids, doctors = doctor_directory.active_listing()
                 if doctors:
-                    session_data['doctors'] = doctors
+                    session_data.doctor_ids = doctor_ids
                     text_doctors = "\n".join([f"{i+1}. {d['name']} ({d['specialization']}) - {d['fee']}" for i,d in enumerate(doctors)])
                     ai_response = f"📞 *Available Doctors:*\n{text_doctors}\n\nSelect doctor number:"
-                    session_data['state'] = 'tele_select'
+                    session_data.state = ChatState.TELE_SELECT
                 else:
                     ai_response = "❌ No doctors available currently."
 
@@ -962,13 +4690,13 @@ Aapka AI Health Saathi!
                 ai_response = "❌ Invalid option. Type 'menu' to see options."
 
         # Emergency Help State
-        elif state == 'emergency_help':
+        elif state == ChatState.EMERGENCY_HELP:
             if user_message == 'nearby':
                 ai_response = "📍 Please enter your 6-digit pincode to find nearby emergency services:"
-                session_data['state'] = 'awaiting_pincode_for_emergency'
+                session_data.state = ChatState.AWAITING_PINCODE_FOR_EMERGENCY
             elif user_message == 'appoint':
                 ai_response = "🚨 *EMERGENCY APPOINTMENT*\n📍 Please enter your pincode for immediate hospital booking:"
-                session_data['state'] = 'emergency_appoint_pincode'
+                session_data.state = ChatState.EMERGENCY_APPOINT_PINCODE
             else:
                 contacts = get_emergency_contacts()
                 contacts_text = "\n".join([f"• {details['number']} - {details['description']}" for _, details in contacts.items()])
@@ -984,7 +4712,7 @@ Aapka AI Health Saathi!
 👉 Type your choice:"""
 
         # Emergency Pincode for Nearby Services
-        elif state == 'awaiting_pincode_for_emergency':
+        elif state == ChatState.AWAITING_PINCODE_FOR_EMERGENCY:
             if user_message.isdigit() and len(user_message) == 6:
                 hospital_text, hospitals = get_real_hospitals_nearby(user_message)
                 
@@ -1004,16 +4732,16 @@ Aapka AI Health Saathi!
 • Describe your emergency"""
                 
                 ai_response = emergency_response
-                session_data['hospitals'] = hospitals
-                session_data['pincode'] = user_message
-                session_data['state'] = 'emergency_services_shown'
+                session_data.hospitals = hospitals
+                session_data.pincode = user_message
+                session_data.state = ChatState.EMERGENCY_SERVICES_SHOWN
             else:
                 ai_response = "⚠️ Please enter a valid 6-digit pincode for emergency services"
 
         # EMERGENCY SERVICES SHOWN STATE - FIXED
-        elif state == 'emergency_services_shown':
+        elif state == ChatState.EMERGENCY_SERVICES_SHOWN:
             if user_message == 'appoint':
-                hospitals = session_data.get('hospitals', [])
+                hospitals = session_data.hospitals or []
                 if hospitals:
                     hospitals_list = "\n".join([f"{i+1}. *{h['name']}* ({h['distance_km']} km)" for i, h in enumerate(hospitals)])
                     ai_response = f"""🚨 *EMERGENCY APPOINTMENT*
@@ -1021,7 +4749,7 @@ Aapka AI Health Saathi!
 {hospitals_list}
 
 👉 *Select hospital number (1-{len(hospitals)}) for emergency appointment:*"""
-                    session_data['state'] = 'emergency_hospital_select'
+                    session_data.state = ChatState.EMERGENCY_HOSPITAL_SELECT
                 else:
                     ai_response = "❌ No hospitals available. Please enter pincode again."
             elif user_message == 'menu':
@@ -1035,7 +4763,7 @@ Aapka AI Health Saathi!
 5️⃣ 📞 Tele-Consultation
 
 👉 Type number (1-5):"""
-                session_data['state'] = 'main_menu'
+                session_data.state = ChatState.MAIN_MENU
             else:
                 ai_response = """💡 *Options:*
 • Type 'appoint' for emergency appointment  
@@ -1043,14 +4771,14 @@ Aapka AI Health Saathi!
 • Or describe your emergency"""
 
         # Emergency Appointment Flow
-        elif state == 'emergency_appoint_pincode':
+        elif state == ChatState.EMERGENCY_APPOINT_PINCODE:
             if user_message.isdigit() and len(user_message) == 6:
                 hospital_text, hospitals = get_real_hospitals_nearby(user_message)
                 
                 if hospitals:
-                    session_data['pincode'] = user_message
-                    session_data['hospitals'] = hospitals
-                    session_data['state'] = 'emergency_hospital_select'
+                    session_data.pincode = user_message
+                    session_data.hospitals = hospitals
+                    session_data.state = ChatState.EMERGENCY_HOSPITAL_SELECT
                     
                     hospitals_list = "\n".join([f"{i+1}. *{h['name']}* ({h['distance_km']} km)" for i, h in enumerate(hospitals)])
                     ai_response = f"""🚨 *EMERGENCY HOSPITALS near {user_message}:*
@@ -1064,15 +4792,15 @@ Aapka AI Health Saathi!
                 ai_response = "⚠️ Please enter a valid 6-digit pincode"
 
         # Emergency Hospital Selection
-        elif state == 'emergency_hospital_select':
+        elif state == ChatState.EMERGENCY_HOSPITAL_SELECT:
             if user_message.isdigit():
                 hospital_index = int(user_message) - 1
-                hospitals = session_data.get('hospitals', [])
+                hospitals = session_data.hospitals or []
                 
                 if 0 <= hospital_index < len(hospitals):
                     selected_hospital = hospitals[hospital_index]
-                    session_data['selected_hospital'] = selected_hospital
-                    session_data['state'] = 'emergency_patient_name'
+                    session_data.hospital_index = hospital_index
+                    session_data.state = ChatState.EMERGENCY_PATIENT_NAME
                     
                     ai_response = f"""🚨 *EMERGENCY APPOINTMENT - {selected_hospital['name']}*
 
@@ -1088,17 +4816,19 @@ Aapka AI Health Saathi!
                 ai_response = "❌ Please enter a valid number"
 
         # Emergency Patient Name
-        elif state == 'emergency_patient_name':
+        elif state == ChatState.EMERGENCY_PATIENT_NAME:
             if user_message.strip():
                 patient_name = user_message.strip()
-                hospital = session_data.get('selected_hospital', {})
-                pincode = session_data.get('pincode', 'Unknown')
-                
-                # Create emergency appointment in database
-                appointment_id = create_emergency_appointment_direct(patient_name, hospital['name'], pincode)
+                hospital = session_data.selected_hospital()
+                pincode = (session_data.pincode or 'Unknown')
                 
-                if appointment_id:
-                    ai_response = f"""✅ *EMERGENCY APPOINTMENT CONFIRMED!*
+                # Create emergency appointment in database (once per client request)
+                patient_phone = (session_data.patient_phone or 'emergency_user')
+                emergency_slot = (datetime.now() + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M')
+                keys = booking_idempotency_keys(session_id, request_id)
+                appointment_id, ai_response, duplicate = create_booking(
+                    keys, patient_name, patient_phone, pincode, hospital['name'], 'Emergency', emergency_slot,
+                    lambda appointment_id: f"""✅ *EMERGENCY APPOINTMENT CONFIRMED!*
 
 🚨 ID: {appointment_id}
 👤 Patient: {patient_name}
@@ -1113,76 +4843,107 @@ Aapka AI Health Saathi!
 🚨 Ambulance dispatched if needed.
 
 💡 *Stay calm and follow instructions*
-Type 'menu' for main options"""
-                    
+Type 'menu' for main options""",
+                    priority='emergency', status='confirmed')
+
+                if appointment_id and duplicate:
+                    print(f"♻️ Duplicate emergency booking submission - returning appointment {appointment_id}")
+                elif appointment_id:
+                    notify_emergency_booking(appointment_id, patient_name, patient_phone, hospital['name'], pincode)
+
                     # Log emergency contact
                     log_emergency_contact('web_user', 'emergency_appointment', pincode, f"Appointment {appointment_id} created")
                 else:
                     ai_response = "❌ Error creating emergency appointment. Please call 108 directly."
                 
                 # Reset to main menu
-                session_data['state'] = 'main_menu'
-                session_data.pop('selected_hospital', None)
-                session_data.pop('pincode', None)
-                session_data.pop('hospitals', None)
+                session_data.state = ChatState.MAIN_MENU
+                session_data.clear_booking()
             else:
                 ai_response = "❌ Please enter a valid patient name:"
 
         # Health Query State
         # Health Query State - UPDATED WITH DYNAMIC AI RESPONSES
-        elif state == 'general_query':
+        elif state == ChatState.GENERAL_QUERY:
             if user_message == '4':
                 ai_response = "🏥 Please enter pincode to find nearby hospitals and clinics:"
-                session_data['state'] = 'awaiting_pincode_for_hospital'
+                session_data.state = ChatState.AWAITING_PINCODE_FOR_HOSPITAL
             else:
+                patient_phone = (session_data.patient_phone or 'web_user')
+                severity, emergency_type = triage_severity(user_message)
+                late_answer = None
+
+                if emergency_type:
+                    # Red flag - skip the LLM round trip and go to emergency help
+                    request_lane.set('emergency')
+                    instructions = "\n".join(get_emergency_instructions(emergency_type))
+                    ai_response = f"""🚨 *YE EMERGENCY HO SAKTI HAI!*
+
+🔴 *Turant karein:*
+• 📞 Call 108 for Ambulance
+• 📞 Call 112 for Any Emergency
+{instructions}
+
+💡 *Quick Options:*
+• Type 'nearby' to find emergency services
+• Type 'appoint' for emergency hospital appointment
+• Type 'menu' for main menu"""
+                    session_data.state = ChatState.EMERGENCY_HELP
+                    log_emergency_contact(patient_phone, emergency_type, (session_data.pincode or ''), 'Red-flag symptoms routed to emergency help')
+                    print(f"🚨 Triage red flag ({emergency_type}): {user_message}")
+                else:
         # Get conversation history for context
-                conversation_history = session_data.get('conversation_history', [])
+                    conversation = session_data.conversation
         
         # Get DYNAMIC AI response
-                ai_response = get_ai_health_response(user_message, conversation_history)
+                    late_answer = LateAnswer()
+                    ai_response, from_model = get_ai_health_response(user_message, conversation, late_answer)
         
-        # Add follow-up suggestion
-                if not any(word in user_message for word in ['menu', 'back', 'stop']):
-                 ai_response += "\n\n💡 You can ask more questions about this, type 'menu' for options, or describe other symptoms"
+        # Save conversation context (without the menu hint) - fallback advice is not part of the conversation
+                    if from_model:
+                        save_conversation_context(session_id, user_message, ai_response)
         
-        # Save conversation context
-                save_conversation_context(session_id, user_message, ai_response)
+        # Add follow-up suggestion
+                    if not any(word in user_message for word in ['menu', 'back', 'stop']):
+                     ai_response += "\n\n💡 You can ask more questions about this, type 'menu' for options, or describe other symptoms"
         
-        # Save to database for analytics
-                save_health_query('web_user', user_message, ai_response)
+        # Save to database for analytics - a late Gemini answer updates this row
+                query_id = save_health_query(patient_phone, user_message, ai_response, severity)
+                if late_answer:
+                    late_answer.attach(query_id)
 
         # Pincode for Appointment State
-        elif state == 'awaiting_pincode_for_appointment':
+        elif state == ChatState.AWAITING_PINCODE_FOR_APPOINTMENT:
             if user_message.isdigit() and len(user_message) == 6:
                 hospital_text, hospitals = get_real_hospitals_nearby(user_message)
                 ai_response = hospital_text
-                session_data['hospitals'] = hospitals
-                session_data['pincode'] = user_message
-                session_data['state'] = 'hospitals_shown'
+                session_data.hospitals = hospitals
+                session_data.pincode = user_message
+                session_data.state = ChatState.HOSPITALS_SHOWN
             else:
                 ai_response = "⚠️ Please enter a valid 6-digit pincode"
 
         # Hospitals Shown State
-        elif state == 'hospitals_shown':
+        elif state == ChatState.HOSPITALS_SHOWN:
             if user_message == 'appoint':
-                hospitals = session_data.get('hospitals', [])
+                hospitals = session_data.hospitals or []
                 if hospitals:
                     ai_response = "👉 Select hospital number (1-{}):".format(len(hospitals))
-                    session_data['state'] = 'hospitals_shown_for_appointment'
+                    session_data.state = ChatState.HOSPITALS_SHOWN_FOR_APPOINTMENT
                 else:
                     ai_response = "❌ No hospitals available. Please enter pincode again using option 3."
             else:
                 ai_response = "💡 *Options:*\n• Type 'appoint' to book appointment\n• Type 'menu' for main menu\n• Or enter pincode again using option 3"
 
         # Hospitals Shown for Appointment State
-        elif state == 'hospitals_shown_for_appointment':
+        elif state == ChatState.HOSPITALS_SHOWN_FOR_APPOINTMENT:
             if user_message.isdigit():
                 hospital_index = int(user_message) - 1
-                hospitals = session_data.get('hospitals', [])
+                hospitals = session_data.hospitals or []
                 
                 if 0 <= hospital_index < len(hospitals):
                     selected_hospital = hospitals[hospital_index]
-                    session_data['selected_hospital'] = selected_hospital
+                    session_data.hospital_index = hospital_index
                     
                     # Get available slots
                     slots = get_available_slots()
@@ -1194,22 +4955,22 @@ Available slots:
 {slots_text}
 
 👉 Select slot number (1-{len(slots)}):"""
-                        session_data['slots'] = slots
-                        session_data['state'] = 'select_slot'
+                        session_data.slots = slots
+                        session_data.state = ChatState.SELECT_SLOT
                     else:
                         ai_response = "❌ No available slots. Please try again later."
-                        session_data['state'] = 'main_menu'
+                        session_data.state = ChatState.MAIN_MENU
                 else:
                     ai_response = f"❌ Invalid hospital number. Please select 1-{len(hospitals)}"
             else:
                 ai_response = "❌ Please enter a valid number"
 
         # Slot Selection State
-        elif state == 'select_slot':
+        elif state == ChatState.SELECT_SLOT:
             if user_message.isdigit():
                 slot_index = int(user_message) - 1
-                slots = session_data.get('slots', [])
-                selected_hospital = session_data.get('selected_hospital', {})
+                slots = session_data.slots or ()
+                selected_hospital = session_data.selected_hospital()
                 
                 if 0 <= slot_index < len(slots):
                     selected_slot = slots[slot_index]
@@ -1220,43 +4981,34 @@ Available slots:
 📅 Slot: {selected_slot}
 
 Please enter patient's name:"""
-                    session_data['selected_slot'] = selected_slot
-                    session_data['state'] = 'get_patient_name'
+                    session_data.slot_index = slot_index
+                    session_data.state = ChatState.GET_PATIENT_NAME
                 else:
                     ai_response = f"❌ Invalid slot number. Please select 1-{len(slots)}"
             else:
                 ai_response = "❌ Please enter a valid number"
 
         # Get Patient Name State - DATABASE SAVE
-        elif state == 'get_patient_name':
+        elif state == ChatState.GET_PATIENT_NAME:
             if user_message.strip():
                 patient_name = user_message.strip()
-                selected_hospital = session_data.get('selected_hospital', {})
-                selected_slot = session_data.get('selected_slot', '')
+                selected_hospital = session_data.selected_hospital()
+                selected_slot = session_data.selected_slot()
                 
                 print(f"🔍 Attempting to save appointment for: {patient_name}")
                 
-                # Create patient and appointment in database
-                patient_id = create_patient(
-                    name=patient_name,
-                    pincode=session_data.get('pincode', ''),
-                    phone=session_data.get('patient_phone', 'web_user')
-                )
-                
-                if patient_id:
-                    appointment_id = create_appointment(
-                        patient_id=patient_id,
-                        hospital_name=selected_hospital.get('name', 'Unknown Hospital'),
-                        hospital_type=selected_hospital.get('type', 'hospital'),
-                        slot=selected_slot,
-                        pincode=session_data.get('pincode', ''),
-                        maps_link=selected_hospital.get('maps_link', ''),
-                        priority=session_data.get('priority', 'normal')
-                    )
-                    
-                    if appointment_id:
-                        # Confirmation message
-                        ai_response = f"""✅ *Appointment Booked Successfully!*
+                # Create patient and appointment in database (once per client request)
+                keys = booking_idempotency_keys(session_id, request_id)
+                appointment_id, ai_response, duplicate = create_booking(
+                    keys, patient_name,
+                    phone=(session_data.patient_phone or 'web_user'),
+                    pincode=(session_data.pincode or ''),
+                    hospital_name=selected_hospital.get('name', 'Unknown Hospital'),
+                    hospital_type=selected_hospital.get('type', 'hospital'),
+                    slot=selected_slot,
+                    maps_link=selected_hospital.get('maps_link', ''),
+                    priority='normal',
+                    confirmation=lambda appointment_id: f"""✅ *Appointment Booked Successfully!*
 
 📋 ID: {appointment_id}
 👤 Patient: {patient_name}
@@ -1268,31 +5020,38 @@ Please enter patient's name:"""
 📞 You'll receive confirmation via WhatsApp.
 
 Type 'menu' for main menu."""
-                        
-                        print(f"🎉 Appointment {appointment_id} saved successfully!")
-                    else:
-                        ai_response = "❌ Error saving appointment. Please try again."
+                )
+                
+                if appointment_id and duplicate:
+                    print(f"♻️ Duplicate booking submission - returning appointment {appointment_id}")
+                elif appointment_id:
+                    print(f"🎉 Appointment {appointment_id} saved successfully!")
+                    enqueue_notification(
+                        (session_data.patient_phone or 'web_user'),
+                        f"📋 Sehat Saathi: Appointment {appointment_id} at {selected_hospital.get('name', 'hospital')} "
+                        f"on {selected_slot} received. Status: Pending approval.",
+                        'appointment_created'
+                    )
                 else:
-                    ai_response = "❌ Error creating patient record. Please try again."
+                    ai_response = "❌ Error saving appointment. Please try again."
                 
                 # Reset to main menu
-                session_data['state'] = 'main_menu'
-                session_data.pop('selected_hospital', None)
-                session_data.pop('selected_slot', None)
-                session_data.pop('slots', None)
-                session_data.pop('hospitals', None)
-                session_data.pop('pincode', None)
+                session_data.state = ChatState.MAIN_MENU
+                session_data.clear_booking()
             else:
                 ai_response = "❌ Please enter a valid name"
 
         # Tele-Consultation Selection State
-        elif state == 'tele_select':
+        elif state == ChatState.TELE_SELECT:
             if user_message.isdigit():
                 doctor_index = int(user_message) - 1
-                doctors = session_data.get('doctors', [])
+                doctor_ids = session_data.doctor_ids or ()
+                selected_doctor = doctor_directory.get(doctor_ids[doctor_index]) if 0 <= doctor_index < len(doctor_ids) else None
                 
-                if 0 <= doctor_index < len(doctors):
-                    selected_doctor = doctors[doctor_index]
+                if 0 <= doctor_index < len(doctor_ids) and not selected_doctor:
+                    ai_response = "❌ This doctor is not available now. Type '5' from menu to see available doctors."
+                    session_data.state = ChatState.MAIN_MENU
+                elif selected_doctor:
                     ai_response = f"""📞 *Doctor Selected: {selected_doctor['name']}*
 
 💼 Specialization: {selected_doctor['specialization']}
@@ -1305,28 +5064,139 @@ Type 'menu' for main menu."""
 💡 *Click the link above to start consultation*
 
 Type 'menu' for main menu."""
-                    session_data['state'] = 'main_menu'
+                    session_data.state = ChatState.MAIN_MENU
                 else:
-                    ai_response = f"❌ Invalid doctor number. Please select 1-{len(doctors)}"
+                    ai_response = f"❌ Invalid doctor number. Please select 1-{len(doctor_ids)}"
             else:
                 ai_response = "❌ Please enter a valid number"
 
         # Pincode for Hospital Search State
-        elif state == 'awaiting_pincode_for_hospital':
+        elif state == ChatState.AWAITING_PINCODE_FOR_HOSPITAL:
             if user_message.isdigit() and len(user_message) == 6:
                 hospital_text, hospitals = get_real_hospitals_nearby(user_message)
                 ai_response = hospital_text
-                session_data['state'] = 'main_menu'
+                session_data.state = ChatState.MAIN_MENU
             else:
                 ai_response = "⚠️ Please enter a valid 6-digit pincode"
 
-        # Save session and return response
-        user_sessions[session_id] = session_data
-        return jsonify({'reply': ai_response})
+        return ai_response
 
     except Exception as e:
         print(f"❌ Chat error: {e}")
-        return jsonify({'reply': '⚠️ System error. Please try again.'})
+        return '⚠️ System error. Please try again.'
+    finally:
+        request_lane.reset(lane_token)
+
+@app.route('/api/upload-prescription-image', methods=['POST'])
+def upload_prescription_image():
+    """Prescription image upload (multipart 'file' field or raw image body)"""
+    try:
+        if 'file' in request.files:
+            stream = request.files['file'].stream
+        elif request.mimetype.startswith('image/'):
+            stream = request.stream
+        else:
+            return jsonify({'success': False, 'message': 'No file uploaded'}), 400
+
+        session_id = request.form.get('session_id') or request.args.get('session_id')
+        prescription_id, duplicate = save_prescription_upload(stream, session_id)
+
+        if duplicate:
+            analysis = f"📋 Ye prescription pehle se saved hai (ID: {prescription_id})."
+        else:
+            analysis = f"""✅ Prescription received! (ID: {prescription_id})
+📋 Our team will review it shortly.
+⚠️ Medicines sirf doctor ki salah se hi lein."""
+        return jsonify({'success': True, 'prescription_id': prescription_id,
+                        'duplicate': duplicate, 'analysis': analysis})
+
+    except UploadRejected as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status_code
+    except Exception as e:
+        print(f"❌ Prescription upload error: {e}")
+        return jsonify({'success': False, 'message': 'Upload error. Please try again.'}), 500
+
+@app.route('/api/facilities/batch', methods=['POST'])
+@admin_required
+def facilities_batch():
+    """Nearby facilities for many pincodes: {"pincodes": [...]} -> per-pincode results"""
+    data = request.get_json(silent=True) or {}
+    pincodes = data.get('pincodes')
+    if not isinstance(pincodes, list) or not pincodes:
+        return jsonify({'success': False, 'message': 'pincodes must be a non-empty list'}), 400
+    if len(pincodes) > FACILITY_BATCH_MAX:
+        return jsonify({'success': False, 'message': f'At most {FACILITY_BATCH_MAX} pincodes per request'}), 400
+
+    try:
+        results, summary = lookup_facilities_batch([str(pincode).strip() for pincode in pincodes])
+    except Exception as e:
+        print(f"❌ Batch facility lookup error: {e}")
+        return jsonify({'success': False, 'message': 'Lookup error. Please try again.'}), 500
+    return jsonify({'success': True, 'results': results, 'summary': summary})
+
+@app.route('/whatsapp/webhook', methods=['POST'])
+def whatsapp_webhook():
+    """Inbound WhatsApp webhook - store message and ack immediately"""
+    if TWILIO_ENABLED and not twilio_signature_valid(TWILIO_WEBHOOK_URL or request.url, request.form,
+                                                     request.headers.get('X-Twilio-Signature', '')):
+        print("🚫 WhatsApp webhook rejected: bad X-Twilio-Signature")
+        return jsonify({'error': 'Invalid signature'}), 403
+    message_id = request.form.get('MessageSid') or request.form.get('SmsMessageSid')
+    sender = request.form.get('From')
+    if not message_id or not sender:
+        return jsonify({'error': 'MessageSid and From are required'}), 400
+
+    if not enqueue_whatsapp_message(message_id, sender, request.form.get('Body', '')):
+        print(f"📱 Duplicate WhatsApp delivery ignored: {message_id}")
+    start_whatsapp_workers()
+    # Empty TwiML - the reply is sent by a worker
+    return '<Response></Response>', 200, {'Content-Type': 'text/xml'}
+
+@app.route('/api/voice-message', methods=['POST'])
+def voice_message():
+    """Voice note -> transcript -> chat reply (multipart 'audio' field or raw audio body)"""
+    try:
+        start = time.monotonic()
+        if 'audio' in request.files:
+            upload = request.files['audio']
+            stream, mime_type = upload.stream, upload.mimetype
+        elif request.mimetype.startswith('audio/'):
+            stream, mime_type = request.stream, request.mimetype
+        else:
+            return jsonify({'success': False, 'message': 'No audio uploaded'}), 400
+        if not mime_type or mime_type == 'application/octet-stream':
+            mime_type = 'audio/ogg'
+
+        session_id = request.form.get('session_id') or request.args.get('session_id', 'web')
+        audio_bytes = read_voice_upload(stream, VOICE_MAX_BYTES)
+        if not audio_bytes:
+            return jsonify({'success': False, 'message': 'Empty voice note'}), 400
+        received = time.monotonic()
+
+        transcript, timings = transcribe_voice_message(audio_bytes, mime_type)
+        transcribed = time.monotonic()
+
+        user_message = transcript.strip().lower()
+        reply = process_chat_message(session_id, user_message) if user_message else "❌ Voice note samajh nahi aaya. Please dobara bolein ya type karein."
+
+        timings['receive_ms'] = round((received - start) * 1000, 1)
+        timings['chat_ms'] = round((time.monotonic() - transcribed) * 1000, 1)
+        timings['total_ms'] = round((time.monotonic() - start) * 1000, 1)
+        record_voice_timings(timings)
+        print(f"🎙️ Voice [{session_id}] '{user_message}' in {timings['total_ms']}ms")
+
+        return jsonify({'success': True, 'transcript': transcript, 'reply': reply, 'timings': timings})
+
+    except UploadRejected as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status_code
+    except Exception as e:
+        print(f"❌ Voice message error: {e}")
+        return jsonify({'success': False, 'message': 'Voice processing error. Please type your message.'}), 500
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """Upload bigger than MAX_CONTENT_LENGTH"""
+    return jsonify({'success': False, 'message': 'File too large! Max 16MB'}), 413
 
 # ==================== DEBUG ROUTES ====================
 
@@ -1414,7 +5284,10 @@ if __name__ == '__main__':
     print("📊 Admin Features: Patients, Appointments, Doctors, Analytics")
     print("🐛 Debug: http://127.0.0.1:5000/debug/database")
     print("🧪 Test: http://127.0.0.1:5000/debug/test-appointment")
-    print("📱 Twilio: DISABLED (Simulation Mode)")
+    print("📱 Twilio: " + ("ENABLED" if TWILIO_ENABLED else "DISABLED (Simulation Mode)"))
+    start_whatsapp_workers()
+    start_notification_dispatcher()
+    start_background_jobs()
     print("🔍 Gemini AI: " + ("✅ ENABLED" if GEMINI_AVAILABLE else "⚠️ DISABLED"))
     print("🚨 EMERGENCY FLOW: COMPLETELY FIXED!")
     print("💡 Emergency Test Sequence:")
@@ -0,0 +1,72 @@
+# bench_priority_lanes.py - Emergency wait time under routine LLM overload
+# Compares one shared FIFO queue (before) with priority lanes and reserved emergency capacity.
+# Run from project root: python data/bench_priority_lanes.py [--seconds 5] [--routine-clients 40]
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import PriorityScheduler
+
+def routine_client(scheduler, lane, work_s, stop):
+    """Keeps submitting slow routine (Gemini-like) calls"""
+    while not stop.is_set():
+        with scheduler.slot(lane):
+            time.sleep(work_s)
+
+def emergency_client(scheduler, lane, work_s, interval_s, stop, waits):
+    """Submits a short emergency lookup every interval and records its queue wait"""
+    while not stop.is_set():
+        start = time.monotonic()
+        with scheduler.slot(lane):
+            waits.append((time.monotonic() - start) * 1000)
+            time.sleep(work_s)
+        time.sleep(interval_s)
+
+def run(label, capacity, reserved, fifo, args):
+    scheduler = PriorityScheduler('bench', capacity, reserved)
+    stop = threading.Event()
+    waits = []
+    emergency_lane = 'routine' if fifo else 'emergency'
+    threads = [threading.Thread(target=routine_client, args=(scheduler, 'routine', args.routine_ms / 1000, stop))
+               for _ in range(args.routine_clients)]
+    threads += [threading.Thread(target=emergency_client, args=(scheduler, emergency_lane, args.emergency_ms / 1000,
+                                                               args.interval_ms / 1000, stop, waits))
+                for _ in range(args.emergency_clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    ordered = sorted(waits) or [0.0]
+    p = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+    routine = scheduler.snapshot()['lanes']['routine']['completed'] - (len(waits) if fifo else 0)
+    print(f"{label:<30}{p(0.5):>9.1f}{p(0.95):>9.1f}{ordered[-1]:>9.1f}{len(waits):>8}{routine:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Emergency queue wait with and without priority lanes')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--capacity', type=int, default=8, help='Concurrent upstream calls')
+    parser.add_argument('--reserved', type=int, default=2, help='Slots reserved for emergencies')
+    parser.add_argument('--routine-clients', type=int, default=40)
+    parser.add_argument('--routine-ms', type=float, default=300, help='Routine call duration')
+    parser.add_argument('--emergency-clients', type=int, default=4)
+    parser.add_argument('--emergency-ms', type=float, default=50, help='Emergency call duration')
+    parser.add_argument('--interval-ms', type=float, default=100, help='Pause between emergency calls')
+    args = parser.parse_args()
+
+    print(f"📊 EMERGENCY QUEUE WAIT - {args.routine_clients} routine clients, capacity {args.capacity} (ms)")
+    print("-" * 73)
+    print(f"{'setup':<30}{'p50':>9}{'p95':>9}{'max':>9}{'calls':>8}{'routine':>9}")
+    run('shared FIFO (before)', args.capacity, 0, True, args)
+    run('priority lanes', args.capacity, 0, False, args)
+    run(f'priority + {args.reserved} reserved', args.capacity, args.reserved, False, args)
+
+if __name__ == '__main__':
+    main()
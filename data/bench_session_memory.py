@@ -0,0 +1,93 @@
+# bench_session_memory.py - Bytes per chat session, old dict layout vs ChatSession
+# Run from project root: python data/bench_session_memory.py [--sessions 100000]
+
+import os
+import sys
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import ChatSession, ChatState, ConversationContext
+
+HOSPITALS = [{
+    'name': f'Government Hospital {i}', 'type': 'hospital', 'lat': 26.9 + i / 100, 'lon': 75.8 + i / 100,
+    'distance_km': round(1.5 * i, 1), 'maps_link': f'https://www.google.com/maps?q={26.9 + i / 100},{75.8 + i / 100}'
+} for i in range(15)]
+DOCTORS = [{
+    'id': i, 'name': f'Dr. Doctor {i}', 'specialization': 'General Physician', 'fee': 'Free',
+    'contact': '+91-9876543210', 'online_link': 'https://wa.me/919876543210', 'languages': 'Hindi,English',
+    'status': 'active', 'experience_years': 10, 'rating': 4.5
+} for i in range(1, 11)]
+SLOT_HOURS = ['2025-01-06 10:00', '2025-01-06 12:00', '2025-01-06 14:00', '2025-01-06 16:00',
+              '2025-01-07 10:00', '2025-01-07 12:00', '2025-01-07 14:00', '2025-01-07 16:00']
+CONVERSATION = [("sir dard ho raha hai", "🤕 Sir dard hai? Ye practical solutions try karein:\n• Thandi patti se matha ponche"),
+                ("aur kya karu", "• Andhere room mein aaram karein\n⚠️ Agar dard na jaye, doctor ko dikhayein")]
+SCENARIOS = ['menu', 'booking', 'tele', 'health_query']
+
+def old_session(i, scenario):
+    """Session dict as the chat flow used to build it (fresh copies per request)"""
+    pincode = str(302000 + i % 50)
+    session = {'state': 'main_menu'}
+    if scenario == 'booking':
+        hospitals = [dict(h) for h in HOSPITALS]
+        session.update(state='select_slot', pincode=pincode, hospitals=hospitals, selected_hospital=hospitals[1],
+                       slots=[''.join(slot) for slot in SLOT_HOURS])
+    elif scenario == 'tele':
+        session.update(state='tele_select', doctors=[dict(d) for d in DOCTORS])
+    elif scenario == 'health_query':
+        history = []
+        for user_message, ai_response in CONVERSATION:
+            history += [f"User: {user_message}", f"Assistant: {ai_response}"]
+        session.update(state='general_query', conversation_history=history)
+    return session
+
+def new_session(i, scenario, shared):
+    """ChatSession referencing shared hospital/slot/doctor objects"""
+    session = ChatSession()
+    if scenario == 'booking':
+        session.state = ChatState.SELECT_SLOT
+        session.pincode = str(302000 + i % 50)
+        session.hospitals, session.hospital_index = shared['hospitals'], 1
+        session.slots = shared['slots']
+    elif scenario == 'tele':
+        session.state, session.doctor_ids = ChatState.TELE_SELECT, shared['doctor_ids']
+    elif scenario == 'health_query':
+        session.state = ChatState.GENERAL_QUERY
+        session.conversation = ConversationContext()
+        for user_message, ai_response in CONVERSATION:
+            session.conversation.add_turn(user_message, ai_response)
+    return session
+
+def measure(build, count):
+    """Average traced bytes per session, overall and per scenario"""
+    results = {}
+    for scenario in SCENARIOS + ['mix']:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        sessions = {f'user_{i}': build(i, SCENARIOS[i % len(SCENARIOS)] if scenario == 'mix' else scenario)
+                    for i in range(count)}
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del sessions
+        results[scenario] = used / count
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory per simulated chat session')
+    parser.add_argument('--sessions', type=int, default=100000)
+    args = parser.parse_args()
+
+    shared = {'hospitals': list(HOSPITALS), 'slots': tuple(SLOT_HOURS), 'doctor_ids': tuple(d['id'] for d in DOCTORS)}
+    before = measure(old_session, args.sessions)
+    after = measure(lambda i, scenario: new_session(i, scenario, shared), args.sessions)
+
+    print(f"📊 SESSION MEMORY - {args.sessions} sessions (bytes per session, incl. session id key)")
+    print("-" * 50)
+    print(f"{'scenario':<15}{'before':>10}{'after':>10}{'saved':>10}")
+    for scenario in SCENARIOS + ['mix']:
+        saved = 1 - after[scenario] / before[scenario]
+        print(f"{scenario:<15}{before[scenario]:>10.0f}{after[scenario]:>10.0f}{saved:>10.0%}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# bench_write_latency.py - Booking write latency while an analytics report runs
+# Compares the old setup (rollback journal, reports on normal connections)
+# with WAL + read-only snapshot connections used by the admin/analytics pages.
+# Run: python data/bench_write_latency.py [--rows 200000] [--writes 300]
+
+import os
+import time
+import random
+import sqlite3
+import tempfile
+import argparse
+import threading
+from pathlib import Path
+
+REPORT_QUERY = '''
+    SELECT a.hospital_name, strftime('%Y-%m', a.created_at) AS month, COUNT(*), COUNT(DISTINCT p.phone)
+    FROM appointments a LEFT JOIN patients p ON a.patient_id = p.id
+    GROUP BY a.hospital_name, month
+    ORDER BY COUNT(*) DESC
+'''
+
+def seed_database(path, rows, journal_mode):
+    """Create a test database with `rows` appointments"""
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA journal_mode={journal_mode}')
+    conn.executescript('''
+        CREATE TABLE patients (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, phone TEXT, pincode TEXT,
+                               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE appointments (id INTEGER PRIMARY KEY AUTOINCREMENT, patient_id INTEGER, hospital_name TEXT,
+                                   slot TEXT, status TEXT DEFAULT 'pending', pincode TEXT,
+                                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    ''')
+    rng = random.Random(42)
+    conn.executemany('INSERT INTO patients (name, phone, pincode) VALUES (?, ?, ?)',
+                     ((f'Patient {i}', f'98{rng.randint(10000000, 99999999)}', '302004') for i in range(rows)))
+    conn.executemany('INSERT INTO appointments (patient_id, hospital_name, slot, pincode, created_at) VALUES (?, ?, ?, ?, ?)',
+                     ((i + 1, f'Hospital {rng.randint(1, 300)}', '10:00 AM', '302004',
+                       f'2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 10:00:00') for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+def run_reports(path, snapshot, stop):
+    """Keep running the heavy report until stopped"""
+    runs = 0
+    while not stop.is_set():
+        if snapshot:
+            conn = sqlite3.connect(Path(path).as_uri() + '?mode=ro', uri=True, isolation_level=None)
+            conn.execute('BEGIN')
+        else:
+            conn = sqlite3.connect(path)
+            # Old behaviour: report holds a shared lock for the whole read
+            conn.execute('BEGIN')
+        conn.execute(REPORT_QUERY).fetchall()
+        conn.execute('ROLLBACK')
+        conn.close()
+        runs += 1
+    return runs
+
+def run_writes(path, writes, timeout, synchronous):
+    """Time booking-style writes, returns (latencies_ms, locked_errors)"""
+    latencies, locked = [], 0
+    for i in range(writes):
+        start = time.monotonic()
+        try:
+            conn = sqlite3.connect(path, timeout=timeout)
+            conn.execute(f'PRAGMA synchronous={synchronous}')
+            cursor = conn.execute('INSERT INTO patients (name, phone, pincode) VALUES (?, ?, ?)', (f'Bench {i}', '9000000000', '302004'))
+            conn.execute('INSERT INTO appointments (patient_id, hospital_name, slot, pincode) VALUES (?, ?, ?, ?)',
+                         (cursor.lastrowid, 'Bench Hospital', '10:00 AM', '302004'))
+            conn.commit()
+            conn.close()
+            latencies.append((time.monotonic() - start) * 1000)
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+        time.sleep(0.005)
+    return latencies, locked
+
+def summarize(label, latencies, locked, reports):
+    ordered = sorted(latencies) or [0.0]
+    p = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+    print(f"{label:<28}{p(0.5):>9.1f}{p(0.95):>9.1f}{ordered[-1]:>10.1f}{locked:>8}{reports:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure write latency while reports run')
+    parser.add_argument('--rows', type=int, default=200000, help='Seed appointments')
+    parser.add_argument('--writes', type=int, default=300, help='Timed booking writes')
+    parser.add_argument('--timeout', type=float, default=2.0, help='sqlite busy timeout (s)')
+    args = parser.parse_args()
+
+    print(f"📊 WRITE LATENCY DURING REPORTS - {args.rows} rows, {args.writes} writes (ms)")
+    print("-" * 72)
+    print(f"{'setup':<28}{'p50':>9}{'p95':>9}{'max':>10}{'locked':>8}{'reports':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, journal_mode, snapshot, synchronous in [
+            ('rollback journal (before)', 'DELETE', False, 'FULL'),
+            ('WAL + snapshot reads', 'WAL', True, 'NORMAL'),
+        ]:
+            path = os.path.join(tmp, f'{journal_mode.lower()}.db')
+            seed_database(path, args.rows, journal_mode)
+            stop = threading.Event()
+            result = {}
+            reporter = threading.Thread(target=lambda: result.update(runs=run_reports(path, snapshot, stop)))
+            reporter.start()
+            time.sleep(0.2)
+            latencies, locked = run_writes(path, args.writes, args.timeout, synchronous)
+            stop.set()
+            reporter.join()
+            summarize(label, latencies, locked, result.get('runs', 0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# evaluate_triage.py - Offline precision/recall report for the local triage classifier
+# Needs hand-labeled messages (not health_queries.severity, which triage itself wrote).
+# Run from project root: python data/evaluate_triage.py --labels labels.jsonl [--test-labels heldout.jsonl]
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import TRIAGE_LABELS, TriageClassifier, triage_severity, load_triage_examples
+
+def split_examples(examples, holdout, seed):
+    """Shuffle and split into train / test"""
+    examples = list(examples)
+    random.Random(seed).shuffle(examples)
+    cut = int(len(examples) * (1 - holdout))
+    return examples[:cut], examples[cut:]
+
+def evaluate(classifier, examples):
+    """Per-label precision/recall plus scoring latency"""
+    counts = {label: {'tp': 0, 'fp': 0, 'fn': 0} for label in TRIAGE_LABELS}
+    start = time.perf_counter()
+    for text, expected in examples:
+        predicted, _ = triage_severity(text, classifier)
+        if predicted == expected:
+            counts[expected]['tp'] += 1
+        else:
+            counts[predicted]['fp'] += 1
+            if expected in counts:
+                counts[expected]['fn'] += 1
+    elapsed = time.perf_counter() - start
+    return counts, elapsed / max(len(examples), 1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the triage classifier on a held-out split')
+    parser.add_argument('--labels', required=True, help='Hand-labeled JSONL file of {"text": ..., "severity": ...}')
+    parser.add_argument('--test-labels', help='Separately labeled held-out JSONL (otherwise split --labels)')
+    parser.add_argument('--holdout', type=float, default=0.2, help='Fraction kept for testing without --test-labels')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    examples = [(text, label) for text, label in load_triage_examples(args.labels) if label in TRIAGE_LABELS]
+    if args.test_labels:
+        train = examples
+        test = [(text, label) for text, label in load_triage_examples(args.test_labels) if label in TRIAGE_LABELS]
+    else:
+        train, test = split_examples(examples, args.holdout, args.seed)
+    if not test:
+        print("❌ Not enough labeled examples to evaluate")
+        return
+
+    classifier = TriageClassifier()
+    classifier.train(train, epochs=args.epochs, seed=args.seed)
+    counts, per_message = evaluate(classifier, test)
+
+    print(f"📊 TRIAGE EVALUATION - train {len(train)}, test {len(test)}")
+    print("-" * 50)
+    print(f"{'severity':<10}{'precision':>11}{'recall':>9}{'f1':>8}{'support':>9}")
+    for label in TRIAGE_LABELS:
+        c = counts[label]
+        precision = c['tp'] / (c['tp'] + c['fp']) if c['tp'] + c['fp'] else 0.0
+        recall = c['tp'] / (c['tp'] + c['fn']) if c['tp'] + c['fn'] else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        print(f"{label:<10}{precision:>11.3f}{recall:>9.3f}{f1:>8.3f}{c['tp'] + c['fn']:>9}")
+    print(f"\n⏱️ Average triage time: {per_message * 1e6:.1f} µs per message")
+
+if __name__ == '__main__':
+    main()
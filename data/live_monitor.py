@@ -1,44 +1,61 @@
 # live_monitor.py - Ye alag file bana lo
 
-import sqlite3
+import os
+import json
 import time
+import requests
 from datetime import datetime
 
+SERVER_URL = os.getenv("SEHAT_URL", "http://127.0.0.1:5000")
+ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "admin")
+ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "sehat123")
+
+def print_change(change):
+    """Print one pushed change"""
+    row = change.get('row') or {}
+    stamp = datetime.now().strftime('%H:%M:%S')
+    if change['table'] == 'appointments':
+        if change['op'] == 'insert':
+            print(f"🆕 [{stamp}] Appointment {change['row_id']}: {row.get('patient_name')} - {row.get('hospital_name')} ({row.get('status')})")
+        elif change['op'] == 'update':
+            print(f"🔄 [{stamp}] Appointment {change['row_id']}: {change.get('old_status')} -> {change.get('new_status')}")
+        else:
+            print(f"🗑️ [{stamp}] Appointment {change['row_id']} deleted")
+    elif change['table'] == 'patients' and change['op'] == 'insert':
+        print(f"👥 [{stamp}] New patient {change['row_id']}: {row.get('name')}")
+    elif change['table'] == 'health_queries' and change['op'] == 'insert':
+        print(f"🩺 [{stamp}] Health query: {row.get('symptoms')}")
+    elif change['table'] == 'emergency_contacts' and change['op'] == 'insert':
+        print(f"🚨 [{stamp}] Emergency: {row.get('emergency_type')} at {row.get('pincode')}")
+    else:
+        print(f"📝 [{stamp}] {change['table']} {change['row_id']} {change['op']}")
+
 def live_monitor():
+    """Subscribe to the server's change feed instead of polling the database"""
+    http = requests.Session()
+    http.post(f"{SERVER_URL}/admin/login", data={'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD})
+
+    health = http.get(f"{SERVER_URL}/health").json()
+    print(f"🕒 Live Database Monitor - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print("=" * 60)
+    print(f"👥 Patients: {health['services']['patients']}")
+    print(f"📅 Total Appointments: {health['services']['appointments']}")
+    print("=" * 60)
+    print("📡 Waiting for changes... (Ctrl+C to stop)\n")
+
+    last_event_id = None
     while True:
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print(f"🕒 Live Database Monitor - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("=" * 60)
-        
-        conn = sqlite3.connect('data/sehat_saathi.db')
-        
-        # Real-time counts
-        patients = conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
-        appointments = conn.execute("SELECT COUNT(*) FROM appointments").fetchone()[0]
-        pending = conn.execute("SELECT COUNT(*) FROM appointments WHERE status='pending'").fetchone()[0]
-        confirmed = conn.execute("SELECT COUNT(*) FROM appointments WHERE status='confirmed'").fetchone()[0]
-        queries = conn.execute("SELECT COUNT(*) FROM health_queries").fetchone()[0]
-        
-        print(f"👥 Patients: {patients}")
-        print(f"📅 Total Appointments: {appointments}")
-        print(f"⏳ Pending: {pending} | ✅ Confirmed: {confirmed}")
-        print(f"🩺 Health Queries: {queries}")
-        
-        # Recent appointments
-        print(f"\n🆕 Recent Appointments:")
-        recent = conn.execute('''
-            SELECT a.id, p.name, a.hospital_name, a.status, a.created_at 
-            FROM appointments a 
-            JOIN patients p ON a.patient_id = p.id 
-            ORDER BY a.created_at DESC LIMIT 5
-        ''').fetchall()
-        
-        for apt in recent:
-            print(f"  {apt[0]}: {apt[1]} - {apt[2]} ({apt[3]}) - {apt[4]}")
-        
-        conn.close()
-        print(f"\n🔄 Refreshing in 10 seconds... (Ctrl+C to stop)")
-        time.sleep(10)
+        headers = {'Last-Event-ID': last_event_id} if last_event_id else {}
+        try:
+            with http.get(f"{SERVER_URL}/admin/changes", headers=headers, stream=True, timeout=60) as resp:
+                for line in resp.iter_lines(decode_unicode=True):
+                    if line.startswith('id: '):
+                        last_event_id = line[4:]
+                    elif line.startswith('data: '):
+                        print_change(json.loads(line[6:]))
+        except requests.RequestException as e:
+            print(f"⚠️ Connection lost ({e}), reconnecting...")
+            time.sleep(3)
 
 if __name__ == '__main__':
-    live_monitor()
\ No newline at end of file
+    live_monitor()
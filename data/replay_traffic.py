@@ -0,0 +1,117 @@
+# replay_traffic.py - Re-drive captured /web-chat conversations with recorded upstreams
+# Capture first: TRAFFIC_CAPTURE_PATH=data/captures/traffic.jsonl python app.py
+# Run from project root: python data/replay_traffic.py data/captures/traffic.jsonl [--speed 10]
+# Against a running build: start it with TRAFFIC_REPLAY_PATH=<capture>, then pass --url http://host:5000
+# Captures mask phones, e-mails and names, but health-query free text is kept verbatim - handle them as patient data
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as sehat
+
+def group_sessions(turns):
+    """Captured turns per session, in order"""
+    sessions = {}
+    for turn in turns:
+        sessions.setdefault(turn['session'], []).append(turn)
+    return list(sessions.values())
+
+def make_sender(url):
+    """Function posting one chat message, in-process or over HTTP"""
+    if url:
+        import requests
+        http = requests.Session()
+        return lambda session_id, message: http.post(f"{url.rstrip('/')}/web-chat", json={
+            'session_id': session_id, 'message': message}, timeout=60).json()['reply']
+
+    local = threading.local()
+
+    def send(session_id, message):
+        if not hasattr(local, 'client'):
+            local.client = sehat.app.test_client()
+        return local.client.post('/web-chat', json={'session_id': session_id, 'message': message}).get_json()['reply']
+    return send
+
+def replay_session(turns, send, started, speed, run_id, results):
+    """Send one session's turns in order, paced by their capture offsets"""
+    session_id = f"replay-{run_id}-{turns[0]['session']}"
+    for turn in turns:
+        if speed > 0:
+            delay = started + turn['offset_s'] / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        start = time.monotonic()
+        try:
+            reply = send(session_id, turn['message'])
+        except Exception as e:
+            results.append((None, turn, str(e)))
+            continue
+        results.append(((time.monotonic() - start) * 1000, turn, reply))
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a traffic capture and report latency')
+    parser.add_argument('capture', help='JSONL file written with TRAFFIC_CAPTURE_PATH')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 = original pacing, 10 = 10x faster, 0 = no pacing')
+    parser.add_argument('--url', help='Drive a running server instead of this build in-process')
+    parser.add_argument('--workers', type=int, default=32, help='Sessions replayed concurrently')
+    parser.add_argument('--no-upstream-latency', action='store_true', help='Serve recorded upstreams instantly')
+    args = parser.parse_args()
+
+    turns, upstreams = sehat.load_traffic_capture(args.capture)
+    if not turns:
+        print(f"❌ No chat turns in {args.capture}")
+        return
+    if turns[0]['offset_s']:
+        base = turns[0]['offset_s']
+        for turn in turns:
+            turn['offset_s'] -= base
+
+    if not args.url:
+        # Fresh database and in-memory state, upstreams from the capture
+        tmp = tempfile.mkdtemp(prefix='sehat_replay_')
+        sehat.app.config['DATABASE'] = os.path.join(tmp, 'replay.db')
+        sehat.init_db()
+        sehat.traffic_recorder = None
+        sehat.traffic_replay = sehat.TrafficReplay(args.capture, speed=args.speed or 1.0,
+                                                   upstream_latency=not args.no_upstream_latency)
+
+    sessions = group_sessions(turns)
+    send = make_sender(args.url)
+    results = []
+    run_id = int(time.time())
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for session_turns in sessions:
+            executor.submit(replay_session, session_turns, send, started, args.speed, run_id, results)
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(latency for latency, _, _ in results if latency is not None)
+    errors = sum(1 for latency, _, _ in results if latency is None)
+    changed = sum(1 for latency, turn, reply in results if latency is not None and reply != turn['reply'])
+    recorded = sorted(turn['latency_ms'] for turn in turns)
+
+    print(f"📊 TRAFFIC REPLAY - {len(turns)} turns, {len(sessions)} sessions, {len(upstreams)} upstream responses, speed {args.speed:g}x")
+    print("-" * 60)
+    print(f"{'':<12}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)")
+    print(f"{'captured':<12}{percentile(recorded, 0.5):>10.1f}{percentile(recorded, 0.95):>10.1f}"
+          f"{percentile(recorded, 0.99):>10.1f}{recorded[-1]:>10.1f}")
+    if latencies:
+        print(f"{'replayed':<12}{percentile(latencies, 0.5):>10.1f}{percentile(latencies, 0.95):>10.1f}"
+              f"{percentile(latencies, 0.99):>10.1f}{latencies[-1]:>10.1f}")
+    print(f"\n⏱️ {len(results)} turns in {elapsed:.1f}s ({len(results) / elapsed:.1f} turns/s), {errors} errors")
+    print(f"🔀 {changed} replies differ from the capture")
+    if not args.url:
+        print(f"🔁 Upstreams served from capture: {sehat.traffic_replay.served}, missing: {sehat.traffic_replay.misses}")
+
+if __name__ == '__main__':
+    main()
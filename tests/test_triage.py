@@ -0,0 +1,52 @@
+# Red-flag triage rules: real emergencies must flag, everyday messages must not
+# Run from project root: python -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from triage_rules import find_red_flag
+
+@pytest.mark.parametrize('text', [
+    "food poisoning ho gaya",
+    "accidentally cut my finger",
+    "fits aane ki dawai chal rahi hai",
+    "mirgi ki dawai kab leni hai",
+    "no chest pain, bas khansi hai",
+    "mujhe seizure nahi hai",
+    "heat stroke se kaise bache",
+    "zeher jaisa kadwa lagta hai",
+    "sir dard ho raha hai",
+    "bukhar aur khansi hai",
+])
+def test_everyday_messages_are_not_red_flags(text):
+    assert find_red_flag(text) is None
+
+@pytest.mark.parametrize('text, emergency_type', [
+    ("papa ko chest pain ho raha hai", 'heart_attack'),
+    ("seene me dard aur pasina", 'heart_attack'),
+    ("saans nahi aa rahi", 'breathing'),
+    ("dadi behosh ho gayi", 'unconscious'),
+    ("bache ko fits aa rahe hain", 'seizure'),
+    ("papa ko lakwa maar gaya", 'stroke'),
+    ("khoon nahi ruk raha", 'bleeding'),
+    ("bache ne zeher kha liya", 'poisoning'),
+    ("he swallowed poison", 'poisoning'),
+    ("khet mein saanp ne kaat liya", 'poisoning'),
+    ("road accident ho gaya", 'accident'),
+    ("papa ko chest pain ho raha hai, koi medicine batao", 'heart_attack'),
+    ("bache ne zeher kha liya tablet do", 'poisoning'),
+    ("snake bite hua medicine batao", 'poisoning'),
+    ("saans nahi aa rahi, pehle bhi hua tha", 'breathing'),
+    ("not sure but chest pain", 'heart_attack'),
+])
+def test_emergencies_are_red_flags(text, emergency_type):
+    assert find_red_flag(text) == emergency_type
+
+def test_red_flag_is_high_severity():
+    pytest.importorskip('flask')
+    from app import triage_severity
+    assert triage_severity("road accident ho gaya") == ('high', 'accident')
@@ -0,0 +1,36 @@
+# triage_rules.py - Red-flag symptom rules for chat triage
+# Kept free of Flask/Gemini imports so tests can run without the app's dependencies.
+
+import re
+
+# Red-flag symptoms go straight to emergency help (emergency_type, pattern)
+TRIAGE_RED_FLAGS = [
+    ('heart_attack', re.compile(r"\bchest pain\b|\bheart attack\b|\bdil ka daura\b|\bseen[ae] (mein|me|main) (dard|dabav)\b|\bchhati (mein|me) dard\b")),
+    ('breathing', re.compile(r"\bcan'?t breathe\b|\bcannot breathe\b|\bnot breathing\b|\bsaa?ns? (nahi|nhi|na) (aa|le|ho)|\bdam ghut")),
+    ('unconscious', re.compile(r"\bunconscious\b|\bbehosh\b|\bfaint(ed)? and not\b|\bhosh (nahi|nhi)\b")),
+    ('seizure', re.compile(r"\bseizures?\b|\bconvulsions?\b|\bmirgi\b|\bfits? (aa|pad)")),
+    ('stroke', re.compile(r"(?<!heat )(?<!sun )\bstroke\b(?! of luck)|\blakwa\b|\bparaly[sz]|\bface droop|\bmuh tedha\b")),
+    ('bleeding', re.compile(r"\bheavy bleeding\b|\bbleeding (a lot|heavily|nahi ruk)|\bbahut khoon\b|\bkhoon (nahi ruk|beh)")),
+    # Swallowed/bitten only - "food poisoning" is a routine query
+    ('poisoning', re.compile(r"\b(poison|zeh?er|pesticide|keetnashak)\b.{0,20}\b(kha|khaya|khai|khali|pi|piya|pee|li|liya|swallow(ed)?|drank|ate)\b"
+                             r"|\b(ate|drank|swallowed)\b.{0,20}\b(poison|pesticide)\b|(?<!food )\bpoisoned\b"
+                             r"|\bsnake ?bite\b|\bsaa?np (ne )?kaat")),
+    ('accident', re.compile(r"\baccident\b|\bdurghatna\b|\bhead injury\b|\bsir (par|pe) chot\b")),
+    ('self_harm', re.compile(r"\bsuicide\b|\bkill myself\b|\bkhudkushi\b|\bjaan de (dun|du|doon)\b")),
+]
+# Only a negation directly before the flag ("no chest pain") or a denial/"medicine for" directly
+# after it ("seizure nahi hai", "mirgi ki dawai") marks it non-acute. Asking for medicine
+# later in the message ("chest pain hai, koi medicine batao") still flags - missing an
+# emergency is worse than over-flagging one.
+TRIAGE_NEGATION_BEFORE = re.compile(r"\b(no|not|never|without)\W*$")
+TRIAGE_NON_ACUTE_AFTER = re.compile(r"^\w*\W*(nahi hai|nahi tha|nahi hua|nhi hai|ki dawai|ki dawa)\b")
+
+def find_red_flag(text):
+    """Emergency type for the first acute red-flag match, else None"""
+    text = ' '.join(text.lower().split())
+    for emergency_type, pattern in TRIAGE_RED_FLAGS:
+        for match in pattern.finditer(text):
+            if TRIAGE_NEGATION_BEFORE.search(text[:match.start()]) or TRIAGE_NON_ACUTE_AFTER.search(text[match.end():]):
+                continue
+            return emergency_type
+    return None